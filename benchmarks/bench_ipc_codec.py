@@ -0,0 +1,116 @@
+"""
+Compare the IPC encodings on request-log records: encode/decode time per message and bytes on the wire.
+
+    python benchmarks/bench_ipc_codec.py [--records N] [--rounds N] [--batch N]
+
+With --batch the records are published as lists of that many records, as the publisher's batched mode does.
+Encodings whose dependencies aren't installed (e.g. msgpack) are skipped.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cachebrowser.ipccodec import CODECS, CodecError, get_codec
+
+REQUEST_HEADERS = {
+    'Host': 'www.example.com',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, sdch',
+    'Accept-Language': 'en-US,en;q=0.8',
+    'Cookie': 'PREF=f1=50000000&f6=400; VISITOR_INFO1_LIVE=kq1rGmOL7ng; YSC=Eu1bG-uHm3s',
+}
+
+RESPONSE_HEADERS = {
+    'Content-Type': 'text/html; charset=utf-8',
+    'Content-Encoding': 'gzip',
+    'Cache-Control': 'private, max-age=0',
+    'Date': 'Mon, 11 Jul 2016 18:21:05 GMT',
+    'Server': 'gws',
+    'Set-Cookie': 'NID=82=mA3Z8Yc4zTfl2PkJYqrRzZxq; expires=Tue, 10-Jan-2017 18:21:05 GMT; path=/; HttpOnly',
+    'X-XSS-Protection': '1; mode=block',
+}
+
+
+def make_record(i):
+    return {
+        'id': i,
+        'url': 'https://www.example.com/static/{}/app-{}.js'.format(random.randint(0, 1000), i),
+        'method': 'GET',
+        'scheme': 'https',
+        'scheme_upgraded': bool(i % 2),
+        'request_size': random.randint(200, 2000),
+        'request_headers': REQUEST_HEADERS,
+        'status_code': 200,
+        'reason': 'OK',
+        'response_size': random.randint(1000, 100000),
+        'response_headers': RESPONSE_HEADERS,
+        'address': '151.101.{}.{}'.format(random.randint(0, 255), random.randint(0, 255)),
+        'sni': '',
+        'cdn': 'fastly',
+        'cachebrowsed': True,
+        'cb_error': '',
+    }
+
+
+def make_messages(num_records, batch):
+    records = [make_record(i) for i in range(num_records)]
+    if batch > 1:
+        payloads = [records[i:i + batch] for i in range(0, len(records), batch)]
+    else:
+        payloads = records
+    return [{'type': 'pub', 'channel': 'request-log', 'message': payload} for payload in payloads]
+
+
+def bench(codec, messages, rounds):
+    frames = [codec.encode(message) for message in messages]
+    wire_bytes = sum(len(frame if isinstance(frame, bytes) else frame.encode('utf-8')) for frame in frames)
+
+    encode = min(timeit.repeat(lambda: [codec.encode(m) for m in messages], number=1, repeat=rounds))
+    decode = min(timeit.repeat(lambda: [codec.decode(f) for f in frames], number=1, repeat=rounds))
+
+    return {
+        'encode_us': encode / len(messages) * 1e6,
+        'decode_us': decode / len(messages) * 1e6,
+        'bytes': float(wire_bytes) / len(messages),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--compress-threshold', type=int, default=1024)
+    args = parser.parse_args()
+
+    random.seed(0)
+    messages = make_messages(args.records, args.batch)
+
+    print("{} messages ({} record(s) each), best of {} rounds".format(len(messages), args.batch, args.rounds))
+    print("{:<16} {:>12} {:>12} {:>12}".format('encoding', 'encode us', 'decode us', 'bytes/msg'))
+
+    for name in sorted(CODECS):
+        for compress in (False, True):
+            try:
+                codec = get_codec(name, compress=compress, compress_threshold=args.compress_threshold)
+            except CodecError as e:
+                print("{:<16} skipped: {}".format(name, e))
+                break
+            if compress and not codec.compress:
+                continue
+
+            result = bench(codec, messages, args.rounds)
+            label = name + ('+zlib' if compress else '')
+            print("{:<16} {:>12.1f} {:>12.1f} {:>12.0f}".format(label, result['encode_us'], result['decode_us'],
+                                                                result['bytes']))
+
+
+if __name__ == '__main__':
+    main()
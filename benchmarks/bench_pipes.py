@@ -0,0 +1,527 @@
+"""
+Benchmark the proxy's pipe chain.
+
+    python benchmarks/bench_pipes.py [--iterations N] [--requests N] [--concurrency N] [--only micro|macro]
+                                     [--output results.json] [--json]
+
+Micro benchmarks drive the hooks of each pipe (ResolverPipe, ScramblerPipe and the AdBlocker, DecoyMaker and
+NetStatKeeper behind it, SNIPipe, PublisherPipe and PrefetchPipe) directly with synthetic flows and server
+connections, one call at a time.
+
+The macro benchmark starts a local TLS origin and the complete ProxyController built by `cachebrowser start`, and
+sends HTTPS requests for a bootstrapped host through it. Its per-hook numbers come from the controller's own
+pipe statistics (what /pipes/stats reports), ops/sec there is the hook's throughput over the whole run. Decoys
+are disabled for the macro run, they would go out to the real decoy hosts.
+
+Every entry reports ops/sec and the p50/p99 latency in microseconds. With --output the results are also written
+as JSON, with --json only the JSON is printed, so runs can be compared over time.
+
+Everything runs against a temporary database and a bootstrap file describing the synthetic hosts, no requests
+leave the machine. Requires the proxy's own dependencies (mitmproxy 0.17).
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import ssl
+import sys
+import tempfile
+import time
+from itertools import cycle
+from threading import Thread
+from timeit import default_timer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import six
+import yaml
+from six.moves import BaseHTTPServer, http_client, socketserver
+
+from mitmproxy.controller import DummyReply
+from mitmproxy.models import ClientConnection, HTTPFlow, HTTPRequest, HTTPResponse, ServerConnection
+from mitmproxy.proxy.server import ProxyServer
+from netlib.certutils import CertStore
+from netlib.http import Headers
+from netlib.tcp import Address
+from OpenSSL import crypto
+
+from cachebrowser.bootstrap import Bootstrapper
+from cachebrowser.cache import TTLCache
+from cachebrowser.decoys import DecoyCatalog
+from cachebrowser.main import Context, build_proxy_controller
+from cachebrowser.models import WhoisNetwork, WriteBehindQueue, initialize_database
+from cachebrowser.pipes.prefetch import PrefetchPipe, extract_hostnames
+from cachebrowser.pipes.publisher import PublisherPipe
+from cachebrowser.pipes.resolver import ResolverPipe
+from cachebrowser.pipes.scrambler import ScramblerPipe
+from cachebrowser.pipes.sni import SNIPipe
+from cachebrowser.proxy import ProxyConfig
+from cachebrowser.settings import DevelopmentSettings
+from cachebrowser.stats import LatencyHistogram
+
+BENCH_HOST = 'bench.example'
+BENCH_CDN = 'bench-cdn'
+# Hosts served by the bench CDN, besides BENCH_HOST
+NUM_HOSTS = 50
+# Each host's address is classified into one of the decoy organizations
+HOST_NETWORK = u'10.{}.0.0/16'
+
+# Flows are built in batches, outside of the timed calls
+BATCH_SIZE = 500
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103'
+
+PAGE_BODY = (
+    b'<html><head>'
+    b'<link rel="stylesheet" href="https://static.bench.example/site.css">'
+    b'<script src="https://cdn1.bench.example/app.js"></script>'
+    b'</head><body>' + b'<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>' * 300 +
+    b'<img src="https://img.bench.example/logo.png"></body></html>'
+)
+
+
+class BenchIPC(object):
+    """
+    Stands in for the IPC manager: every channel has a subscriber, published messages are only counted
+    """
+
+    def __init__(self):
+        self.published = 0
+        self.handlers = {}
+
+    def has_subscribers(self, channel):
+        return True
+
+    def publish(self, channel, message):
+        self.published += 1
+
+    def subscribe(self, channel, callback):
+        pass
+
+    def register_rpc(self, method, handler):
+        self.handlers[method] = handler
+
+
+class BenchMaster(object):
+    """
+    Stands in for the ProxyController when pipe hooks are called directly. Replayed requests (decoys) are only
+    counted.
+    """
+    pause_scripts = False
+
+    def __init__(self, ipc):
+        self.ipc = ipc
+        self.replayed = 0
+
+    def add_event(self, e, level=None, key=None):
+        pass
+
+    def create_request(self, method, scheme, host, port, path):
+        return make_flow(host, path, ip='127.0.0.1', scheme=scheme, port=port, response=False)
+
+    def replay_request(self, flow, run_scripthooks=True, block=False):
+        self.replayed += 1
+
+    def call_in_master(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def pipes_changed(self, pipe):
+        pass
+
+
+def make_flow(host, path, ip, scheme='https', port=443, response=True, content_type='text/html', body=PAGE_BODY):
+    client_conn = ClientConnection.make_dummy(('127.0.0.1', 40000))
+    server_conn = ServerConnection.make_dummy((host, port))
+    server_conn.peer_address = Address((ip, port))
+
+    flow = HTTPFlow(client_conn, server_conn)
+    flow.reply = DummyReply()
+    flow.request = HTTPRequest(
+        'relative', 'GET', scheme, host, port, path, 'HTTP/1.1',
+        Headers(host=host, user_agent=USER_AGENT, accept='text/html,*/*;q=0.8', accept_encoding='identity'),
+        b'')
+
+    if response:
+        flow.response = HTTPResponse(
+            'HTTP/1.1', 200, 'OK',
+            Headers(content_type=content_type, content_length=str(len(body)), cache_control='max-age=300'),
+            body)
+
+    return flow
+
+
+def host_name(i):
+    return 'www{}.{}'.format(i, BENCH_HOST)
+
+
+def host_ip(i):
+    return '10.{}.0.{}'.format(i % 250, 1 + i % 200)
+
+
+def write_bootstrap_file(path, edge_server):
+    entries = [{'type': 'cdn', 'id': BENCH_CDN, 'name': 'Bench CDN', 'edge_servers': [edge_server]},
+               {'type': 'host', 'name': BENCH_HOST, 'ssl': True, 'cdn': BENCH_CDN},
+               {'type': 'host', 'name': '*.' + BENCH_HOST, 'ssl': True, 'cdn': BENCH_CDN}]
+    with open(path, 'w') as f:
+        yaml.safe_dump(entries, f, default_flow_style=False)
+
+
+def make_context(workdir, ipc, proxy_port=8080):
+    bootstrap_path = os.path.join(workdir, 'bootstrap.yaml')
+    write_bootstrap_file(bootstrap_path, '127.0.0.1')
+
+    settings = DevelopmentSettings()
+    settings.port = proxy_port
+    settings.database = os.path.join(workdir, 'bench.sqlite')
+    settings.bootstrap_sources = [{'type': 'local', 'path': bootstrap_path}]
+    settings.pipe_stats_interval = 0
+    settings.validate()
+
+    db = initialize_database(settings.database, reset=True, pragmas=settings.database_pragmas)
+
+    context = Context()
+    context.settings = settings
+    context.bootstrapper = Bootstrapper(settings)
+    context.host_cache = TTLCache(max_size=settings.host_cache_size,
+                                  ttl=settings.host_cache_ttl,
+                                  negative_ttl=settings.host_cache_negative_ttl)
+    context.db_writer = WriteBehindQueue(db,
+                                         max_batch=settings.database_write_batch_size,
+                                         flush_interval=settings.database_write_interval,
+                                         enabled=settings.database_write_behind)
+    context.ipc = ipc
+    return context
+
+
+def seed_whois(settings):
+    """
+    Classify the synthetic host addresses (and 127/8, for the macro run) into the decoy organizations, so the
+    scrambler never does a lookup
+    """
+    org_names = DecoyCatalog.open(settings.data_path('scrambler/decoy.json')).org_names
+    expires = time.time() + 24 * 3600
+    WhoisNetwork.delete().execute()
+    for i in range(250):
+        WhoisNetwork.create(cidr=HOST_NETWORK.format(i), org=org_names[i % len(org_names)], expires=expires)
+    WhoisNetwork.create(cidr=u'127.0.0.0/8', org=org_names[0], expires=expires)
+
+
+def ad_domains(settings, count=20):
+    domains = []
+    with open(settings.data_path('scrambler/ad-domains')) as f:
+        for line in f:
+            line = line.strip()
+            if line and line.count('.') >= 1:
+                domains.append(line)
+            if len(domains) >= count:
+                break
+    return domains
+
+
+def summarize(histogram, calls, elapsed):
+    def us(seconds):
+        return None if seconds is None else round(seconds * 1e6, 2)
+
+    return {
+        'calls': calls,
+        'ops_per_sec': round(calls / elapsed, 1) if elapsed else None,
+        'mean_us': round(histogram.total / float(histogram.count), 2) if histogram.count else None,
+        'p50_us': us(histogram.percentile(50)),
+        'p99_us': us(histogram.percentile(99)),
+    }
+
+
+def bench_hook(func, make_args, iterations):
+    """
+    Call `func(*args)` `iterations` times with arguments from `make_args(i)`, built in batches outside the
+    timed calls
+    """
+    histogram = LatencyHistogram()
+    elapsed = 0.0
+
+    for batch_start in range(0, iterations, BATCH_SIZE):
+        batch = [make_args(i) for i in range(batch_start, min(batch_start + BATCH_SIZE, iterations))]
+        for args in batch:
+            start = default_timer()
+            func(*args)
+            duration = default_timer() - start
+            histogram.record(duration)
+            elapsed += duration
+
+    return summarize(histogram, iterations, elapsed)
+
+
+def run_micro(context, iterations):
+    master = BenchMaster(context.ipc)
+
+    def attach(pipe):
+        pipe.set_master(master)
+        return pipe
+
+    resolver = attach(ResolverPipe(context))
+    scrambler = attach(ScramblerPipe(context))
+    sni = attach(SNIPipe(context))
+    publisher = attach(PublisherPipe(context))
+    prefetch = attach(PrefetchPipe(context, resolver))
+
+    # What their start hooks do, without the background threads
+    scrambler.adblocker.load_blacklist(context.settings.data_path('scrambler/ad-domains'),
+                                       context.settings.data_path('scrambler/blacklist'))
+    publisher.start()
+
+    # Warm the host cache (and the database) with every synthetic host
+    for i in range(NUM_HOSTS):
+        resolver.serverconnect(make_flow(host_name(i), '/', host_ip(i)).server_conn)
+    context.db_writer.flush()
+
+    ads = ad_domains(context.settings)
+
+    def user_flow(i, response=True):
+        return make_flow(host_name(i % NUM_HOSTS), '/page/{}'.format(i), host_ip(i), response=response)
+
+    def ad_flow(i):
+        return make_flow(ads[i % len(ads)], '/ad/{}.js'.format(i), host_ip(i), response=False)
+
+    def uncached_server_conn(i):
+        server_conn = user_flow(i).server_conn
+        context.host_cache.invalidate(server_conn.address.host)
+        return server_conn,
+
+    results = {}
+
+    def bench(name, func, make_args):
+        results[name] = bench_hook(func, make_args, iterations)
+
+    bench('ResolverPipe.serverconnect', resolver.serverconnect, lambda i: (user_flow(i).server_conn,))
+    bench('ResolverPipe.serverconnect (uncached)', resolver.serverconnect, uncached_server_conn)
+    bench('ResolverPipe.request', resolver.request,
+          lambda i: (make_flow(host_name(i % NUM_HOSTS), '/', host_ip(i), scheme='http', port=80),))
+
+    bench('ScramblerPipe.request', scrambler.request, lambda i: (user_flow(i, response=False),))
+    bench('ScramblerPipe.request (blocked ad)', scrambler.request, lambda i: (ad_flow(i),))
+    bench('ScramblerPipe.response', scrambler.response, lambda i: (user_flow(i),))
+    bench('AdBlocker.should_block', scrambler.adblocker.should_block, lambda i: (user_flow(i, response=False),))
+    bench('DecoyMaker.get_decoy', scrambler.decoymaker.get_decoy, lambda i: ())
+    bench('NetStatKeeper.update_requested_downstream', scrambler.netstats.update_requested_downstream,
+          lambda i: (user_flow(i),))
+
+    bench('SNIPipe.serverconnect', sni.serverconnect,
+          lambda i: (resolver.serverconnect(user_flow(i).server_conn),))
+
+    bench('PublisherPipe.request', publisher.request, lambda i: (user_flow(i, response=False),))
+    bench('PublisherPipe.response', publisher.response, lambda i: (publisher.request(user_flow(i)),))
+
+    bench('PrefetchPipe.response', prefetch.response, lambda i: (user_flow(i),))
+    # Done by the prefetcher's scanner thread, off the response hook
+    bench('extract_hostnames', extract_hostnames, lambda i: (PAGE_BODY, PrefetchPipe.MAX_HOSTS_PER_RESPONSE))
+
+    return results
+
+
+class OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(PAGE_BODY)))
+        self.end_headers()
+        self.wfile.write(PAGE_BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class OriginServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_origin(workdir):
+    """
+    Start the TLS stub origin on a free port, with a certificate from a throwaway CA
+    """
+    store = CertStore.from_store(workdir, 'bench')
+    cert, key, _ = store.get_cert(six.b(BENCH_HOST), [six.b('*.' + BENCH_HOST)])
+
+    pem_path = os.path.join(workdir, 'origin.pem')
+    with open(pem_path, 'wb') as f:
+        f.write(cert.to_pem())
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+    tls = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    tls.load_cert_chain(pem_path)
+
+    server = OriginServer(('127.0.0.1', 0), OriginHandler)
+    server.socket = tls.wrap_socket(server.socket, server_side=True)
+
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("proxy didn't start listening on port {}".format(port))
+
+
+def run_client(proxy_port, origin_port, requests, histogram, errors):
+    tls = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    tls.verify_mode = ssl.CERT_NONE
+
+    conn = None
+    tunnel_host = None
+    hosts = cycle([BENCH_HOST] * 10 + [host_name(i) for i in range(NUM_HOSTS)])
+    for i in range(requests):
+        host = next(hosts)
+        start = default_timer()
+        try:
+            if conn is None or tunnel_host != host:
+                # One tunnel per host, like a browser
+                if conn is not None:
+                    conn.close()
+                conn = http_client.HTTPSConnection('127.0.0.1', proxy_port, timeout=30, context=tls)
+                conn.set_tunnel(host, origin_port)
+                tunnel_host = host
+            conn.request('GET', '/page/{}'.format(i), headers={'User-Agent': USER_AGENT})
+            conn.getresponse().read()
+        except Exception:
+            errors.append(i)
+            conn = None
+            continue
+        histogram.record(default_timer() - start)
+
+    if conn is not None:
+        conn.close()
+
+
+def run_macro(context, requests, concurrency, workdir):
+    origin = start_origin(workdir)
+    origin_port = origin.server_address[1]
+
+    server = ProxyServer(ProxyConfig(context))
+    context.db_writer.start()
+    master = build_proxy_controller(context, server)
+    for pipe in master.scripts:
+        if isinstance(pipe, ScramblerPipe):
+            pipe.send_decoys = False
+
+    proxy = Thread(target=master.run)
+    proxy.daemon = True
+    proxy.start()
+    wait_for_port(context.settings.port)
+
+    # Bootstrap and connect once before timing
+    run_client(context.settings.port, origin_port, 1, LatencyHistogram(), [])
+    for stats in master.hook_stats.values():
+        stats.latency.reset()
+        stats.errors = stats.skips = 0
+
+    histogram = LatencyHistogram()
+    errors = []
+    per_client = max(1, requests // concurrency)
+    clients = [Thread(target=run_client, args=(context.settings.port, origin_port, per_client, histogram, errors))
+               for _ in range(concurrency)]
+
+    start = default_timer()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = default_timer() - start
+
+    master.shutdown()
+    origin.shutdown()
+    context.db_writer.stop()
+
+    hooks = {}
+    for (pipe_name, hook), stats in sorted(master.hook_stats.items()):
+        hooks['{}.{}'.format(pipe_name, hook)] = summarize(stats.latency, stats.latency.count, elapsed)
+
+    result = summarize(histogram, histogram.count, elapsed)
+    result.update({'requests': per_client * concurrency, 'concurrency': concurrency, 'errors': len(errors)})
+    return {'requests': result, 'hooks': hooks}
+
+
+def print_table(title, entries):
+    print(title)
+    print("{:<48} {:>10} {:>12} {:>10} {:>10}".format('', 'calls', 'ops/sec', 'p50 us', 'p99 us'))
+    for name in sorted(entries):
+        entry = entries[name]
+        print("{:<48} {:>10} {:>12} {:>10} {:>10}".format(name, entry['calls'], entry['ops_per_sec'],
+                                                           entry['p50_us'], entry['p99_us']))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000, help="calls per micro benchmark")
+    parser.add_argument('--requests', type=int, default=2000, help="requests sent in the macro benchmark")
+    parser.add_argument('--concurrency', type=int, default=4, help="concurrent clients in the macro benchmark")
+    parser.add_argument('--only', choices=['micro', 'macro'])
+    parser.add_argument('--output', help="write the results to this file as JSON")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON instead of a table")
+    args = parser.parse_args()
+
+    # The development settings find the data files relative to the repository
+    os.chdir(ROOT)
+    workdir = tempfile.mkdtemp(prefix='cachebrowser-bench-')
+
+    results = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+    }
+
+    try:
+        if args.only != 'macro':
+            context = make_context(workdir, BenchIPC())
+            seed_whois(context.settings)
+            results['micro'] = run_micro(context, args.iterations)
+        if args.only != 'micro':
+            context = make_context(workdir, BenchIPC(), proxy_port=free_port())
+            seed_whois(context.settings)
+            results['macro'] = run_macro(context, args.requests, args.concurrency, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    if 'micro' in results:
+        print_table("Micro benchmarks, {} calls each".format(args.iterations), results['micro'])
+    if 'macro' in results:
+        requests = results['macro']['requests']
+        print("Macro benchmark: {} requests over {} connections, {} req/s, p50 {} us, p99 {} us, {} errors".format(
+            requests['requests'], requests['concurrency'], requests['ops_per_sec'], requests['p50_us'],
+            requests['p99_us'], requests['errors']))
+        print_table("Pipe hooks during the macro benchmark", results['macro']['hooks'])
+
+
+if __name__ == '__main__':
+    main()
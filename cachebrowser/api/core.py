@@ -9,6 +9,9 @@ class APIRequest(object):
     def reply(self, response):
         raise NotImplementedError()
 
+    def error(self, message):
+        raise NotImplementedError()
+
 
 class BaseAPIManager(object):
     def __init__(self):
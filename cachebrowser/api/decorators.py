@@ -0,0 +1,7 @@
+def blocking(handler):
+    """
+    Mark an API handler as blocking, e.g. because it queries the database. Blocking handlers are run in a worker
+    pool instead of on the IPC IOLoop thread, they may reply from the worker thread.
+    """
+    handler.blocking = True
+    return handler
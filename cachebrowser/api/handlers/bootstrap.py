@@ -1,3 +1,4 @@
+from cachebrowser.api.decorators import blocking
 from cachebrowser.models import Host, CDN
 
 
@@ -17,6 +18,7 @@ def serialize_cdn(cdn):
     }
 
 
+@blocking
 def get_hosts(context, request):
     page = request.params.get('page', 0)
     num_per_page = request.params.get('num_per_page', 5)
@@ -30,12 +32,15 @@ def get_hosts(context, request):
     request.reply(hosts)
 
 
+@blocking
 def delete_host(context, request):
     hostname = request.params.get('host', '')
     Host.delete().where(Host.hostname == hostname).execute()
+    context.host_cache.invalidate(hostname)
     request.reply()
 
 
+@blocking
 def add_host(context, request):
     host = Host()
     host.hostname = request.params.get('hostname', '')
@@ -43,9 +48,11 @@ def add_host(context, request):
     host.ssl = request.params.get('ssl', True)
 
     host.save(force_insert=True)
+    context.host_cache.invalidate(host.hostname)
     request.reply()
 
 
+@blocking
 def get_cdns(context, request):
     page = request.params.get('page', 0)
     num_per_page = request.params.get('num_per_page', 5)
@@ -59,6 +66,7 @@ def get_cdns(context, request):
     request.reply(cdns)
 
 
+@blocking
 def add_cdn(context, request):
     cdn = CDN()
     cdn.id = request.params.get('id', '')
@@ -66,4 +74,19 @@ def add_cdn(context, request):
     cdn.edge_server = request.params.get('edge_server', True)
 
     cdn.save(force_insert=True)
+    # Any cached host (or negative entry) may refer to the new CDN, so drop them all
+    context.host_cache.clear()
     request.reply()
+
+
+def get_host_cache_stats(context, request):
+    request.reply(context.host_cache.stats())
+
+
+def clear_host_cache(context, request):
+    context.host_cache.clear()
+    request.reply()
+
+
+def get_bootstrap_stats(context, request):
+    request.reply(context.bootstrapper.stats())
@@ -1,6 +1,8 @@
+from cachebrowser.api.decorators import blocking
 from cachebrowser.models import Website
 
 
+@blocking
 def enable_website(context, request):
     hostname = request.params.get('website', None)
 
@@ -15,6 +17,7 @@ def enable_website(context, request):
     request.reply({'result': 'success'})
 
 
+@blocking
 def disable_website(context, request):
     hostname = request.params.get('website', None)
 
@@ -29,6 +32,7 @@ def disable_website(context, request):
     request.reply({'result': 'success'})
 
 
+@blocking
 def is_website_enabled(context, request):
     hostname = request.params.get('website', None)
 
@@ -1,4 +1,5 @@
-from cachebrowser.api.handlers.bootstrap import get_hosts, get_cdns, delete_host, add_host, add_cdn
+from cachebrowser.api.handlers.bootstrap import get_hosts, get_cdns, delete_host, add_host, add_cdn, \
+    get_host_cache_stats, clear_host_cache, get_bootstrap_stats
 from cachebrowser.api.handlers.process import close, ping
 from cachebrowser.api.handlers.website import is_website_enabled, enable_website, disable_website
 
@@ -8,8 +9,11 @@ routes = [
     ('/hosts', get_hosts),
     ('/hosts/delete', delete_host),
     ('/hosts/add', add_host),
+    ('/hosts/cache/stats', get_host_cache_stats),
+    ('/hosts/cache/clear', clear_host_cache),
     ('/cdns', get_cdns),
     ('/cdns/add', add_cdn),
+    ('/bootstrap/stats', get_bootstrap_stats),
     ('/website/enabled', is_website_enabled),
     ('/website/enable', enable_website),
     ('/website/disable', disable_website),
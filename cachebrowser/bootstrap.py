@@ -1,9 +1,17 @@
+import json
 import random
 import yaml
 import logging
-from copy import deepcopy
+from time import time
+from threading import Lock
 from yaml.scanner import ScannerError
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from cachebrowser.cache import TTLCache, SingleFlight, MISSING, NEGATIVE
+from cachebrowser.matching import HostPatternIndex
+from cachebrowser.stats import LatencyHistogram
+
 logger = logging.getLogger(__name__)
 
 
@@ -15,6 +23,18 @@ class BaseBootstrapSource(object):
     def lookup_host(self, hostname):
         pass
 
+    def lookup_hosts(self, hostnames):
+        """
+        Lookup several hosts at once. Returns a dict mapping each hostname that was found to its host data.
+        Sources which can do better than one lookup per host should override this.
+        """
+        result = {}
+        for hostname in hostnames:
+            host_data = self.lookup_host(hostname)
+            if host_data:
+                result[hostname] = host_data
+        return result
+
     def lookup_cdn(self, cdn_id):
         pass
 
@@ -24,30 +44,34 @@ class LocalBootstrapSource(BaseBootstrapSource):
 
     def __init__(self, filename):
         super(LocalBootstrapSource, self).__init__()
-        self.hosts = {}
-        self.cdns = {}
+        # (host pattern index, {cdn id: cdn}), replaced as a whole when the file is reloaded
+        self._index = (HostPatternIndex(), {})
 
         self.filename = filename
         self._load_source(filename)
 
-    def lookup_host(self, hostname):
-        from fnmatch import fnmatch
-
-        main_domain = '.'.join(hostname.split('.')[-2:])
+    def reload(self):
+        """
+        Parse the file again. The new indexes replace the current ones once they are complete, lookups keep using
+        the current ones in the meantime. If the file is invalid the current ones are kept.
+        """
+        source = LocalBootstrapSource(self.filename)
+        self._index = source._index
 
-        if main_domain not in self.hosts:
+    def lookup_host(self, hostname):
+        hosts, _ = self._index
+        host = hosts.lookup(hostname)
+        if host is None:
             return None
 
-        for host in self.hosts[main_domain]:
-            if fnmatch(hostname, host['hostname']):
-                _host = deepcopy(host)
-                _host['hostname'] = hostname
-                return _host
-
-        return None
+        # Host records are stored as immutable tuples of items, callers get their own (shallow) dict
+        _host = dict(host)
+        _host['hostname'] = hostname
+        return _host
 
     def lookup_cdn(self, cdn_id):
-        cdn = self.cdns.get(cdn_id, None)
+        _, cdns = self._index
+        cdn = cdns.get(cdn_id, None)
         if cdn is not None and len(cdn['edge_servers']) > 0:
             return {
                 'id': cdn['id'],
@@ -100,9 +124,8 @@ class LocalBootstrapSource(BaseBootstrapSource):
         if any([s in main_domain for s in ('*', '?')]):
             raise BootstrapSourceError(self.ERROR_PREFIX + "Wildcards only allowed in subdomains")
 
-        if main_domain not in self.hosts:
-            self.hosts[main_domain] = []
-        self.hosts[main_domain].append(host)
+        hosts, _ = self._index
+        hosts.add(host['hostname'], tuple(host.items()))
 
     def _parse_cdn_entry(self, cdn_data):
         if 'id' not in cdn_data:
@@ -114,25 +137,98 @@ class LocalBootstrapSource(BaseBootstrapSource):
             'edge_servers': cdn_data.get('edge_servers', [])
         }
 
-        self.cdns[cdn['id']] = cdn
+        _, cdns = self._index
+        cdns[cdn['id']] = cdn
 
     def __str__(self):
         return self.filename
 
 
 class RemoteBootstrapSource(BaseBootstrapSource):
-    def __init__(self, server_url):
+    """
+    Bootstrap source backed by a remote bootstrap server's REST API.
+
+    Requests go through a pooled keep-alive session with connect/read timeouts. Responses are cached (404s
+    negatively, for a shorter time) and concurrent lookups for the same resource share a single in-flight request,
+    so a slow or unreachable server only stalls the first of them. Failed requests raise `BootstrapSourceError`
+    and aren't cached, the bootstrapper's circuit breaker decides when to try the server again.
+    """
+
+    def __init__(self, server_url, timeout=(3.05, 5), pool_size=10, cache_size=4096, cache_ttl=600, negative_ttl=60):
         super(RemoteBootstrapSource, self).__init__()
 
         if '://' not in server_url:
             raise BootstrapSourceError('Invalid remote bootstrap server URL')
 
-        self.server_url = server_url
+        self.server_url = server_url.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl, negative_ttl=negative_ttl)
+        self._inflight = SingleFlight()
+        self._session = None
+        self._session_lock = Lock()
+
+        # Assume the server has the batch endpoint until it tells us otherwise
+        self.batch_supported = True
 
     def lookup_host(self, hostname):
-        _hostname = hostname.replace('.', '_')
-        data = self._request('/hosts/%s' % _hostname)
+        data = self._request(self._host_path(hostname))
+        return self._parse_host_data(hostname, data)
+
+    def lookup_hosts(self, hostnames):
+        """
+        Lookup several hosts with a single request to the server's batch endpoint:
+
+            POST /hosts/batch  {"hosts": ["www_example_com", ...]}  ->  {"data": {"www_example_com": {...}, ...}}
+
+        Hosts which are missing from the response don't exist. Responses are cached per host, so later
+        `lookup_host` calls are served from the cache. Falls back to one request per host if the server doesn't
+        support batch lookups.
+        """
+        result = {}
+        missing = []
+        for hostname in hostnames:
+            data = self.cache.get(self._host_path(hostname))
+            if data is MISSING:
+                missing.append(hostname)
+            elif data is not NEGATIVE:
+                result[hostname] = self._parse_host_data(hostname, data)
+
+        if not missing:
+            return result
+
+        if not self.batch_supported:
+            result.update(super(RemoteBootstrapSource, self).lookup_hosts(missing))
+            return result
+
+        batch = self._fetch_batch(missing)
+        if batch is None:
+            # Batch endpoint not available, fetch the hosts one by one
+            result.update(super(RemoteBootstrapSource, self).lookup_hosts(missing))
+            return result
+
+        for hostname in missing:
+            path = self._host_path(hostname)
+            data = batch.get(self._host_key(hostname))
+            if data is None:
+                self.cache.set_negative(path)
+            else:
+                self.cache.set(path, data)
+                result[hostname] = self._parse_host_data(hostname, data)
+
+        return result
+
+    @staticmethod
+    def _host_key(hostname):
+        return hostname.replace('.', '_')
 
+    @classmethod
+    def _host_path(cls, hostname):
+        return '/hosts/%s' % cls._host_key(hostname)
+
+    @staticmethod
+    def _parse_host_data(hostname, data):
         if data is None:
             return None
 
@@ -161,26 +257,73 @@ class RemoteBootstrapSource(BaseBootstrapSource):
             'edge': data['edges'][0]
         }
 
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
     def _request(self, path):
+        data = self.cache.get(path)
+        if data is NEGATIVE:
+            return None
+        if data is not MISSING:
+            return data
+
+        return self._inflight.do(path, self._fetch, path)
+
+    def _fetch(self, path):
         import requests
-        import json
 
         url = self.server_url + path
         try:
-            response = requests.get(url)
-        except requests.exceptions.ConnectionError:
-            logger.warning("Connection with remote bootstrap '{}' failed".format(str(self)))
-            return None
+            response = self.session.get(url, timeout=self.timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise BootstrapSourceError("Connection with remote bootstrap '{}' failed: {}".format(str(self), e))
 
-        # response = request(os.path.join(self.server_url, path))
         if response.status_code == 404:
+            self.cache.set_negative(path)
+            return None
+        elif response.status_code != 200:
+            raise BootstrapSourceError('Remote bootstrapper request failed: %d' % response.status_code)
+
+        try:
+            data = json.loads(response.text)['data']
+        except (ValueError, KeyError):
+            raise BootstrapSourceError('Invalid JSON response from remote bootstrap server')
+
+        self.cache.set(path, data)
+        return data
+
+    def _fetch_batch(self, hostnames):
+        import requests
+
+        url = self.server_url + '/hosts/batch'
+        payload = {'hosts': [self._host_key(hostname) for hostname in hostnames]}
+        try:
+            response = self.session.post(url, json=payload, timeout=self.timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise BootstrapSourceError("Connection with remote bootstrap '{}' failed: {}".format(str(self), e))
+
+        if response.status_code in (404, 405, 501):
+            logger.debug("Remote bootstrap '{}' does not support batch lookups".format(str(self)))
+            self.batch_supported = False
             return None
         elif response.status_code != 200:
             raise BootstrapSourceError('Remote bootstrapper request failed: %d' % response.status_code)
 
         try:
             return json.loads(response.text)['data']
-        except ValueError:
+        except (ValueError, KeyError):
             raise BootstrapSourceError('Invalid JSON response from remote bootstrap server')
 
     def __str__(self):
@@ -205,26 +348,126 @@ class BootstrapValidationError(BootstrapError):
     pass
 
 
+class CircuitBreaker(object):
+    """
+    Stops calling a source that keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and `allow` returns False for `reset_timeout`
+    seconds. After that a single trial call is let through (half-open): if it succeeds the breaker closes again,
+    if it fails the breaker re-opens for another `reset_timeout`.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time()
+
+
+class SourceState(object):
+    """
+    Bookkeeping the bootstrapper keeps for each source: its deadline, circuit breaker and latency histogram
+    """
+
+    def __init__(self, source, timeout, breaker):
+        self.source = source
+        self.timeout = timeout
+        self.breaker = breaker
+        self.latency = LatencyHistogram()
+
+        self.errors = 0
+        self.timeouts = 0
+        self.skipped = 0
+
+    def stats(self):
+        return {
+            'source': str(self.source),
+            'type': 'local' if isinstance(self.source, LocalBootstrapSource) else 'remote',
+            'timeout': self.timeout,
+            'breaker': self.breaker.state,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'skipped': self.skipped,
+            'latency': self.latency.snapshot(),
+        }
+
+
 class Bootstrapper(object):
+    SEQUENTIAL = 'sequential'
+    PARALLEL = 'parallel'
+
     def __init__(self, settings):
         self.settings = settings
         self.sources = []
+        self.source_states = []
+
+        self.lookup_mode = settings.bootstrap_lookup_mode
+        self.grace_period = settings.bootstrap_grace_period
+        self._executor = None
 
         self._initialize_sources(settings.bootstrap_sources)
 
     def _initialize_sources(self, sources):
         for source_config in sources:
+            timeout = source_config.get('timeout', self.settings.bootstrap_timeout)
             if source_config['type'] == 'local':
                 source = LocalBootstrapSource(source_config['path'])
             elif source_config['type'] == 'remote':
-                source = RemoteBootstrapSource(source_config['url'])
+                source = RemoteBootstrapSource(source_config['url'],
+                                               timeout=timeout,
+                                               cache_ttl=source_config.get('cache_ttl', self.settings.bootstrap_cache_ttl))
             else:
                 # TODO warn
                 continue
-            self.add_source(source)
+            self.add_source(source, timeout)
+
+    def add_source(self, source, timeout=None):
+        if timeout is None:
+            timeout = self.settings.bootstrap_timeout
+        breaker = CircuitBreaker(self.settings.bootstrap_breaker_threshold, self.settings.bootstrap_breaker_reset)
 
-    def add_source(self, source):
         self.sources.append(source)
+        self.source_states.append(SourceState(source, timeout, breaker))
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, 4 * len(self.sources)))
+        return self._executor
+
+    def stats(self):
+        return {
+            'mode': self.lookup_mode,
+            'grace_period': self.grace_period,
+            'sources': [state.stats() for state in self.source_states],
+        }
 
     def bootstrap(self, hostname):
         hostname = self._validate_host_name(hostname)
@@ -267,33 +510,121 @@ class Bootstrapper(object):
         return host
 
     def lookup_host(self, hostname):
-        for source in self.sources:
-            logger.debug("Looking up host bootstrap info for '{}' from {} source '{}'".format(
-                hostname,
-                'local' if isinstance(source, LocalBootstrapSource) else 'remote',
-                str(source)
-            ))
-
-            host_data = source.lookup_host(hostname)
-            if host_data:
-                # return self._validate_host_data(hostname, host_data), source
-                return self._validate_host_data(hostname, host_data)
+        host_data = self._lookup('lookup_host', hostname)
+        if host_data:
+            return self._validate_host_data(hostname, host_data)
         raise HostNotAvailableError(hostname)
 
+    def lookup_hosts(self, hostnames):
+        """
+        Lookup bootstrap information for several hosts, asking each source only for the hosts which the sources
+        before it didn't know about. Returns a dict mapping hostnames to host data, unknown hosts are left out.
+        """
+        result = {}
+        remaining = list(hostnames)
+
+        for state in self.source_states:
+            if not remaining:
+                break
+
+            found = self._query_source(state, 'lookup_hosts', remaining) or {}
+            for hostname, host_data in found.items():
+                try:
+                    result[hostname] = self._validate_host_data(hostname, host_data)
+                except BootstrapValidationError as e:
+                    logger.warning(str(e))
+            remaining = [hostname for hostname in remaining if hostname not in result]
+
+        return result
+
     def lookup_cdn(self, cdn_id):
-        for source in self.sources:
-            logger.debug("Looking up cdn bootstrap info for '{}' from {} source '{}'".format(
-                cdn_id,
-                'local' if isinstance(source, LocalBootstrapSource) else 'remote',
-                str(source)
-            ))
-
-            cdn_data = source.lookup_cdn(cdn_id)
-            if cdn_data:
-                # return self._validate_cdn_data(cdn_id, cdn_data), source
-                return self._validate_cdn_data(cdn_id, cdn_data)
+        cdn_data = self._lookup('lookup_cdn', cdn_id)
+        if cdn_data:
+            return self._validate_cdn_data(cdn_id, cdn_data)
         raise CDNNotAvailableError(cdn_id)
 
+    def _lookup(self, method, key):
+        if self.lookup_mode == self.PARALLEL and len(self.source_states) > 1:
+            return self._lookup_parallel(method, key)
+
+        for state in self.source_states:
+            data = self._query_source(state, method, key)
+            if data:
+                return data
+        return None
+
+    def _lookup_parallel(self, method, key):
+        """
+        Query all sources at once. The answer of the highest priority source wins, but once some source has
+        answered, higher priority sources only get `grace_period` more seconds to answer. Sources that don't
+        answer within their own deadline are abandoned.
+        """
+        start = time()
+        futures = {}
+        for priority, state in enumerate(self.source_states):
+            futures[self.executor.submit(self._query_source, state, method, key)] = priority
+
+        deadlines = dict((future, start + self.source_states[priority].timeout)
+                         for future, priority in futures.items())
+        pending = set(futures)
+
+        best_priority, best_data, answered_at = None, None, None
+        while pending:
+            now = time()
+            if best_priority is not None:
+                pending = set(f for f in pending if futures[f] < best_priority)
+                wait_until = answered_at + self.grace_period
+            else:
+                pending = set(f for f in pending if deadlines[f] > now)
+                wait_until = max(deadlines[f] for f in pending) if pending else now
+
+            if not pending or wait_until <= now:
+                break
+
+            done, pending = wait(pending, timeout=wait_until - now, return_when=FIRST_COMPLETED)
+            for future in done:
+                data = future.result()
+                if data and (best_priority is None or futures[future] < best_priority):
+                    best_priority, best_data = futures[future], data
+                    if answered_at is None:
+                        answered_at = time()
+
+        return best_data
+
+    def _query_source(self, state, method, key):
+        source = state.source
+        if not state.breaker.allow():
+            state.skipped += 1
+            return None
+
+        logger.debug("Looking up {} for '{}' from {} source '{}'".format(
+            method[len('lookup_'):],
+            key,
+            'local' if isinstance(source, LocalBootstrapSource) else 'remote',
+            str(source)
+        ))
+
+        start = time()
+        try:
+            data = getattr(source, method)(key)
+        except Exception as e:
+            state.latency.record(time() - start)
+            state.errors += 1
+            state.breaker.record_failure()
+            logger.warning("Bootstrap source '{}' failed: {}".format(str(source), e))
+            return None
+
+        elapsed = time() - start
+        state.latency.record(elapsed)
+        if state.timeout is not None and elapsed > state.timeout:
+            # The answer came in too late to be used in parallel mode, treat slowness as a failure
+            state.timeouts += 1
+            state.breaker.record_failure()
+        else:
+            state.breaker.record_success()
+
+        return data
+
     # @classmethod
     # def _get_or_create_host(cls, hostname, create=True):
     #     try:
@@ -0,0 +1,155 @@
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+
+# Returned by `TTLCache.get` when the key is not cached (or its entry has expired)
+MISSING = object()
+# Stored by `TTLCache.set_negative` to remember that a key is known to have no value
+NEGATIVE = object()
+
+
+class TTLCache(object):
+    """
+    A bounded, thread-safe key/value cache with per-entry expiry and least-recently-used eviction.
+
+    Besides regular values the cache can hold negative entries (see `set_negative`). These record that the
+    backing store has nothing for a key, so repeated lookups for that key don't have to go back to the store
+    until the (usually shorter) negative TTL runs out.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, negative_ttl=60, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires = entry
+            if expires <= self.clock():
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+
+            if value is NEGATIVE:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return value
+
+    def peek(self, key, default=MISSING):
+        """
+        Like `get`, but doesn't count towards the hit/miss statistics or refresh the entry's LRU position
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= self.clock():
+                return default
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.negative_ttl if value is NEGATIVE else self.ttl
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, self.clock() + ttl)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_negative(self, key, ttl=None):
+        self.set(key, NEGATIVE, ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.negative_hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key: while a call for a key is in progress, other callers asking
+    for the same key wait for it and share its result (or exception) instead of issuing their own call.
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.event = Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def in_flight(self, key):
+        return key in self._calls
@@ -7,8 +7,9 @@ import click
 
 from cachebrowser.api.core import APIManager, APIRequest
 from cachebrowser.bootstrap import BootstrapError
+from cachebrowser.decoys import DecoyCatalog, compiled_path_for
 
-main_commands = ['hostcli', 'cdncli', 'bootstrap']
+main_commands = ['hostcli', 'cdncli', 'bootstrap', 'decoycli']
 
 api = APIManager()
 logger = logging.getLogger(__name__)
@@ -86,3 +87,23 @@ def bootstrap(context, save, hostname):
     if save:
         host = Host(**host_data)
         host.save()
+
+
+@click.group('decoys')
+def decoycli():
+    pass
+
+
+@decoycli.command('compile')
+@click.option('--output', help="Where to write the compiled catalog (default: next to decoy.json)")
+@click.pass_obj
+def compile_decoys(context, output):
+    """
+    Compile the scrambler's decoy.json into a catalog which can be memory-mapped on startup
+    """
+    path = context.settings.data_path('scrambler/decoy.json')
+    catalog = DecoyCatalog.from_json(path)
+
+    output = output or compiled_path_for(path)
+    catalog.compile(output)
+    click.echo("Compiled {} decoys for {} organizations into {}".format(len(catalog), len(catalog.org_names), output))
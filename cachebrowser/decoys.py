@@ -0,0 +1,249 @@
+"""
+The scrambler's decoy catalog: for every organization (CDN, hosting provider, ...) a list of URLs it serves,
+with the size of each response.
+
+The catalog is distributed as JSON ({org: {url: size}}). It can also be compiled into a compact binary file
+which is memory-mapped instead of parsed. The file starts with a header and an organization table, followed by
+the URL table, the sizes array and a blob holding all the URL strings:
+
+    header      magic, version, number of orgs, number of urls, blob length
+    orgs        per org: name offset, name length, index of the org's first url, number of urls
+    urls        per url: offset, length (into the blob)
+    sizes       per url: size in bytes
+    blob        org names and urls, utf-8 encoded
+
+URLs of an organization are stored next to each other, so an organization is just a range of url indexes.
+All integers are unsigned 32 bit little endian.
+"""
+import json
+import mmap
+from bisect import bisect_right
+import os
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+
+import six
+
+MAGIC = b'CBDC'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHIII')
+_ORG = struct.Struct('<IIII')
+_URL = struct.Struct('<II')
+
+_SIZE_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+
+COMPILED_EXTENSION = '.catalog'
+
+
+class DecoyCatalogError(Exception):
+    pass
+
+
+def _native_str(value):
+    # Flows don't like unicode URLs under Python 2
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    if not six.PY2 and isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class _MappedStrings(object):
+    """
+    Read-only sequence of the strings in a compiled catalog, decoded on access
+    """
+
+    def __init__(self, buf, table_offset, blob_offset, count):
+        self._buf = buf
+        self._table_offset = table_offset
+        self._blob_offset = blob_offset
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        offset, length = _URL.unpack_from(self._buf, self._table_offset + index * _URL.size)
+        start = self._blob_offset + offset
+        return _native_str(self._buf[start:start + length])
+
+
+class DecoyCatalog(object):
+    def __init__(self, orgs, urls, sizes, source=None):
+        """
+        :param orgs: ordered mapping of org name to (index of its first url, number of urls)
+        :param urls: sequence of all urls
+        :param sizes: array with the size of every url
+        """
+        self._orgs = orgs
+        self._urls = urls
+        self._sizes = sizes
+        self.source = source
+
+        # org -> running sums of its url sizes, built on first use by `weighted_index`
+        self._cumulative_sizes = {}
+
+    @property
+    def org_names(self):
+        return list(self._orgs.keys())
+
+    def count(self, org):
+        entry = self._orgs.get(org)
+        return entry[1] if entry is not None else 0
+
+    def url(self, org, index):
+        first, count = self._orgs[org]
+        if not 0 <= index < count:
+            raise IndexError(index)
+        return self._urls[first + index]
+
+    def size(self, org, index):
+        first, count = self._orgs[org]
+        if not 0 <= index < count:
+            raise IndexError(index)
+        return self._sizes[first + index]
+
+    def sizes(self, org):
+        first, count = self._orgs.get(org, (0, 0))
+        return self._sizes[first:first + count]
+
+    def weighted_index(self, org, r):
+        """
+        Map `r` (uniform in [0, 1)) to the index of one of the org's urls, chosen with probability proportional
+        to its size. O(log n) once the org's cumulative sizes are built.
+        """
+        cumulative = self._cumulative_sizes.get(org)
+        if cumulative is None:
+            cumulative = []
+            total = 0
+            for size in self.sizes(org):
+                total += size
+                cumulative.append(total)
+            self._cumulative_sizes[org] = cumulative
+
+        if not cumulative:
+            raise IndexError(org)
+        if not cumulative[-1]:
+            return int(r * len(cumulative))
+        return bisect_right(cumulative, r * cumulative[-1])
+
+    def __len__(self):
+        return len(self._sizes)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open the catalog at `path`, using the compiled version next to it if it's up to date
+        """
+        compiled_path = compiled_path_for(path)
+        if os.path.isfile(compiled_path) and (not os.path.isfile(path) or
+                                              os.path.getmtime(compiled_path) >= os.path.getmtime(path)):
+            return cls.from_compiled(compiled_path)
+        return cls.from_json(path)
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        orgs = OrderedDict()
+        urls = []
+        sizes = array(_SIZE_TYPECODE)
+        for org in sorted(data):
+            org_urls = data[org]
+            orgs[_native_str(org)] = (len(urls), len(org_urls))
+            for url, size in org_urls.items():
+                urls.append(_native_str(url))
+                sizes.append(int(size))
+
+        return cls(orgs, urls, sizes, source=path)
+
+    @classmethod
+    def from_compiled(cls, path):
+        with open(path, 'rb') as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                raise DecoyCatalogError("decoy catalog '{}' is empty".format(path))
+
+        try:
+            return cls._from_buffer(buf, path)
+        except (struct.error, ValueError) as e:
+            buf.close()
+            raise DecoyCatalogError("decoy catalog '{}' is corrupt: {}".format(path, e))
+        except DecoyCatalogError:
+            buf.close()
+            raise
+
+    @classmethod
+    def _from_buffer(cls, buf, path):
+        if len(buf) < _HEADER.size:
+            raise DecoyCatalogError("decoy catalog '{}' is truncated".format(path))
+
+        magic, version, num_orgs, num_urls, blob_length = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise DecoyCatalogError("'{}' is not a version {} decoy catalog".format(path, VERSION))
+
+        orgs_offset = _HEADER.size
+        urls_offset = orgs_offset + num_orgs * _ORG.size
+        sizes_offset = urls_offset + num_urls * _URL.size
+        blob_offset = sizes_offset + num_urls * 4
+        if blob_offset + blob_length > len(buf):
+            raise DecoyCatalogError("decoy catalog '{}' is truncated".format(path))
+
+        orgs = OrderedDict()
+        for i in range(num_orgs):
+            name_offset, name_length, first, count = _ORG.unpack_from(buf, orgs_offset + i * _ORG.size)
+            if name_offset + name_length > blob_length or first + count > num_urls:
+                raise DecoyCatalogError("decoy catalog '{}' has an invalid org table".format(path))
+            start = blob_offset + name_offset
+            orgs[_native_str(buf[start:start + name_length])] = (first, count)
+
+        sizes = array(_SIZE_TYPECODE)
+        if six.PY2:
+            sizes.fromstring(buf[sizes_offset:blob_offset])
+        else:
+            sizes.frombytes(buf[sizes_offset:blob_offset])
+        if sys.byteorder != 'little':
+            sizes.byteswap()
+
+        return cls(orgs, _MappedStrings(buf, urls_offset, blob_offset, num_urls), sizes, source=path)
+
+    def compile(self, path):
+        blob = bytearray()
+        org_table = []
+        for org, (first, count) in self._orgs.items():
+            name = org.encode('utf-8') if isinstance(org, six.text_type) else org
+            org_table.append(_ORG.pack(len(blob), len(name), first, count))
+            blob.extend(name)
+
+        url_table = []
+        for i in range(len(self._sizes)):
+            url = self._urls[i]
+            url = url.encode('utf-8') if isinstance(url, six.text_type) else url
+            url_table.append(_URL.pack(len(blob), len(url)))
+            blob.extend(url)
+
+        sizes = array(_SIZE_TYPECODE, self._sizes)
+        if sys.byteorder != 'little':
+            sizes.byteswap()
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, len(self._orgs), len(self._sizes), len(blob)))
+            f.write(b''.join(org_table))
+            f.write(b''.join(url_table))
+            f.write(sizes.tostring() if six.PY2 else sizes.tobytes())
+            f.write(bytes(blob))
+        # Readers that already mapped the old file keep their mapping
+        os.rename(tmp_path, path)
+
+
+def compiled_path_for(path):
+    return os.path.splitext(path)[0] + COMPILED_EXTENSION
@@ -0,0 +1,230 @@
+"""
+A small in-process stub resolver for A records.
+
+This replaces shelling out to `dig`: queries are sent over UDP straight to a (configurable) recursive nameserver,
+answers are cached for as long as their TTL allows, names without an answer are cached negatively, and concurrent
+lookups for the same name share a single query.
+
+`DNSResolver.resolve` is called from the proxy's hooks and never blocks: names which aren't cached are looked up
+in a worker pool, and reported as not resolving until the answer is in the cache.
+"""
+import logging
+import random
+import socket
+import struct
+from threading import Lock
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cachebrowser.cache import TTLCache, SingleFlight, MISSING, NEGATIVE
+
+logger = logging.getLogger(__name__)
+
+TYPE_A = 1
+CLASS_IN = 1
+
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+DEFAULT_NAMESERVER = '8.8.8.8'
+
+
+class DNSError(Exception):
+    pass
+
+
+def system_nameserver(resolv_conf='/etc/resolv.conf'):
+    """
+    Return the first nameserver configured in resolv.conf, or None if there is none
+    """
+    try:
+        with open(resolv_conf) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver':
+                    return parts[1]
+    except IOError:
+        pass
+    return None
+
+
+def build_query(query_id, hostname, qtype=TYPE_A):
+    # Header: id, flags (recursion desired), 1 question, no answer/authority/additional records
+    header = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    qname = b''
+    for label in hostname.rstrip('.').split('.'):
+        try:
+            label = label.encode('idna')
+        except UnicodeError:
+            label = b''
+        if not 0 < len(label) < 64:
+            raise DNSError("invalid hostname {!r}".format(hostname))
+        qname += struct.pack('>B', len(label)) + label
+    return header + qname + b'\x00' + struct.pack('>HH', qtype, CLASS_IN)
+
+
+def _unpack(fmt, data, offset):
+    try:
+        return struct.unpack_from(fmt, data, offset)
+    except struct.error:
+        raise DNSError("truncated DNS response")
+
+
+def _skip_name(data, offset):
+    while True:
+        length = _unpack('>B', data, offset)[0]
+        if length & 0xC0 == 0xC0:
+            # Compression pointer, the name ends here
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def parse_response(data, query_id):
+    """
+    Parse a DNS response and return `(rcode, addresses, ttl)`, where `ttl` is the smallest TTL among the returned
+    A records (None if there are none)
+    """
+    if len(data) < 12:
+        raise DNSError("truncated DNS response")
+
+    response_id, flags, qdcount, ancount, _, _ = struct.unpack_from('>HHHHHH', data, 0)
+    if response_id != query_id:
+        raise DNSError("DNS response id mismatch")
+
+    rcode = flags & 0x000F
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+    if offset > len(data):
+        raise DNSError("truncated DNS response")
+
+    addresses = []
+    ttl = None
+    for _ in range(ancount):
+        offset = _skip_name(data, offset)
+        rtype, rclass, rttl, rdlength = _unpack('>HHIH', data, offset)
+        offset += 10
+        if offset + rdlength > len(data):
+            raise DNSError("truncated DNS response")
+        if rtype == TYPE_A and rclass == CLASS_IN and rdlength == 4:
+            addresses.append(socket.inet_ntoa(data[offset:offset + 4]))
+            ttl = rttl if ttl is None else min(ttl, rttl)
+        offset += rdlength
+
+    return rcode, addresses, ttl
+
+
+def is_ip_address(hostname):
+    try:
+        socket.inet_aton(hostname)
+    except (socket.error, ValueError):
+        return False
+    return hostname.count('.') == 3
+
+
+class DNSResolver(object):
+    def __init__(self, nameserver=None, port=53, timeout=2.0, retries=1, workers=2,
+                 cache_size=4096, min_ttl=5, max_ttl=3600, negative_ttl=60):
+        self.nameserver = nameserver or system_nameserver() or DEFAULT_NAMESERVER
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+
+        self.cache = TTLCache(max_size=cache_size, negative_ttl=negative_ttl)
+        self._inflight = SingleFlight()
+        self._pending = set()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.queries = 0
+        self.failures = 0
+
+    def resolve(self, hostname):
+        """
+        Return the list of IPv4 addresses `hostname` resolves to, empty if it doesn't resolve or isn't cached yet.
+        Never blocks, a name which isn't cached is looked up in the background.
+        """
+        if is_ip_address(hostname):
+            return [hostname]
+
+        hostname = hostname.lower().rstrip('.')
+
+        addresses = self.cache.get(hostname)
+        if addresses is NEGATIVE:
+            return []
+        if addresses is not MISSING:
+            return addresses
+
+        with self._lock:
+            if hostname in self._pending:
+                return []
+            self._pending.add(hostname)
+
+        self._executor.submit(self._resolve_pending, hostname)
+        return []
+
+    def _resolve_pending(self, hostname):
+        try:
+            self._inflight.do(hostname, self._resolve, hostname)
+        except Exception:
+            logger.exception("DNS lookup for {!r} failed".format(hostname))
+        finally:
+            with self._lock:
+                self._pending.discard(hostname)
+
+    def _resolve(self, hostname):
+        try:
+            rcode, addresses, ttl = self._query(hostname)
+        except (DNSError, socket.error) as e:
+            logger.debug("DNS lookup for {!r} failed: {}".format(hostname, e))
+            self.failures += 1
+            self.cache.set_negative(hostname)
+            return []
+
+        if rcode != RCODE_NOERROR or not addresses:
+            self.cache.set_negative(hostname)
+            return []
+
+        ttl = max(self.min_ttl, min(self.max_ttl, ttl))
+        self.cache.set(hostname, addresses, ttl)
+        return addresses
+
+    def _query(self, hostname):
+        query_id = random.randint(0, 0xFFFF)
+        query = build_query(query_id, hostname)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        try:
+            for attempt in range(self.retries + 1):
+                self.queries += 1
+                sock.sendto(query, (self.nameserver, self.port))
+                try:
+                    while True:
+                        data, _ = sock.recvfrom(4096)
+                        if len(data) < 2 or struct.unpack_from('>H', data)[0] != query_id:
+                            # Stray datagram, keep waiting for ours
+                            continue
+                        # A malformed answer to our query fails the lookup
+                        return parse_response(data, query_id)
+                except socket.timeout:
+                    if attempt == self.retries:
+                        raise DNSError("DNS query for '{}' timed out".format(hostname))
+        finally:
+            sock.close()
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update({
+            'nameserver': self.nameserver,
+            'queries': self.queries,
+            'failures': self.failures,
+            'pending': len(self._pending),
+        })
+        return stats
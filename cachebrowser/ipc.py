@@ -1,25 +1,134 @@
-import json
-from threading import Thread
+from collections import deque
+from threading import Lock, Thread
+from time import time
 import traceback
 import uuid
 import logging
 
+import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
 import tornado.websocket
+from concurrent.futures import ThreadPoolExecutor
 
 from cachebrowser.api.core import APIRequest
+from cachebrowser.ipccodec import JSONCodec, CodecError, get_codec
+from cachebrowser.matching import GlobMatcher, compile_globs, has_wildcard
 
 logger = logging.getLogger(__name__)
 
+# Channels starting with this prefix are used between CacheBrowser processes and are not meant for UI clients
+INTERNAL_CHANNEL_PREFIX = '_'
+# Carries the list of channels and patterns which UI clients are subscribed to, so worker processes can skip
+# building messages nobody would receive
+SUBSCRIPTIONS_CHANNEL = '_ipc/subscriptions'
+
+
+class SubscriptionFilter(object):
+    """
+    Server-side predicate attached to a subscription, so clients only receive the flow records they care about.
+
+    The filter spec is a dict which may contain:
+      - 'host': a hostname or glob pattern ('*.google.com'), or a list of them
+      - 'cdn': a CDN name, or a list of them
+      - 'status_code': a status code, a class like '5xx', or a list of them
+      - 'cachebrowsed': true or false
+    A record matches if it matches every given field. Messages which are lists of records (batched request logs)
+    are reduced to the records which match.
+    """
+
+    FIELDS = ('host', 'cdn', 'status_code', 'cachebrowsed')
+
+    def __init__(self, spec):
+        unknown = set(spec) - set(self.FIELDS)
+        if unknown:
+            raise ValueError("unknown filter field '{}'".format(unknown.pop()))
+
+        self.host = GlobMatcher(self._as_list(spec['host'])) if 'host' in spec else None
+        self.cdns = set(self._as_list(spec['cdn'])) if 'cdn' in spec else None
+        self.cachebrowsed = spec.get('cachebrowsed')
+
+        self.status_codes = None
+        self.status_classes = None
+        if 'status_code' in spec:
+            codes = self._as_list(spec['status_code'])
+            self.status_codes = set(int(code) for code in codes if not str(code).lower().endswith('xx'))
+            self.status_classes = set(int(str(code)[0]) for code in codes if str(code).lower().endswith('xx'))
+
+    @staticmethod
+    def _as_list(value):
+        return value if isinstance(value, list) else [value]
+
+    def apply(self, message):
+        """
+        Return the part of `message` which passes the filter, or None if nothing does
+        """
+        if isinstance(message, list):
+            matching = [record for record in message if self.matches(record)]
+            return matching or None
+        return message if self.matches(message) else None
+
+    def matches(self, record):
+        if not isinstance(record, dict):
+            return False
+
+        if self.host is not None:
+            host = record.get('host')
+            if host is None or not self.host.match(host.lower()):
+                return False
+
+        if self.cdns is not None and record.get('cdn') not in self.cdns:
+            return False
+
+        if self.cachebrowsed is not None and bool(record.get('cachebrowsed')) != self.cachebrowsed:
+            return False
+
+        if self.status_codes is not None:
+            status_code = record.get('status_code')
+            if status_code is None:
+                return False
+            if status_code not in self.status_codes and status_code // 100 not in self.status_classes:
+                return False
+
+        return True
+
 
 class IPCRouter(object):
-    def __init__(self):
+    """
+    Clients subscribe to channel names or to glob patterns of channel names ('stats/*'), optionally with a
+    `SubscriptionFilter`. A client receives a published message at most once, even if several of its
+    subscriptions match the channel.
+
+    Pending RPC requests expire after their timeout (`rpc_timeout` unless the request asks for another one),
+    `expire_rpc_requests` is called periodically to send timeout errors for them.
+
+    Several clients may register the same RPC method (e.g. every proxy worker process registers the scrambler's
+    methods). Requests are then sent to all of them and the first response is the one passed on.
+    """
+
+    def __init__(self, rpc_timeout=30, clock=time):
+        self.rpc_timeout = rpc_timeout
+        self.clock = clock
         self.clients = {}
+        # {channel name or pattern: {client id: filter or None}}
         self.channels = {}
+        # {pattern: compiled regex}
+        self._patterns = {}
+        # {channel: [subscribed channel names and patterns matching it]}, rebuilt when patterns change. It's also
+        # filled from other threads (see `has_subscribers`), so it's only written with `_keys_lock` held and only
+        # if no pattern changed since the keys were computed, as told by `_keys_generation`.
+        self._channel_keys = {}
+        self._keys_generation = 0
+        self._keys_lock = Lock()
         self.rpc_clients = {}
         self.rpc_pending_requests = {}
 
+        # Called whenever a channel or pattern, other than an internal one, gains its first or loses its last
+        # subscriber
+        self.on_subscriptions_changed = None
+
     def add_client(self, client_id, client):
         self.clients[client_id] = client
 
@@ -27,54 +136,136 @@ class IPCRouter(object):
         if client_id in self.clients:
             del self.clients[client_id]
 
-    def publish(self, channel, message):
-        if channel not in self.channels:
-            return
-
-        dangling_clients = []
+        for key in list(self.channels):
+            self.unsubscribe(client_id, key)
 
-        for client_id in self.channels[channel]:
-            if client_id not in self.clients:
-                dangling_clients.append(client_id)
-            else:
-                self.clients[client_id].send_publish(channel, message)
+        for clients in self.rpc_clients.values():
+            if client_id in clients:
+                clients.remove(client_id)
 
-        for client_id in dangling_clients:
-            self.channels[channel].remove(client_id)
+    def publish(self, channel, message):
+        subscriptions = []
+        for key in self._keys_for(channel):
+            subscriptions.extend(self.channels.get(key, {}).items())
+        if not subscriptions:
+            return
 
-    def subscribe(self, client_id, channel):
-        if channel not in self.channels:
-            self.channels[channel] = set()
-        self.channels[channel].add(client_id)
+        # Unfiltered subscriptions first, so a client with one gets the whole message
+        subscriptions.sort(key=lambda subscription: subscription[1] is not None)
+
+        delivered = set()
+        for client_id, message_filter in subscriptions:
+            if client_id in delivered:
+                continue
+
+            client = self.clients.get(client_id)
+            if client is None:
+                continue
+
+            filtered = message if message_filter is None else message_filter.apply(message)
+            if filtered is None:
+                continue
+
+            delivered.add(client_id)
+            client.send_publish(channel, filtered)
+
+    def has_subscribers(self, channel):
+        # May be called from other threads, so only work on copies
+        return any(client_id in self.clients
+                   for key in self._keys_for(channel)
+                   for client_id in list(self.channels.get(key, ())))
+
+    def subscribe(self, client_id, channel, message_filter=None):
+        changed = channel not in self.channels
+        if changed:
+            self.channels[channel] = {}
+            if has_wildcard(channel):
+                with self._keys_lock:
+                    self._patterns[channel] = compile_globs([channel])
+                    self._invalidate_keys()
+        self.channels[channel][client_id] = message_filter
+
+        if channel == SUBSCRIPTIONS_CHANNEL:
+            # The list is only published when it changes, a (re)connecting worker needs the current one
+            client = self.clients.get(client_id)
+            if client is not None:
+                client.send_publish(SUBSCRIPTIONS_CHANNEL, self.subscribed_channels())
+        elif changed and not channel.startswith(INTERNAL_CHANNEL_PREFIX) and self.on_subscriptions_changed is not None:
+            self.on_subscriptions_changed()
 
     def unsubscribe(self, client_id, channel):
-        if channel in self.channels and client_id in self.channels[channel]:
-            self.channels[channel].remove(client_id)
+        subscribers = self.channels.get(channel)
+        if subscribers is None or client_id not in subscribers:
+            return
 
-    def rpc_request(self, client_id, request_id, method, params):
-        if method not in self.rpc_clients:
+        del subscribers[client_id]
+        if not subscribers:
+            del self.channels[channel]
+            if channel in self._patterns:
+                with self._keys_lock:
+                    del self._patterns[channel]
+                    self._invalidate_keys()
+
+            if not channel.startswith(INTERNAL_CHANNEL_PREFIX) and self.on_subscriptions_changed is not None:
+                self.on_subscriptions_changed()
+
+    def subscribed_channels(self):
+        """
+        The channels and patterns UI clients are subscribed to
+        """
+        return sorted(channel for channel in self.channels if not channel.startswith(INTERNAL_CHANNEL_PREFIX))
+
+    def _keys_for(self, channel):
+        keys = self._channel_keys.get(channel)
+        if keys is None:
+            generation = self._keys_generation
+            keys = [channel] + [pattern for pattern, regex in list(self._patterns.items()) if regex.match(channel)]
+            with self._keys_lock:
+                if generation == self._keys_generation:
+                    self._channel_keys[channel] = keys
+        return keys
+
+    def _invalidate_keys(self):
+        # Must be called with `_keys_lock` held
+        self._channel_keys = {}
+        self._keys_generation += 1
+
+    def rpc_request(self, client_id, request_id, method, params, timeout=None):
+        targets = [self.clients[target_id] for target_id in self.rpc_clients.get(method, ()) if target_id in self.clients]
+        if not targets:
             logger.error("RPC request received for '{}', but route does not exist".format(method))
-            # TODO Give error
-            pass
-
-        self.rpc_pending_requests[request_id] = client_id
-        target_client_id = self.rpc_clients.get(method, None)
-        if target_client_id is not None:
-            client = self.clients.get(target_client_id, None)
+            client = self.clients.get(client_id, None)
             if client is not None:
-                client.send_rpc_request(request_id, method, params)
+                client.send_rpc_response(request_id, None, "route '{}' does not exist".format(method))
+            return
 
-        # TODO give error if route doesn't exist
+        self.rpc_pending_requests[request_id] = (client_id, self.clock() + (timeout or self.rpc_timeout))
+        for target in targets:
+            target.send_rpc_request(request_id, method, params)
 
-    def rpc_response(self, request_id, response):
-        client_id = self.rpc_pending_requests.pop(request_id)
-        client = self.clients.get(client_id, None)
+    def rpc_response(self, request_id, response, error=None):
+        pending = self.rpc_pending_requests.pop(request_id, None)
+        if pending is None:
+            # Already timed out, or answered twice
+            logger.debug("Dropping RPC response for unknown request {}".format(request_id))
+            return
+
+        client = self.clients.get(pending[0], None)
         if client is not None:
-            client.send_rpc_response(request_id, response)
+            client.send_rpc_response(request_id, response, error)
+
+    def expire_rpc_requests(self, now=None):
+        if now is None:
+            now = self.clock()
+
+        expired = [request_id for request_id, (_, deadline) in self.rpc_pending_requests.items() if deadline <= now]
+        for request_id in expired:
+            self.rpc_response(request_id, None, 'timeout')
 
     def register_rpc(self, client_id, method):
-        # TODO give error if already registered
-        self.rpc_clients[method] = client_id
+        clients = self.rpc_clients.setdefault(method, [])
+        if client_id not in clients:
+            clients.append(client_id)
 
 
 class IPCClient(object):
@@ -87,33 +278,58 @@ class IPCClient(object):
     def send_rpc_request(self, request_id, method, params):
         pass
 
-    def send_rpc_response(self, request_id, response):
+    def send_rpc_response(self, request_id, response, error=None):
         pass
 
 
 class IPCManager(IPCClient):
+    """
+    The router and the websocket clients are only ever touched from the IPC IOLoop thread. Publishes and RPC
+    replies coming from other threads (e.g. the proxy thread) are handed over to it with `IOLoop.add_callback`.
+
+    RPC handlers run on the IOLoop thread, except for those marked with `@blocking` which are run in a worker pool.
+    """
+
+    # Seconds between checks for timed out RPC requests
+    RPC_SWEEP_INTERVAL = 1
+
     def __init__(self, context):
         self.context = context
 
-        self.router = IPCRouter()
+        self.router = IPCRouter(rpc_timeout=context.settings.ipc_rpc_timeout)
         self.handlers = {}
+        # Runs handlers marked as blocking
+        self.executor = ThreadPoolExecutor(max_workers=context.settings.ipc_rpc_workers)
 
         self.id = 'local_client'
         self.router.add_client(self.id, self)
+        self.router.on_subscriptions_changed = self._publish_subscriptions
+        self._local_subscriptions = {}
 
+        self.ioloop = tornado.ioloop.IOLoop(make_current=False)
         self.websocket = self.initialize_websocket_server(context.settings.ipc_port)
 
     def initialize_websocket_server(self, port):
+        settings = self.context.settings
         app = tornado.web.Application([
-            (r'/', WebSocketIPCClient, {'router': self.router}),
+            (r'/', WebSocketIPCClient, {
+                'router': self.router,
+                'high_water_mark': settings.ipc_high_water_mark,
+                'slow_client_policy': settings.ipc_slow_client_policy,
+                'compress_threshold': settings.ipc_compress_threshold,
+            }),
         ])
 
+        # Bound here rather than on the IOLoop thread, so forked processes can close them (`close_inherited_sockets`)
+        self._sockets = tornado.netutil.bind_sockets(port)
+
         def run_loop():
             logger.debug("Starting IPC websocket server on port {}".format(port))
-            ioloop = tornado.ioloop.IOLoop()
-            ioloop.make_current()
-            app.listen(port)
-            ioloop.start()
+            self.ioloop.make_current()
+            server = tornado.httpserver.HTTPServer(app)
+            server.add_sockets(self._sockets)
+            tornado.ioloop.PeriodicCallback(self.router.expire_rpc_requests, self.RPC_SWEEP_INTERVAL * 1000).start()
+            self.ioloop.start()
 
         t = Thread(target=run_loop)
         t.daemon = True
@@ -121,11 +337,27 @@ class IPCManager(IPCClient):
 
         return app
 
+    def close_inherited_sockets(self):
+        """
+        Called in a process forked from the one running this manager, closes the copies of the listening sockets.
+        The IOLoop isn't touched, its epoll instance is shared with the parent process.
+        """
+        for sock in self._sockets:
+            sock.close()
+        self._sockets = []
+
     def publish(self, channel, message):
-        self.router.publish(channel, message)
+        self.ioloop.add_callback(self.router.publish, channel, message)
+
+    def has_subscribers(self, channel):
+        return self.router.has_subscribers(channel)
 
     def subscribe(self, channel, callback):
-        raise NotImplementedError("Local subscriptions not implemented")
+        """
+        Call `callback(channel, message)` on the IOLoop thread for messages published on `channel`
+        """
+        self._local_subscriptions.setdefault(channel, []).append(callback)
+        self.ioloop.add_callback(self.router.subscribe, self.id, channel)
 
     def register_rpc(self, method, handler):
         logger.debug("Registering RPC method {}".format(method))
@@ -137,46 +369,117 @@ class IPCManager(IPCClient):
             self.register_rpc(route[0], route[1])
 
     def send_publish(self, channel, message):
-        raise NotImplementedError("Local subscriptions not implemented")
+        for key in self.router._keys_for(channel):
+            for callback in self._local_subscriptions.get(key, ()):
+                try:
+                    callback(channel, message)
+                except Exception:
+                    logger.exception("IPC: subscription callback for '{}' failed".format(channel))
+
+    def _publish_subscriptions(self):
+        self.router.publish(SUBSCRIPTIONS_CHANNEL, self.router.subscribed_channels())
 
     def send_rpc_request(self, request_id, method, params):
-        request = RPCRequest(self.router, request_id, method, params)
-        self.handlers[method](self.context, request)
-        # api_manager.handle_api_request(self.context, request)
+        request = RPCRequest(self.router, self.ioloop, request_id, method, params)
+        handler = self.handlers.get(method)
+        if handler is None:
+            request.error("no handler for '{}'".format(method))
+        elif getattr(handler, 'blocking', False):
+            self.executor.submit(self._run_handler, handler, request)
+        else:
+            self._run_handler(handler, request)
 
-    def send_rpc_response(self, request_id, response):
+    def _run_handler(self, handler, request):
+        try:
+            handler(self.context, request)
+        except Exception as e:
+            logger.exception("RPC handler for '{}' failed".format(request.route))
+            request.error(str(e) or e.__class__.__name__)
+
+    def send_rpc_response(self, request_id, response, error=None):
         raise NotImplementedError()
 
 
 class RPCRequest(APIRequest):
-    def __init__(self, router, request_id, route, params):
+    def __init__(self, router, ioloop, request_id, route, params):
         self.id = request_id
         self.router = router
+        self.ioloop = ioloop
 
         super(RPCRequest, self).__init__(route, params)
 
     def reply(self, response=None):
-        self.router.rpc_response(self.id, response)
+        # Handlers may reply from any thread
+        self.ioloop.add_callback(self.router.rpc_response, self.id, response)
+
+    def error(self, message):
+        self.ioloop.add_callback(self.router.rpc_response, self.id, None, message)
 
 
 class WebSocketIPCClient(tornado.websocket.WebSocketHandler, IPCClient):
-    def initialize(self, router=None):
+    """
+    Outgoing messages are queued per client and written one at a time, the next one once the previous write has
+    been flushed to the socket. When more than `high_water_mark` messages are waiting, the client is considered
+    slow and published messages are handled according to `slow_client_policy`:
+      - 'drop': new published messages are dropped,
+      - 'coalesce': a new published message replaces the newest waiting message on the same channel (or is
+        dropped if there is none), so the client only gets the latest state of each channel,
+      - 'disconnect': the connection is closed.
+    RPC requests and responses are never dropped.
+
+    Messages are encoded with the codec the client asked for when connecting (see `cachebrowser.ipccodec`).
+    Text frames from the client are always read as JSON, binary frames with the negotiated codec.
+    """
+
+    DROP = 'drop'
+    COALESCE = 'coalesce'
+    DISCONNECT = 'disconnect'
+
+    def initialize(self, router=None, high_water_mark=1000, slow_client_policy=DROP, compress_threshold=1024):
         self.id = str(uuid.uuid4())[:8]
         self.router = router
+        self.high_water_mark = high_water_mark
+        self.slow_client_policy = slow_client_policy
+        self.compress_threshold = compress_threshold
+
+        self.codec = None
+        self._json_codec = JSONCodec()
+
+        # Entries are [channel, message], channel is None for RPC messages
+        self._outbound = deque()
+        self._writing = False
+        self._closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
 
     def open(self, *args, **kwargs):
+        encoding = self.get_argument('encoding', JSONCodec.name)
+        compress = self.get_argument('compress', '0') not in ('0', 'false', '')
+        try:
+            self.codec = get_codec(encoding, compress=compress, compress_threshold=self.compress_threshold)
+        except CodecError as e:
+            logger.error("IPC: rejecting client {}: {}".format(self.id, e))
+            self._closed = True
+            self.close(1003, str(e))
+            return
+
         self.router.add_client(self.id, self)
 
     def on_close(self):
+        self._closed = True
+        self._outbound.clear()
         self.router.remove_client(self.id)
 
     def on_message(self, message):
+        codec = self.codec if isinstance(message, bytes) and self.codec.binary else self._json_codec
         try:
-            json_message = json.loads(message)
-        except ValueError:
-            logger.error("IPC: received invalid json message:\n{}".format(message))
+            decoded = codec.decode(message)
+        except CodecError as e:
+            logger.error("IPC: received invalid message: {}\n{!r}".format(e, message[:200]))
         else:
-            self.handle_message(json_message)
+            self.handle_message(decoded)
 
     def handle_message(self, message):
         message_type = message.get('type', None)
@@ -188,13 +491,14 @@ class WebSocketIPCClient(tornado.websocket.WebSocketHandler, IPCClient):
             if message_type == 'pub':
                 self.router.publish(message['channel'], message['message'])
             elif message_type == 'sub':
-                self.router.subscribe(self.id, message['channel'])
+                self.subscribe(message['channel'], message.get('filter'))
             elif message_type == 'unsub':
                 self.router.unsubscribe(self.id, message['channel'])
             elif message_type == 'rpc_req':
-                self.router.rpc_request(self.id, message['request_id'], message['method'], message.get('params', {}))
+                self.router.rpc_request(self.id, message['request_id'], message['method'], message.get('params', {}),
+                                        message.get('timeout'))
             elif message_type == 'rpc_resp':
-                self.router.rpc_response(message['request_id'], message['message'])
+                self.router.rpc_response(message['request_id'], message.get('message'), message.get('error'))
             elif message_type == 'rpc_reg':
                 self.router.register_rpc(self.id, message['method'])
                 
@@ -202,12 +506,22 @@ class WebSocketIPCClient(tornado.websocket.WebSocketHandler, IPCClient):
             logger.error("Uncaught exception occurred while handling IPC message: {}".format(message))
             traceback.print_exc()
 
+    def subscribe(self, channel, filter_spec=None):
+        message_filter = None
+        if filter_spec:
+            try:
+                message_filter = SubscriptionFilter(filter_spec)
+            except (ValueError, TypeError) as e:
+                logger.error("IPC: invalid subscription filter for '{}': {}".format(channel, e))
+                return
+        self.router.subscribe(self.id, channel, message_filter)
+
     def send_publish(self, channel, message):
         self.send({
             'type': 'pub',
             'channel': channel,
             'message': message
-        })
+        }, channel=channel)
 
     def send_rpc_request(self, request_id, method, params):
         self.send({
@@ -217,15 +531,274 @@ class WebSocketIPCClient(tornado.websocket.WebSocketHandler, IPCClient):
             'params': params
         })
 
-    def send_rpc_response(self, request_id, response):
-        self.send({
+    def send_rpc_response(self, request_id, response, error=None):
+        message = {
             'type': 'rpc_resp',
             'request_id': request_id,
             'message': response
-        })
+        }
+        if error is not None:
+            message['error'] = error
+        self.send(message)
+
+    def send(self, message, channel=None):
+        """
+        Queue a message for this client. Must be called from the IOLoop thread.
+
+        :param channel: the channel of a published message, None for messages which must not be dropped
+        """
+        if self._closed:
+            return
+
+        if channel is not None and len(self._outbound) >= self.high_water_mark:
+            if not self._handle_slow_client(channel, message):
+                return
+
+        self._outbound.append([channel, message])
+        self._write_next()
+
+    def _handle_slow_client(self, channel, message):
+        """
+        Returns True if the message should still be queued
+        """
+        if self.slow_client_policy == self.DISCONNECT:
+            logger.warning("IPC: disconnecting slow client {} ({} messages waiting)".format(
+                self.id, len(self._outbound)))
+            self._closed = True
+            self._outbound.clear()
+            self.close()
+            return False
+
+        if self.slow_client_policy == self.COALESCE:
+            for entry in reversed(self._outbound):
+                if entry[0] == channel:
+                    entry[1] = message
+                    self.coalesced += 1
+                    return False
+
+        self.dropped += 1
+        return False
+
+    def _write_next(self):
+        if self._writing or self._closed or not self._outbound:
+            return
+
+        _, message = self._outbound.popleft()
+        try:
+            future = self.write_message(self.codec.encode(message), binary=self.codec.binary)
+        except tornado.websocket.WebSocketClosedError:
+            self._closed = True
+            self._outbound.clear()
+            return
+
+        self.sent += 1
+        self._writing = True
+        tornado.ioloop.IOLoop.current().add_future(future, self._on_written)
+
+    def _on_written(self, future):
+        self._writing = False
+        if future.exception() is not None:
+            self._closed = True
+            self._outbound.clear()
+            return
+        self._write_next()
 
-    def send(self, message):
-        self.write_message(message)
+    def stats(self):
+        return {
+            'queued': len(self._outbound),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
 
     def check_origin(self, origin):
         return True
+
+
+class IPCWorkerClient(object):
+    """
+    IPC endpoint of a proxy worker process. It offers the same interface as `IPCManager` to the pipes, but
+    instead of serving clients itself it connects to the supervisor's IPC server as a websocket client: publishes
+    are forwarded to the supervisor, which routes them to the UI clients, and RPC methods registered here are
+    served for requests routed from the supervisor.
+
+    The connection is kept alive (and re-established) from a separate IOLoop thread, messages sent while
+    disconnected are buffered up to `MAX_BUFFERED` messages.
+    """
+
+    RECONNECT_DELAY = 0.5
+    MAX_BUFFERED = 1000
+
+    def __init__(self, context, url, on_disconnect=None):
+        self.context = context
+        self.url = url
+        self.on_disconnect = on_disconnect
+
+        self.handlers = {}
+        self.executor = ThreadPoolExecutor(max_workers=context.settings.ipc_rpc_workers)
+        self.codec = JSONCodec()
+
+        self._connection = None
+        self._buffer = deque(maxlen=self.MAX_BUFFERED)
+        self._local_subscriptions = {}
+        # Channels and patterns UI clients are subscribed to, as announced by the supervisor
+        self._subscribed = set()
+        self._subscribed_patterns = []
+
+        self.ioloop = tornado.ioloop.IOLoop(make_current=False)
+        self.subscribe(SUBSCRIPTIONS_CHANNEL, self._update_subscriptions)
+
+        t = Thread(target=self._run_loop)
+        t.daemon = True
+        t.start()
+
+    def _run_loop(self):
+        self.ioloop.make_current()
+        self.ioloop.add_callback(self._connect)
+        self.ioloop.start()
+
+    @tornado.gen.coroutine
+    def _connect(self):
+        while True:
+            try:
+                self._connection = yield tornado.websocket.websocket_connect(self.url)
+            except Exception as e:
+                logger.debug("IPC: connecting to {} failed: {}".format(self.url, e))
+                yield tornado.gen.sleep(self.RECONNECT_DELAY)
+                continue
+
+            logger.debug("IPC: connected to {}".format(self.url))
+            self._announce()
+            while True:
+                message = yield self._connection.read_message()
+                if message is None:
+                    break
+                self._handle_message(message)
+
+            self._connection = None
+            logger.warning("IPC: lost connection to {}".format(self.url))
+            if self.on_disconnect is not None and self.on_disconnect() is False:
+                return
+            yield tornado.gen.sleep(self.RECONNECT_DELAY)
+
+    def _announce(self):
+        # (Re-)register everything on the new connection, then send what was buffered meanwhile
+        for method in self.handlers:
+            self._write({'type': 'rpc_reg', 'method': method})
+        for channel in self._local_subscriptions:
+            self._write({'type': 'sub', 'channel': channel})
+
+        buffered = list(self._buffer)
+        self._buffer.clear()
+        for message in buffered:
+            self._write(message)
+
+    def _register(self, message):
+        # Registrations made while disconnected are sent by `_announce` once connected
+        if self._connection is not None:
+            self._write(message)
+
+    def _send(self, message):
+        """
+        Must be called from the IOLoop thread
+        """
+        if self._connection is None:
+            self._buffer.append(message)
+        else:
+            self._write(message)
+
+    def _write(self, message):
+        try:
+            self._connection.write_message(self.codec.encode(message))
+        except tornado.websocket.WebSocketClosedError:
+            self._buffer.append(message)
+
+    def _handle_message(self, data):
+        try:
+            message = self.codec.decode(data)
+        except CodecError as e:
+            logger.error("IPC: received invalid message: {}".format(e))
+            return
+
+        message_type = message.get('type')
+        if message_type == 'pub':
+            for callback in self._local_subscriptions.get(message['channel'], ()):
+                try:
+                    callback(message['channel'], message['message'])
+                except Exception:
+                    logger.exception("IPC: subscription callback for '{}' failed".format(message['channel']))
+        elif message_type == 'rpc_req':
+            self._handle_rpc_request(message['request_id'], message['method'], message.get('params', {}))
+
+    def _handle_rpc_request(self, request_id, method, params):
+        request = WorkerRPCRequest(self, request_id, method, params)
+        handler = self.handlers.get(method)
+        if handler is None:
+            request.error("no handler for '{}'".format(method))
+        elif getattr(handler, 'blocking', False):
+            self.executor.submit(self._run_handler, handler, request)
+        else:
+            self._run_handler(handler, request)
+
+    def _run_handler(self, handler, request):
+        try:
+            handler(self.context, request)
+        except Exception as e:
+            logger.exception("RPC handler for '{}' failed".format(request.route))
+            request.error(str(e) or e.__class__.__name__)
+
+    def _update_subscriptions(self, channel, channels):
+        self._subscribed = set(channel for channel in channels if not has_wildcard(channel))
+        self._subscribed_patterns = [compile_globs([channel]) for channel in channels if has_wildcard(channel)]
+
+    def publish(self, channel, message):
+        self.ioloop.add_callback(self._send, {
+            'type': 'pub',
+            'channel': channel,
+            'message': message
+        })
+
+    def has_subscribers(self, channel):
+        if channel in self._subscribed:
+            return True
+        return any(pattern.match(channel) for pattern in self._subscribed_patterns)
+
+    def subscribe(self, channel, callback):
+        """
+        Call `callback(channel, message)` on the IOLoop thread for messages published on `channel`
+        """
+        callbacks = self._local_subscriptions.setdefault(channel, [])
+        callbacks.append(callback)
+        if len(callbacks) == 1:
+            self.ioloop.add_callback(self._register, {'type': 'sub', 'channel': channel})
+
+    def register_rpc(self, method, handler):
+        self.handlers[method] = handler
+        self.ioloop.add_callback(self._register, {'type': 'rpc_reg', 'method': method})
+
+    def register_rpc_handlers(self, routes):
+        for route in routes:
+            self.register_rpc(route[0], route[1])
+
+
+class WorkerRPCRequest(APIRequest):
+    def __init__(self, client, request_id, route, params):
+        self.id = request_id
+        self.client = client
+
+        super(WorkerRPCRequest, self).__init__(route, params)
+
+    def reply(self, response=None):
+        self.client.ioloop.add_callback(self.client._send, {
+            'type': 'rpc_resp',
+            'request_id': self.id,
+            'message': response
+        })
+
+    def error(self, message):
+        self.client.ioloop.add_callback(self.client._send, {
+            'type': 'rpc_resp',
+            'request_id': self.id,
+            'message': None,
+            'error': message
+        })
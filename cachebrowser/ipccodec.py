@@ -0,0 +1,120 @@
+"""
+Wire encodings for IPC messages.
+
+Clients pick an encoding when they connect, with the 'encoding' query parameter of the websocket URL
+(e.g. ws://localhost:9000/?encoding=msgpack&compress=1). JSON text frames are the default.
+
+Binary encodings are sent as binary frames which start with a one byte header holding flags, followed by the
+payload. If the FLAG_ZLIB bit is set the payload is zlib compressed. With compression enabled, only payloads of at
+least `compress_threshold` bytes are compressed, small frames aren't worth the CPU time. Clients may send either
+compressed or uncompressed frames.
+"""
+import json
+import zlib
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FLAG_ZLIB = 0x01
+
+_HEADER = struct.Struct('!B')
+
+
+class CodecError(Exception):
+    pass
+
+
+class JSONCodec(object):
+    name = 'json'
+    binary = False
+
+    def __init__(self, compress=False, compress_threshold=1024):
+        # Text frames have no room for a header, compression is left to the websocket layer
+        self.compress = False
+
+    def encode(self, message):
+        return json.dumps(message, separators=(',', ':'))
+
+    def decode(self, data):
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise CodecError("invalid json message: {}".format(e))
+
+
+class BinaryCodec(object):
+    """
+    Base class for binary encodings, takes care of the frame header and compression
+    """
+    name = None
+    binary = True
+
+    def __init__(self, compress=False, compress_threshold=1024):
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+
+    def encode(self, message):
+        payload = self.pack(message)
+        flags = 0
+        if self.compress and len(payload) >= self.compress_threshold:
+            payload = zlib.compress(payload, 1)
+            flags |= FLAG_ZLIB
+        return _HEADER.pack(flags) + payload
+
+    def decode(self, data):
+        if not data:
+            raise CodecError("empty frame")
+
+        flags = _HEADER.unpack_from(data)[0]
+        payload = data[_HEADER.size:]
+        try:
+            if flags & FLAG_ZLIB:
+                payload = zlib.decompress(payload)
+            return self.unpack(payload)
+        except Exception as e:
+            raise CodecError("invalid {} frame: {}".format(self.name, e))
+
+    def pack(self, message):
+        raise NotImplementedError()
+
+    def unpack(self, payload):
+        raise NotImplementedError()
+
+
+class MsgPackCodec(BinaryCodec):
+    name = 'msgpack'
+
+    def __init__(self, *args, **kwargs):
+        if msgpack is None:
+            raise CodecError("the 'msgpack' encoding requires the msgpack-python package")
+        super(MsgPackCodec, self).__init__(*args, **kwargs)
+
+    def pack(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def unpack(self, payload):
+        try:
+            return msgpack.unpackb(payload, raw=False)
+        except TypeError:
+            # msgpack < 0.5.2
+            return msgpack.unpackb(payload, encoding='utf-8')
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    MsgPackCodec.name: MsgPackCodec,
+}
+
+
+def available_codecs():
+    return sorted(name for name in CODECS if name != MsgPackCodec.name or msgpack is not None)
+
+
+def get_codec(name, compress=False, compress_threshold=1024):
+    codec_class = CODECS.get(name)
+    if codec_class is None:
+        raise CodecError("unknown encoding '{}'".format(name))
+    return codec_class(compress=compress, compress_threshold=compress_threshold)
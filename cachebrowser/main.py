@@ -5,16 +5,19 @@ import logging.config
 import sys
 import inspect
 import os
+from functools import partial
 
 import click
 import mitmproxy
 import mitmproxy.controller
 from mitmproxy.proxy.server import ProxyServer
 
-from cachebrowser.bootstrap import Bootstrapper
-from cachebrowser.models import initialize_database
+from cachebrowser.bootstrap import Bootstrapper, LocalBootstrapSource
+from cachebrowser.cache import TTLCache
+from cachebrowser.models import initialize_database, WriteBehindQueue
 from cachebrowser.proxy import ProxyController, ProxyConfig
 from cachebrowser.pipes.resolver import ResolverPipe
+from cachebrowser.pipes.prefetch import PrefetchPipe
 from cachebrowser.pipes.publisher import PublisherPipe
 from cachebrowser.pipes.sni import SNIPipe
 from cachebrowser.pipes.website_filter import WebsiteFilterPipe
@@ -22,6 +25,8 @@ from cachebrowser.pipes.scrambler import ScramblerPipe
 from cachebrowser.settings import DevelopmentSettings, ProductionSettings, SettingsValidationError
 from cachebrowser.ipc import IPCManager
 from cachebrowser.api.routes import routes as api_routes
+from cachebrowser.watcher import FileWatcher
+from cachebrowser.workers import Supervisor, share_pipe_stats
 from cachebrowser import cli
 
 logger = logging.getLogger(__name__)
@@ -32,7 +37,13 @@ class Context(object):
         self.click = None
         self.settings = None
         self.bootstrapper = None
+        self.host_cache = None
+        self.db_writer = None
         self.ipc = None
+        # Reloads data files when they change, while the proxy runs (None if disabled)
+        self.file_watcher = None
+        # Index of this proxy worker process when running with --workers
+        self.worker_index = 0
 
 
 @click.group(invoke_without_command=True)
@@ -41,6 +52,7 @@ class Context(object):
 @click.option('-p', '--port', type=int, help='The HTTP proxy port to run on.')
 @click.option('-d', '--database', type=str, help="Path to store database file.")
 @click.option('--sni', type=click.Choice(['empty', 'front', 'original']), help="The default SNI policy to use.")
+@click.option('--workers', type=int, help="Number of proxy worker processes to run.")
 @click.option('--reset-db', is_flag=True, default=False, help="Reset the database.")
 @click.option('--dev', is_flag=True, default=False, help="Run in development mode.")
 @click.pass_context
@@ -65,13 +77,20 @@ def cachebrowser(click_context, config, verbose, reset_db, dev, **kwargs):
         check_data_files(settings)
 
     logger.debug("Initializing database {}".format(settings.database))
-    initialize_database(settings.database, reset_db)
+    db = initialize_database(settings.database, reset_db, pragmas=settings.database_pragmas)
 
     logger.debug("Initializing bootstrapper")
     bootstrapper = Bootstrapper(settings)
 
     context = Context()
     context.bootstrapper = bootstrapper
+    context.host_cache = TTLCache(max_size=settings.host_cache_size,
+                                  ttl=settings.host_cache_ttl,
+                                  negative_ttl=settings.host_cache_negative_ttl)
+    context.db_writer = WriteBehindQueue(db,
+                                         max_batch=settings.database_write_batch_size,
+                                         flush_interval=settings.database_write_interval,
+                                         enabled=settings.database_write_behind)
     context.settings = settings
     context.click = click_context
 
@@ -85,31 +104,86 @@ def cachebrowser(click_context, config, verbose, reset_db, dev, **kwargs):
 @cachebrowser.command('start')
 @click.pass_obj
 def start_cachebrowser_server(context):
+    config = ProxyConfig(context)
+    server = ProxyServer(config)
+
+    if context.settings.workers > 1:
+        logger.info("Starting {} proxy workers".format(context.settings.workers))
+        supervisor = Supervisor(context, context.settings.workers, lambda index: run_proxy(context, server))
+        return supervisor.run()
+
     logger.debug("Initializing IPC")
     ipc = IPCManager(context)
     ipc.register_rpc_handlers(api_routes)
     context.ipc = ipc
 
-    config = ProxyConfig(context)
-    server = ProxyServer(config)
-    m = ProxyController(server, ipc)
+    return run_proxy(context, server)
+
+
+def build_proxy_controller(context, server):
+    """
+    Create the ProxyController with the proxy's pipe chain
+    """
+    # With several workers the supervisor serves the merged statistics of all of them
+    m = ProxyController(server, context.ipc,
+                        stats_interval=context.settings.pipe_stats_interval,
+                        serve_stats=context.settings.workers <= 1)
 
     # logger.debug("Adding WebsiteFilter Pipe")
     # m.add_pipe(WebsiteFilterPipe(context))
     logger.debug("Adding 'Resolver' pipe")
-    m.add_pipe(ResolverPipe(context))
+    resolver = ResolverPipe(context)
+    m.add_pipe(resolver)
     logger.debug("Adding Scrambler Pipe")
     m.add_pipe(ScramblerPipe(context))
     logger.debug("Adding 'SNI' pipe")
     m.add_pipe(SNIPipe(context))
     logger.debug("Adding 'Publisher' pipe")
     m.add_pipe(PublisherPipe(context))
+    if context.settings.prefetch_hosts:
+        logger.debug("Adding 'Prefetch' pipe")
+        m.add_pipe(PrefetchPipe(context, resolver))
+
+    return m
+
+
+def run_proxy(context, server):
+    context.db_writer.start()
+    if context.settings.watch_files:
+        context.file_watcher = create_file_watcher(context)
+        context.file_watcher.start()
+
+    m = build_proxy_controller(context, server)
+    if context.settings.workers > 1:
+        share_pipe_stats(context.ipc, m, context.worker_index)
 
     try:
         logger.info("Listening for proxy connections on port {}".format(context.settings.port))
         return m.run()
     except KeyboardInterrupt:
         m.shutdown()
+    finally:
+        if context.file_watcher is not None:
+            context.file_watcher.stop()
+        context.db_writer.stop()
+
+
+def create_file_watcher(context):
+    """
+    Create a FileWatcher which reloads the local bootstrap sources, pipes add their own files when they start
+    """
+    watcher = FileWatcher(context.settings.watch_interval)
+
+    def reload_source(source):
+        source.reload()
+        # Hostnames which weren't in the file before may be cached as having no bootstrap information
+        context.host_cache.clear()
+
+    for source in context.bootstrapper.sources:
+        if isinstance(source, LocalBootstrapSource):
+            watcher.watch(source.filename, partial(reload_source, source))
+
+    return watcher
 
 
 def initialize_logging(verbose=False):
@@ -0,0 +1,317 @@
+"""
+Matching structures for large domain and URL pattern lists.
+
+Both structures do the expensive work once, when entries are added, so that lookups only cost a walk over the
+labels of the hostname being checked plus (for globs) a couple of compiled regex matches, regardless of how
+many entries have been loaded.
+"""
+import re
+
+# Key used inside trie nodes to hold the value stored at that node. Labels are always strings so this can't clash.
+_VALUE = None
+
+
+def glob_to_regex(pattern):
+    """
+    Translate a shell-style glob (as understood by `fnmatch`) into a regex string without anchors or flags,
+    so that many of them can be joined into a single alternation.
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            res.append('.*')
+        elif c == '?':
+            res.append('.')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res.append('[%s]' % stuff)
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+
+def compile_globs(patterns):
+    """
+    Compile a list of glob patterns into one regex which matches a string if any of the patterns match it
+    """
+    return re.compile('(?:%s)\\Z' % '|'.join(glob_to_regex(p) for p in patterns), re.DOTALL)
+
+
+def has_wildcard(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+class GlobMatcher(object):
+    """
+    Matches a string against a group of glob patterns.
+
+    Patterns which are a literal string, optionally followed by a single trailing '*', are by far the most common
+    in block lists; they are checked with `str.startswith`/equality instead of a regex. Only the remaining
+    patterns are compiled, into a single combined regex.
+    """
+
+    def __init__(self, patterns):
+        prefixes = []
+        literals = set()
+        globs = []
+
+        for pattern in patterns:
+            if not has_wildcard(pattern):
+                literals.add(pattern)
+            elif pattern.endswith('*') and not has_wildcard(pattern[:-1]):
+                prefixes.append(pattern[:-1])
+            else:
+                globs.append(pattern)
+
+        self.literals = literals
+        self.prefixes = tuple(prefixes)
+        self.regex = compile_globs(globs) if globs else None
+
+    def match(self, string):
+        if string in self.literals:
+            return True
+        if self.prefixes and string.startswith(self.prefixes):
+            return True
+        return self.regex is not None and self.regex.match(string) is not None
+
+
+class DomainTrie(object):
+    """
+    A trie over the reversed labels of domain names, e.g. 'ads.example.com' is stored under com -> example -> ads.
+
+    Finding every stored domain which is a suffix of a hostname is a single walk down the trie, so lookups are
+    proportional to the number of labels in the hostname rather than to the number of stored domains.
+    """
+
+    def __init__(self):
+        self._root = {}
+        self._size = 0
+
+    def add(self, domain, value=True):
+        node = self._root
+        for label in reversed(domain.lower().split('.')):
+            child = node.get(label)
+            if child is None:
+                child = node[label] = {}
+            node = child
+
+        if _VALUE not in node:
+            self._size += 1
+        node[_VALUE] = value
+
+    def get(self, domain, default=None):
+        node = self._root
+        for label in reversed(domain.lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                return default
+        return node.get(_VALUE, default)
+
+    def iter_suffixes(self, hostname, min_labels=1, proper=False):
+        """
+        Yield `(num_labels, value)` for every stored domain which is a suffix of `hostname`, shortest first.
+
+        :param min_labels: ignore stored domains with fewer labels than this
+        :param proper: only yield suffixes which are strictly shorter than `hostname`
+        """
+        labels = hostname.lower().split('.')
+        total = len(labels)
+        node = self._root
+        depth = 0
+        for label in reversed(labels):
+            node = node.get(label)
+            if node is None:
+                return
+            depth += 1
+            if _VALUE in node and depth >= min_labels and not (proper and depth == total):
+                yield depth, node[_VALUE]
+
+    def matches_suffix(self, hostname, min_labels=1):
+        for _ in self.iter_suffixes(hostname, min_labels):
+            return True
+        return False
+
+    def __len__(self):
+        return self._size
+
+
+class URLGlobSet(object):
+    """
+    A set of glob patterns matched against scheme-less URLs ('host/path?query').
+
+    Patterns are bucketed by the host part of the pattern when they are added:
+      - a literal host ('www.google.com/ads/*') goes into an exact-match dict,
+      - a host of the form '*.example.com' goes into a `DomainTrie` keyed by 'example.com',
+      - anything else is kept in a generic bucket which is checked for every URL.
+    For the first two kinds only the path part of the pattern ('/ads/*') is kept, which turns the vast majority
+    of block list entries into plain prefix checks. Each bucket is compiled into a `GlobMatcher`, so a lookup
+    only evaluates the patterns that could possibly match the URL's host. Host wildcards are therefore matched
+    against the host part of the URL only.
+    """
+
+    def __init__(self, patterns=None):
+        self._exact = {}
+        self._suffix = DomainTrie()
+        self._generic = []
+
+        self._compiled = False
+        self._size = 0
+
+        for pattern in patterns or []:
+            self.add(pattern)
+
+    def add(self, pattern):
+        host = pattern.split('/', 1)[0]
+        path = pattern[len(host):]
+        host = host.lower()
+
+        if not has_wildcard(host):
+            self._exact.setdefault(host, []).append(path)
+        elif host.startswith('*.') and not has_wildcard(host[2:]):
+            bucket = self._suffix.get(host[2:])
+            if bucket is None:
+                bucket = []
+                self._suffix.add(host[2:], bucket)
+            bucket.append(path)
+        else:
+            self._generic.append(pattern)
+
+        self._size += 1
+        self._compiled = False
+
+    def compile(self):
+        self._exact_matchers = dict((host, GlobMatcher(patterns)) for host, patterns in self._exact.items())
+        self._suffix_matchers = DomainTrie()
+        self._collect_suffix_matchers(self._suffix._root, [])
+        self._generic_matcher = GlobMatcher(self._generic) if self._generic else None
+        self._compiled = True
+
+    def _collect_suffix_matchers(self, node, labels):
+        for label, child in node.items():
+            if label is _VALUE:
+                self._suffix_matchers.add('.'.join(reversed(labels)), GlobMatcher(child))
+            else:
+                self._collect_suffix_matchers(child, labels + [label])
+
+    def match(self, url):
+        """
+        :param url: URL without the scheme, e.g. 'www.google.com/ads/track?x=1'
+        """
+        if not self._compiled:
+            self.compile()
+
+        host = url.split('/', 1)[0]
+        path = url[len(host):]
+        host = host.lower()
+
+        matcher = self._exact_matchers.get(host)
+        if matcher is not None and matcher.match(path):
+            return True
+
+        for _, matcher in self._suffix_matchers.iter_suffixes(host, proper=True):
+            if matcher.match(path):
+                return True
+
+        return self._generic_matcher is not None and self._generic_matcher.match(url)
+
+    def __len__(self):
+        return self._size
+
+
+class HostPatternIndex(object):
+    """
+    Maps hostname patterns, which may contain `fnmatch`-style wildcards, to values.
+
+    Literal hostnames are kept in a dict. Wildcard patterns are indexed in a `DomainTrie` under their longest
+    wildcard-free suffix ('r1---*.googlevideo.com' under 'googlevideo.com'). A lookup only evaluates the wildcard
+    patterns stored along the hostname's path in the trie. The common '*.example.com' form needs no regex at all,
+    other patterns are compiled the first time they are evaluated.
+
+    When several patterns match a hostname, the one that was added first wins.
+    """
+
+    # Stands in for the regex of '*.<suffix>' patterns, which match any hostname that reaches their trie node
+    _ANY_SUBDOMAIN = object()
+
+    def __init__(self):
+        self._exact = {}
+        self._wildcards = DomainTrie()
+        self._generic = []
+        self._count = 0
+
+    def add(self, pattern, value):
+        order = self._count
+        self._count += 1
+
+        pattern = pattern.lower()
+        if not has_wildcard(pattern):
+            self._exact.setdefault(pattern, (order, value))
+            return
+
+        labels = pattern.split('.')
+        suffix = []
+        while len(labels) > 1 and not has_wildcard(labels[-1]):
+            suffix.insert(0, labels.pop())
+
+        # [order, pattern, compiled regex (filled in lazily), value]
+        entry = [order, pattern, None, value]
+        if not suffix:
+            self._generic.append(entry)
+            return
+
+        if labels == ['*']:
+            entry[2] = self._ANY_SUBDOMAIN
+
+        suffix = '.'.join(suffix)
+        bucket = self._wildcards.get(suffix)
+        if bucket is None:
+            bucket = []
+            self._wildcards.add(suffix, bucket)
+        bucket.append(entry)
+
+    def lookup(self, hostname, default=None):
+        hostname = hostname.lower()
+        best = self._exact.get(hostname)
+
+        for _, bucket in self._wildcards.iter_suffixes(hostname, proper=True):
+            best = self._first_match(bucket, hostname, best)
+        if self._generic:
+            best = self._first_match(self._generic, hostname, best)
+
+        return default if best is None else best[1]
+
+    @classmethod
+    def _first_match(cls, entries, hostname, best):
+        # Entries are kept in insertion order, so the first match is the best candidate from this bucket
+        for entry in entries:
+            if best is not None and entry[0] > best[0]:
+                break
+
+            regex = entry[2]
+            if regex is None:
+                regex = entry[2] = re.compile(glob_to_regex(entry[1]) + '\\Z', re.DOTALL)
+
+            if regex is cls._ANY_SUBDOMAIN or regex.match(hostname):
+                return entry[0], entry[3]
+        return best
+
+    def __len__(self):
+        return self._count
@@ -1,8 +1,35 @@
 import peewee
 import logging
+from threading import Thread
+
+from concurrent.futures import Future
+from six.moves import queue
 
 logger = logging.getLogger(__name__)
-db = peewee.SqliteDatabase('')
+
+
+class CacheBrowserDatabase(peewee.SqliteDatabase):
+    """
+    SQLite database with configurable pragmas.
+
+    Connections are per thread (the proxy thread, the IPC thread and the worker pools each get their own), and
+    the pragmas are applied to every new connection as it is opened.
+    """
+
+    def __init__(self, database, pragmas=None, **kwargs):
+        kwargs['threadlocals'] = True
+        super(CacheBrowserDatabase, self).__init__(database, pragmas=pragmas, **kwargs)
+
+    def set_pragmas(self, pragmas):
+        """
+        :param pragmas: dict or list of (name, value) pairs, e.g. {'journal_mode': 'wal', 'synchronous': 'normal'}
+        """
+        if isinstance(pragmas, dict):
+            pragmas = sorted(pragmas.items())
+        self._pragmas = list(pragmas or [])
+
+
+db = CacheBrowserDatabase('')
 
 
 class BaseModel(peewee.Model):
@@ -51,20 +78,151 @@ class Website(peewee.Model):
     hostname = peewee.CharField(primary_key=True)
     enabled = peewee.BooleanField(default=False)
 
+    class Meta:
+        database = db
+
+
+class WhoisNetwork(BaseModel):
+    """
+    Organization which an announced network (as returned by RDAP/whois) belongs to
+    """
+    cidr = peewee.CharField(primary_key=True)
+    org = peewee.CharField()
+    expires = peewee.FloatField()
+
+    class Meta:
+        database = db
+
 DoesNotExist = peewee.DoesNotExist
 
 
-def initialize_database(db_filename, reset=False):
+def initialize_database(db_filename, reset=False, pragmas=None):
     db.database = db_filename
+    db.set_pragmas(pragmas)
 
     if reset:
         logger.info("Resetting database tables")
         Host.drop_table(True)
         CDN.drop_table(True)
         Website.drop_table(True)
+        WhoisNetwork.drop_table(True)
 
     CDN.create_table(True)
     Host.create_table(True)
     Website.create_table(True)
+    WhoisNetwork.create_table(True)
 
     return db
+
+
+class WriteBehindQueue(object):
+    """
+    Runs database writes on a background thread, grouping them into batched transactions.
+
+    Writes are callables queued with `put`. The writer thread takes up to `max_batch` of them, waiting at most
+    `flush_interval` seconds for a batch to fill up, and runs them all in a single transaction. Each write runs in
+    its own savepoint, so a failing write (e.g. an IntegrityError for a row that was inserted concurrently) only
+    rolls back itself. `put` returns a `Future` with the result of the write.
+
+    Until `start` is called (or if the queue is disabled) writes are executed right away on the calling thread.
+    """
+
+    def __init__(self, database, max_batch=200, flush_interval=0.1, enabled=True):
+        self.database = database
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+
+        self._queue = queue.Queue()
+        self._worker = None
+
+        self.writes = 0
+        self.batches = 0
+        self.failures = 0
+
+    def start(self):
+        if self.enabled and self._worker is None:
+            self._worker = Thread(target=self._run, name='db-writer')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def stop(self, timeout=None):
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join(timeout)
+            self._worker = None
+
+    def put(self, func, *args, **kwargs):
+        future = Future()
+        if self._worker is None:
+            self._resolve(future, *self._execute(func, args, kwargs))
+        else:
+            self._queue.put((future, func, args, kwargs))
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Block until every write queued so far has been committed
+        """
+        return self.put(lambda: None).result(timeout)
+
+    def stats(self):
+        return {
+            'pending': self._queue.qsize(),
+            'writes': self.writes,
+            'batches': self.batches,
+            'failures': self.failures,
+        }
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            try:
+                while len(batch) < self.max_batch:
+                    item = self._queue.get(timeout=self.flush_interval)
+                    if item is None:
+                        self._queue.put(None)
+                        break
+                    batch.append(item)
+            except queue.Empty:
+                pass
+
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        try:
+            with self.database.atomic():
+                results = [self._execute(func, args, kwargs) for _, func, args, kwargs in batch]
+        except Exception as e:
+            # The commit itself failed, none of the writes made it
+            logger.warning("Database write batch failed: {}".format(e))
+            results = [(None, e)] * len(batch)
+
+        self.batches += 1
+        # Only resolve the futures once the batch is committed
+        for (future, _, _, _), (result, error) in zip(batch, results):
+            self._resolve(future, result, error)
+
+    def _execute(self, func, args, kwargs):
+        self.writes += 1
+        try:
+            with self.database.atomic():
+                return func(*args, **kwargs), None
+        except Exception as e:
+            self.failures += 1
+            if not isinstance(e, peewee.IntegrityError):
+                logger.warning("Database write failed: {}".format(e))
+            return None, e
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if not future.set_running_or_notify_cancel():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
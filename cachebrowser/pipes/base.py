@@ -36,6 +36,9 @@ class FlowPipe(Script, ScriptContext):
     def send_request(self, flow, run_hooks=False, block=False):
         self._master.replay_request(flow, run_scripthooks=run_hooks, block=block)
 
+    def call_in_master(self, func, *args, **kwargs):
+        self._master.call_in_master(func, *args, **kwargs)
+
     def run(self, name, *args, **kwargs):
         if not self.enabled:
             return
@@ -46,9 +49,13 @@ class FlowPipe(Script, ScriptContext):
 
     def enable(self):
         self.enabled = True
+        if self._master is not None:
+            self._master.pipes_changed(self)
 
     def disable(self):
         self.enabled = False
+        if self._master is not None:
+            self._master.pipes_changed(self)
 
     def pause(self):
         _self = self
@@ -0,0 +1,122 @@
+import logging
+import re
+from threading import Thread
+
+from netlib import encoding
+from six.moves import queue
+
+from cachebrowser.pipes.base import FlowPipe
+
+logger = logging.getLogger(__name__)
+
+"""
+Pages usually pull in resources from many other hosts. Instead of bootstrapping each of them when the browser opens a
+connection to it, the prefetcher picks hostnames out of HTML and CSS responses and warms the resolver's host cache
+for them in the background, with one batched bootstrap lookup per group of hostnames.
+
+The response hook only queues the raw body, decoding it and scanning it for hostnames is done by a worker thread so
+it doesn't hold up the master thread.
+"""
+
+PREFETCH_CONTENT_TYPES = ('text/html', 'text/css')
+
+# Absolute and protocol-relative URLs: http://host, https://host, //host
+HOSTNAME_RE = re.compile(br'(?:https?:)?//([a-z0-9](?:[a-z0-9-]*[a-z0-9])?(?:\.[a-z0-9](?:[a-z0-9-]*[a-z0-9])?)+)',
+                         re.IGNORECASE)
+
+
+def extract_hostnames(content, limit=None):
+    hostnames = set()
+    for match in HOSTNAME_RE.finditer(content):
+        hostname = match.group(1).decode('ascii').lower()
+        # Skip IP addresses and things like '//foo.js' in comments
+        if hostname.rsplit('.', 1)[-1].isalpha():
+            hostnames.add(hostname)
+            if limit is not None and len(hostnames) >= limit:
+                break
+    return hostnames
+
+
+class PrefetchPipe(FlowPipe):
+    MAX_HOSTS_PER_RESPONSE = 100
+    MAX_BATCH_SIZE = 50
+    BATCH_WAIT = 0.05
+    MAX_QUEUE_SIZE = 10000
+    # Bodies waiting to be scanned, further responses are skipped while it's full
+    MAX_BODY_QUEUE_SIZE = 100
+
+    def __init__(self, context, resolver, *args, **kwargs):
+        super(PrefetchPipe, self).__init__(context, *args, **kwargs)
+        self.resolver = resolver
+
+        self._queue = queue.Queue(maxsize=self.MAX_QUEUE_SIZE)
+        self._bodies = queue.Queue(maxsize=self.MAX_BODY_QUEUE_SIZE)
+        self._worker = None
+        self._scanner = None
+
+        self.prefetched = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._worker is None:
+            self._worker = Thread(target=self._run)
+            self._worker.daemon = True
+            self._worker.start()
+
+        if self._scanner is None:
+            self._scanner = Thread(target=self._scan)
+            self._scanner.daemon = True
+            self._scanner.start()
+
+    def response(self, flow):
+        if getattr(flow, 'is_decoy', False) or flow.response is None:
+            return
+
+        content_type = flow.response.headers.get('content-type', '')
+        if not content_type.startswith(PREFETCH_CONTENT_TYPES):
+            return
+
+        response = flow.response
+        content = getattr(response, 'raw_content', None)
+        if content is None:
+            content = response.content
+        if not content:
+            return
+
+        try:
+            self._bodies.put_nowait((response.headers.get('content-encoding'), content))
+        except queue.Full:
+            self.dropped += 1
+
+    def _scan(self):
+        while True:
+            content_encoding, content = self._bodies.get()
+            try:
+                if content_encoding in encoding.ENCODINGS:
+                    content = encoding.decode(content_encoding, content)
+                if not content:
+                    continue
+
+                for hostname in extract_hostnames(content, self.MAX_HOSTS_PER_RESPONSE):
+                    try:
+                        self._queue.put_nowait(hostname)
+                    except queue.Full:
+                        self.dropped += 1
+                        break
+            except Exception:
+                logger.warning("Scanning a response for hostnames failed", exc_info=True)
+
+    def _run(self):
+        while True:
+            batch = set([self._queue.get()])
+            try:
+                while len(batch) < self.MAX_BATCH_SIZE:
+                    batch.add(self._queue.get(timeout=self.BATCH_WAIT))
+            except queue.Empty:
+                pass
+
+            try:
+                self.resolver.prefetch_hosts(batch)
+                self.prefetched += len(batch)
+            except Exception:
+                logger.warning("Prefetching bootstrap information failed", exc_info=True)
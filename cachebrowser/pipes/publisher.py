@@ -1,18 +1,66 @@
+import random
+from collections import deque
+from threading import Thread, Event, Lock
+
 from cachebrowser.pipes.base import FlowPipe
-from cachebrowser.util import get_flow_size
+from cachebrowser.util import request_size, response_size
+
+"""
+Flows are published on the 'request-log' channel, once when the request comes in and once more when the response
+arrives. Nothing is built or published while no IPC client is subscribed to the channel.
+
+In 'immediate' mode every record is published on its own, from the proxy thread. In 'batched' mode records are
+buffered and a background thread publishes them as a list of records, every `publisher_flush_interval` seconds
+or as soon as `publisher_batch_size` records are waiting. The buffer is bounded by `publisher_buffer_size`; when it
+is full, the 'drop_oldest' policy discards the oldest records while the 'sample' policy keeps a uniform sample of
+the records seen since the last flush.
+"""
+
+REQUEST_LOG_CHANNEL = 'request-log'
+
+IMMEDIATE = 'immediate'
+BATCHED = 'batched'
+
+DROP_OLDEST = 'drop_oldest'
+SAMPLE = 'sample'
 
 
 class PublisherPipe(FlowPipe):
     def __init__(self, *args, **kwargs):
         super(PublisherPipe, self).__init__(*args, **kwargs)
         self._id_counter = 1
+        self._id_step = 1
+
+        self.mode = self.settings.publisher_mode
+        self.batch_size = self.settings.publisher_batch_size
+        self.flush_interval = self.settings.publisher_flush_interval
+        self.buffer_size = self.settings.publisher_buffer_size
+        self.overflow_policy = self.settings.publisher_overflow_policy
+
+        self._buffer = self._new_buffer()
+        # Records offered to the buffer since the last flush, used for sampling
+        self._offered = 0
+        self._lock = Lock()
+        self._flush_event = Event()
+        self._flusher = None
+
+        self.published = 0
+        self.dropped = 0
 
     def start(self):
         self._id_counter = 1
+        # Keep ids unique across proxy worker processes
+        self._id_step = self.settings.workers
+        self._id_counter += self.context.worker_index
+
+        if self.mode == BATCHED and self._flusher is None:
+            self._flusher = Thread(target=self._run_flusher)
+            self._flusher.daemon = True
+            self._flusher.start()
 
     def request(self, flow):
         flow._id = self._id_counter
-        self._id_counter += 1
+        self._id_counter += self._id_step
 
         self.publish_flow(flow)
         return flow
@@ -21,20 +69,33 @@ class PublisherPipe(FlowPipe):
         self.publish_flow(flow)
 
     def publish_flow(self, flow):
+        if not self._master.ipc.has_subscribers(REQUEST_LOG_CHANNEL):
+            return
+
+        log = self.build_record(flow)
+
+        if self.mode == BATCHED:
+            self._enqueue(log)
+        else:
+            self.publish(REQUEST_LOG_CHANNEL, log)
+            self.published += 1
+
+    def build_record(self, flow):
         log = {
             'id': flow._id,
             'url': flow.request.pretty_url,
+            'host': flow.request.pretty_host,
             'method': flow.request.method,
             'scheme': flow.request.scheme,
             'scheme_upgraded': flow.request.scheme_upgraded,
-            'request_size': get_flow_size(flow)[0],
+            'request_size': request_size(flow),
             'request_headers': dict(flow.request.headers)
         }
 
         if flow.response is not None:
             log['status_code'] = flow.response.status_code
             log['reason'] = flow.response.reason
-            log['response_size'] = get_flow_size(flow)[1]
+            log['response_size'] = response_size(flow)
             log['response_headers'] = dict(flow.response.headers)
 
         if getattr(flow.server_conn, 'cachebrowsed', None) is not None:
@@ -46,6 +107,59 @@ class PublisherPipe(FlowPipe):
                 'cb_error': flow.server_conn.cb_status_message
             })
 
-        self.publish('request-log', log)
+        return log
+
+    def flush(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            records = list(self._buffer)
+            self._buffer = self._new_buffer()
+            self._offered = 0
+
+        if self.overflow_policy == SAMPLE:
+            # Sampling replaces random slots, put the records back in the order they came in
+            records.sort(key=lambda record: record.pop('_seq'))
+
+        self.publish(REQUEST_LOG_CHANNEL, records)
+        self.published += len(records)
+
+    def _new_buffer(self):
+        if self.overflow_policy == DROP_OLDEST:
+            return deque(maxlen=self.buffer_size)
+        return []
+
+    def _enqueue(self, log):
+        with self._lock:
+            self._offered += 1
+
+            if len(self._buffer) < self.buffer_size:
+                if self.overflow_policy == SAMPLE:
+                    log['_seq'] = self._offered
+                self._buffer.append(log)
+            elif self.overflow_policy == SAMPLE:
+                # Reservoir sampling: every record offered since the last flush is kept with equal probability
+                self.dropped += 1
+                index = random.randrange(self._offered)
+                if index < self.buffer_size:
+                    log['_seq'] = self._offered
+                    self._buffer[index] = log
+            else:
+                # The deque discards the oldest record itself
+                self.dropped += 1
+                self._buffer.append(log)
+
+            full = len(self._buffer) >= self.batch_size
+
+        if full:
+            self._flush_event.set()
+
+    def _run_flusher(self):
+        while True:
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
 
-# TODO publish error
+            try:
+                self.flush()
+            except Exception as e:
+                self.log("Publishing request log batch failed: {}".format(e), 'error')
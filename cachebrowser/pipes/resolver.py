@@ -1,6 +1,8 @@
+import peewee
 from cachebrowser.bootstrap import BootstrapError
 from netlib.tcp import Address
 
+from cachebrowser.cache import SingleFlight, MISSING, NEGATIVE
 from cachebrowser.models import Host, DoesNotExist, CDN
 from cachebrowser.pipes.base import FlowPipe
 
@@ -14,12 +16,23 @@ If so we will change the scheme as shown above. If the request is already HTTPS
 
 In the 'serverconnect' hook we will then check whether the connection address and sni has to be changed.
 
-This is bad a little because for every HTTP request we will have to lookup the Host from the database twice. But so be
-it for now.
+For every HTTP request we have to lookup the Host twice, so resolved hosts (and hostnames which have no bootstrap
+information) are kept in the context's host cache and the database is only hit on a cache miss.
+
+Bootstrapped hosts and CDNs are written to the database through the context's write-behind queue, so the proxy
+thread doesn't wait for the inserts. CDNs whose insert is still queued are kept in `_pending_cdns` so they aren't
+bootstrapped a second time in the meantime.
 """
 
 
 class ResolverPipe(FlowPipe):
+    def __init__(self, *args, **kwargs):
+        super(ResolverPipe, self).__init__(*args, **kwargs)
+        self.host_cache = self.context.host_cache
+        self._inflight = SingleFlight()
+        self.db_writer = self.context.db_writer
+        self._pending_cdns = {}
+
     def serverconnect(self, server_conn):
         hostname = server_conn.address.host
 
@@ -72,38 +85,109 @@ class ResolverPipe(FlowPipe):
 
         return flow
 
+    def prefetch_hosts(self, hostnames):
+        """
+        Warm the host cache for `hostnames`, using one database query and one batched bootstrap lookup for all of
+        the hosts which aren't cached yet
+        """
+        hostnames = [hostname for hostname in set(hostnames)
+                     if self.host_cache.peek(hostname) is MISSING and not self._inflight.in_flight(hostname)]
+        if not hostnames:
+            return
+
+        found = set()
+        for host in self._select_hosts().where(Host.hostname << hostnames):
+            self.host_cache.set(host.hostname, host)
+            found.add(host.hostname)
+
+        remaining = [hostname for hostname in hostnames if hostname not in found]
+        if not remaining:
+            return
+
+        bootstrapped = self.bootstrapper.lookup_hosts(remaining)
+        for hostname in remaining:
+            if hostname not in bootstrapped:
+                self.host_cache.set_negative(hostname)
+                continue
+
+            try:
+                self._inflight.do(hostname, self._cache_new_host, hostname, bootstrapped[hostname])
+            except DoesNotExist:
+                pass
+
     def _get_or_bootstrap_host(self, hostname):
+        host = self.host_cache.get(hostname)
+        if host is NEGATIVE:
+            raise DoesNotExist
+        if host is not MISSING:
+            return host
+
+        return self._inflight.do(hostname, self._resolve_host, hostname)
+
+    def _resolve_host(self, hostname):
         try:
-            return Host.get(Host.hostname == hostname)
+            host = self._load_or_bootstrap_host(hostname)
+        except DoesNotExist:
+            self.host_cache.set_negative(hostname)
+            raise
+
+        self.host_cache.set(hostname, host)
+        return host
+
+    def _cache_new_host(self, hostname, host_data):
+        host = self.host_cache.peek(hostname)
+        if host is MISSING or host is NEGATIVE:
+            host = self._create_host(host_data)
+            self.host_cache.set(hostname, host)
+        return host
+
+    @staticmethod
+    def _select_hosts():
+        # Fetch the CDN in the same query so the cached host doesn't trigger lazy loads later on
+        return Host.select(Host, CDN).join(CDN, peewee.JOIN.LEFT_OUTER)
+
+    def _load_or_bootstrap_host(self, hostname):
+        try:
+            return self._select_hosts().where(Host.hostname == hostname).get()
         except DoesNotExist:
             try:
                 host_data = self.bootstrapper.lookup_host(hostname)
             except BootstrapError:
                 raise DoesNotExist
 
-            cdn_id = host_data.get('cdn', None)
-            if 'cdn' in host_data:
-                del host_data['cdn']
+            return self._create_host(host_data)
 
-            host = Host(**host_data)
+    def _create_host(self, host_data):
+        host_data = dict(host_data)
+        cdn_id = host_data.pop('cdn', None)
 
-            try:
-                host.cdn = self._get_or_bootstrap_cdn(cdn_id)
-            except DoesNotExist:
-                host.cdn = CDN.create(id=cdn_id, valid=False)
+        host = Host(**host_data)
 
-            host.save(force_insert=True)
+        try:
+            host.cdn = self._get_or_bootstrap_cdn(cdn_id)
+        except DoesNotExist:
+            host.cdn = self._insert_cdn(CDN(id=cdn_id, valid=False))
 
-            return host
+        # If the host was created concurrently (e.g. from the API) the insert fails and the existing row is kept
+        self.db_writer.put(host.save, force_insert=True)
+        return host
 
     def _get_or_bootstrap_cdn(self, cdn_id):
+        cdn = self._pending_cdns.get(cdn_id)
+        if cdn is not None:
+            return cdn
+
         try:
             return CDN.get(CDN.id == cdn_id)
         except DoesNotExist:
             try:
                 cdn_data = self.bootstrapper.lookup_cdn(cdn_id)
-                cdn = CDN(**cdn_data)
-                cdn.save(force_insert=True)
-                return cdn
+                return self._insert_cdn(CDN(**cdn_data))
             except BootstrapError:
                 raise DoesNotExist
+
+    def _insert_cdn(self, cdn):
+        self._pending_cdns[cdn.id] = cdn
+        future = self.db_writer.put(cdn.save, force_insert=True)
+        future.add_done_callback(lambda _: self._pending_cdns.pop(cdn.id, None))
+        return cdn
@@ -1,15 +1,21 @@
 # cdn.jsdelivr.net
 import logging
 from time import time, sleep
-from threading import Thread, RLock
-from random import random, shuffle, choice
+from collections import deque
+from threading import Lock, Thread
+from random import random
 from six.moves.urllib.parse import urlparse
 
 from mitmproxy.models import HTTPResponse
 from netlib.http import Headers
 
+from cachebrowser.decoys import DecoyCatalog, compiled_path_for
+from cachebrowser.dnsresolver import DNSResolver
+from cachebrowser.matching import DomainTrie, URLGlobSet
 from cachebrowser.pipes.base import FlowPipe
-from cachebrowser.util import get_flow_size, pretty_bytes
+from cachebrowser.stats import SlidingWindowCounter, sum_stats
+from cachebrowser.util import pretty_bytes, request_size, response_size
+from cachebrowser.whois import WhoisClassifier
 
 
 logger = logging.getLogger(__name__)
@@ -26,21 +32,41 @@ class ScramblerPipe(FlowPipe):
     PROB_AD_DECOY = 1.0
     PROB_DECOY = 0.2
 
-    OVERHEAD = 0.1
     BLOCK_ADS = True
 
     def __init__(self, *args, **kwargs):
         super(ScramblerPipe, self).__init__(*args, **kwargs)
 
-        self.overhead = self.OVERHEAD
         self.drop_ads = True
         self.send_decoys = True
-        self.org_names = self.read_org_names()
 
+        self.decoys_path = self.settings.data_path('scrambler/decoy.json')
+        self.ad_domains_path = self.settings.data_path('scrambler/ad-domains')
+        self.blacklist_path = self.settings.data_path('scrambler/blacklist')
+        catalog = DecoyCatalog.open(self.decoys_path)
+        self.org_names = catalog.org_names + ['OTHER']
 
         self.adblocker = AdBlocker()
-        self.netstats = NetStatKeeper(self.org_names)
-        self.decoymaker = DecoyMaker(self.netstats, self.org_names)
+        self.whois = WhoisClassifier(self.org_names,
+                                     ttl=self.settings.whois_cache_ttl,
+                                     workers=self.settings.whois_workers,
+                                     writer=self.context.db_writer)
+        self.dns = DNSResolver(nameserver=self.settings.dns_nameserver,
+                               port=self.settings.dns_port,
+                               timeout=self.settings.dns_timeout,
+                               workers=self.settings.dns_workers)
+        self.netstats = NetStatKeeper(self.org_names, self.whois, self.dns)
+        self.decoymaker = DecoyMaker(self.netstats, catalog)
+        self.budget = OverheadBudget(self.netstats.requested_downstream_traffic,
+                                     sustained=self.settings.scrambler_overhead,
+                                     burst=self.settings.scrambler_burst_overhead)
+        self.dispatcher = DecoyDispatcher(self._send_decoy, self.budget,
+                                          max_concurrent=self.settings.scrambler_max_concurrent_decoys,
+                                          max_per_org=self.settings.scrambler_max_decoys_per_org,
+                                          max_queued=self.settings.scrambler_decoy_queue_size,
+                                          schedule=self.call_in_master)
+        self._scheduler = None
+        self._release_pending = False
 
         self.api = ScramblerAPI(self.context, self)
 
@@ -59,9 +85,64 @@ class ScramblerPipe(FlowPipe):
 
     def start(self):
         # super(Scrambler, self).start()
-        self.adblocker.load_blacklist(self.context.settings.data_path('scrambler/ad-domains'),
-                                      self.context.settings.data_path('scrambler/blacklist'))
-        self.decoymaker.load_decoys(self.context.settings.data_path('scrambler/decoy.json'))
+        self.adblocker.load_blacklist(self.ad_domains_path, self.blacklist_path)
+
+        watcher = self.context.file_watcher
+        if watcher is not None:
+            watcher.watch([self.ad_domains_path, self.blacklist_path],
+                          lambda: self.adblocker.load_blacklist(self.ad_domains_path, self.blacklist_path))
+            watcher.watch([self.decoys_path, compiled_path_for(self.decoys_path)], self._load_decoys)
+
+        if self._scheduler is None:
+            self._scheduler = Thread(target=self._run_scheduler)
+            self._scheduler.daemon = True
+            self._scheduler.start()
+
+    def enable(self):
+        # Hooks don't run while disabled, so decoys which completed in the meantime were never accounted for
+        self.dispatcher.reset()
+        super(ScramblerPipe, self).enable()
+
+    def disable(self):
+        super(ScramblerPipe, self).disable()
+        self.dispatcher.cancel_all()
+
+    @property
+    def overhead(self):
+        return self.budget.sustained
+
+    @overhead.setter
+    def overhead(self, overhead):
+        self.budget.sustained = overhead
+
+    def reload_decoys(self):
+        """
+        Load the decoy catalog again in the background and swap it in once it's ready
+        """
+        def reload():
+            try:
+                self._load_decoys()
+            except Exception as e:
+                logger.error("Reloading decoys from {} failed: {}".format(self.decoys_path, e))
+
+        thread = Thread(target=reload)
+        thread.daemon = True
+        thread.start()
+
+    def _load_decoys(self):
+        catalog = DecoyCatalog.open(self.decoys_path)
+
+        new_orgs = [org for org in catalog.org_names if org not in self.org_names]
+        if new_orgs:
+            self.netstats.add_orgs(new_orgs)
+            self.org_names.extend(new_orgs)
+
+        self.decoymaker.set_catalog(catalog)
+
+        if new_orgs:
+            # Only now may the classifier return the new orgs, the traffic windows have to know them first
+            self.whois.org_names = self.whois.org_names | set(new_orgs)
+        logger.info("Reloaded {} decoys from {}".format(len(catalog), catalog.source))
 
     def reset(self):
         self.block_count = 0
@@ -75,6 +156,7 @@ class ScramblerPipe(FlowPipe):
         self.decoysent = 0
         self.decoyreceived = 0
         self.decoymaker.inflight = 0
+        self.dispatcher.cancel_all()
 
         self.user_requests = 0
         self.blocked_requests = 0
@@ -89,14 +171,17 @@ class ScramblerPipe(FlowPipe):
             'decoys': self.decoyreceived,
             'decoys_sent': self.decoysent,
             'max_overhead': self.overhead,
+            'achieved_overhead': float(self.downstream_overhead) / self.downstream_traffic
+                                 if self.downstream_traffic else 0.0,
+            'budget': self.budget.stats(),
+            'dispatcher': self.dispatcher.stats(),
             'user_requests': self.user_requests,
             'blocked_requests': self.blocked_requests,
-            'adblock_enabled': self.BLOCK_ADS
+            'adblock_enabled': self.BLOCK_ADS,
+            'whois': self.whois.stats(),
+            'dns': self.dns.stats()
         }
 
-    def serverconnect(self, server_conn):
-        pass
-
     def print_stats(self):
         print(self.decoymaker.inflight)
         print("Sent: {}  Received: {}  Overhead: {}  Traffic: {}   Overhead: {}  Traffic: {} ".format(self.decoysent, self.decoyreceived,
@@ -108,26 +193,20 @@ class ScramblerPipe(FlowPipe):
 
         if is_decoy:
             self.netstats.update_real_upstream(flow)
-            self.upstream_overhead += get_flow_size(flow)[0]
+            self.upstream_overhead += request_size(flow)
 
             self.decoysent += 1
         else:
             self.netstats.update_real_upstream(flow)
             self.netstats.update_requested_upstream(flow)
-            self.upstream_traffic += get_flow_size(flow)[0]
+            self.upstream_traffic += request_size(flow)
 
             self.user_requests += 1
 
             if self.BLOCK_ADS and self.adblocker.should_block(flow):
                 self.blocked_requests += 1
                 self.dummy_response(flow)
-                self._send_decoy_request(skip_netname=_whois(flow, self.org_names))
-            else:
-                for i in range(6):
-                    wanted = sum(self.netstats.requested_downstream_traffic.values())
-                    actual = sum(self.netstats.real_downstream_traffic.values())
-                    if actual + self.decoymaker.inflight < wanted + wanted * self.overhead:
-                        self._send_decoy_request()
+                self._queue_decoy(skip_netname=self.whois.classify(_get_flow_ip(flow, self.dns)))
 
         # self.print_stats()
         # print("")
@@ -141,32 +220,67 @@ class ScramblerPipe(FlowPipe):
             self.decoymaker.record_decoy_received(flow)
             self.decoyreceived += 1
 
-            self.downstream_overhead += get_flow_size(flow)[1]
+            budget_org = getattr(flow, 'budget_org', None)
+            if budget_org is not None:
+                self.budget.settle(budget_org, flow.estimated_size, response_size(flow))
+
+            self.downstream_overhead += response_size(flow)
+            self.dispatcher.done(flow)
         else:
             self.netstats.update_real_downstream(flow)
             self.netstats.update_requested_downstream(flow)
-            self.downstream_traffic += get_flow_size(flow)[1]
-
-    def read_org_names(self):
-        with open(self.context.settings.data_path('scrambler/decoy.json')) as f:
-            import json
-            netname_data = json.loads(f.read())
-            org_names = netname_data.keys()
-        org_names.append('OTHER')
-        return org_names
-
-    def _send_decoy_request(self, skip_netname=None):
-        decoyurl = self.decoymaker.get_decoy_url(skip_netname)
-        # logging.info("Sending DECOY to {}".format(decoyurl))
-        if decoyurl is not None:
-            new_flow = self.create_request_from_url('GET', decoyurl)
+            self.downstream_traffic += response_size(flow)
+
+    def _queue_decoy(self, skip_netname=None, budget_org=None):
+        """
+        Pick a decoy and hand it to the dispatcher, paid for from `budget_org`'s budget if given
+        """
+        decoy = self.decoymaker.get_decoy(skip_netname)
+        if decoy is None:
+            return
 
-            # Don't update stats on dummy request
-            new_flow.outgoing_request = True
-            new_flow.is_decoy = True
-            self.send_request(new_flow, run_hooks=True)
+        netname, decoyurl, size = decoy
+        if budget_org is not None:
+            self.budget.debit(budget_org, size)
+        self.dispatcher.submit(netname, decoyurl, size, budget_org)
 
-            self.decoymaker.record_decoy_sent(new_flow, decoyurl)
+    def _send_decoy(self, decoy):
+        # logging.info("Sending DECOY to {}".format(decoyurl))
+        new_flow = self.create_request_from_url('GET', decoy.url)
+
+        # Don't update stats on dummy request
+        new_flow.outgoing_request = True
+        new_flow.is_decoy = True
+        new_flow.decoy_org = decoy.org
+        new_flow.budget_org = decoy.budget_org
+        self.send_request(new_flow, run_hooks=True)
+
+        self.decoymaker.record_decoy_sent(new_flow, decoy.size)
+        return new_flow
+
+    def _run_scheduler(self):
+        """
+        Release the decoys the budget allows for every `scrambler_schedule_interval` seconds. Decoys are sent
+        from the master thread, the request hooks don't send any themselves.
+        """
+        while True:
+            sleep(self.settings.scrambler_schedule_interval)
+
+            if not self.enabled or not self.send_decoys or self._release_pending:
+                continue
+            if self.budget.ready():
+                self._release_pending = True
+                self.call_in_master(self._release_decoys)
+
+    def _release_decoys(self):
+        try:
+            # At most one decoy per org and round, so decoys are spread out over time
+            for org in self.budget.ready():
+                if self.dispatcher.full():
+                    break
+                self._queue_decoy(skip_netname=org, budget_org=org)
+        finally:
+            self._release_pending = False
 
     def handle_ads(self, flow):
         domain = urlparse(flow.request.url).netloc
@@ -175,8 +289,9 @@ class ScramblerPipe(FlowPipe):
             self.dummy_response(flow)
 
             if self.send_decoys and should_i(self.PROB_AD_DECOY):
-                decoy_url = self.decoymaker.get_decoy_url(flow)
-                if decoy_url is not None:
+                decoy = self.decoymaker.get_decoy()
+                if decoy is not None:
+                    decoy_url = decoy[1]
                     # logging.info("@@@@@@@@@@@@@@  Sending Decoy Request {}".format(decoy_url))
                     new_flow = self.create_request_from_url('GET', decoy_url)
 
@@ -197,7 +312,12 @@ class ScramblerPipe(FlowPipe):
         flow.reply(resp)
 
     def error(self, flow):
-        pass
+        if getattr(flow, 'is_decoy', False):
+            # Nothing was received, the budget gets the decoy's expected size back
+            self.decoymaker.record_decoy_received(flow)
+            if flow.budget_org is not None:
+                self.budget.settle(flow.budget_org, flow.estimated_size, 0)
+            self.dispatcher.done(flow)
 
 
 class ScramblerAPI(object):
@@ -208,6 +328,10 @@ class ScramblerAPI(object):
         context.ipc.register_rpc('/scrambler/set/settings', self.set_settings)
         context.ipc.register_rpc('/scrambler/enable', self.enable_scrambler)
         context.ipc.register_rpc('/scrambler/disable', self.disable_scrambler)
+        context.ipc.register_rpc('/scrambler/decoys/reload', self.reload_decoys)
+        if context.settings.workers <= 1:
+            # With several workers the supervisor serves the merged statistics (see `cachebrowser.workers`)
+            context.ipc.register_rpc('/scrambler/stats', self.get_stats)
 
     def get_settings(self, context, request):
         request.reply({
@@ -215,16 +339,33 @@ class ScramblerAPI(object):
             'settings': {
                 'enabled': self.scrambler.enabled,
                 'overhead': self.scrambler.overhead,
+                'burst_overhead': self.scrambler.budget.burst,
                 'drops': self.scrambler.drop_ads,
                 'decoys': self.scrambler.send_decoys
             }
         })
 
     def set_settings(self, context, request):
+        ratios = {}
+        for key in ('overhead', 'burst_overhead'):
+            if key not in request.params:
+                continue
+            try:
+                ratios[key] = float(request.params[key])
+            except (ValueError, TypeError):
+                ratios[key] = None
+            if ratios[key] is None or not ratios[key] >= 0:
+                return request.error("'{}' should be a non-negative ratio".format(key))
+
         if 'enabled' in request.params:
-            self.scrambler.enabled = bool(request.params['enabled'])
-        if 'overhead' in request.params:
-            self.scrambler.overhead = int(request.params['overhead'])
+            if request.params['enabled']:
+                self.scrambler.enable()
+            else:
+                self.scrambler.disable()
+        if 'overhead' in ratios:
+            self.scrambler.overhead = ratios['overhead']
+        if 'burst_overhead' in ratios:
+            self.scrambler.budget.burst = ratios['burst_overhead']
         if 'drops' in request.params:
             self.scrambler.drop_ads = bool(request.params['drops'])
         if 'decoys' in request.params:
@@ -241,6 +382,98 @@ class ScramblerAPI(object):
         self.scrambler.disable()
         request.reply({'result': 'success'})
 
+    def reload_decoys(self, context, request):
+        self.scrambler.reload_decoys()
+        request.reply({'result': 'success'})
+
+    def get_stats(self, context, request):
+        request.reply(self.scrambler.get_stats())
+
+
+class TrafficWindow(object):
+    """
+    Traffic per organization over a sliding time window, plus the total across all organizations.
+
+    Reads are O(1): `window[org]` and `window.total()` return running totals which are maintained incrementally
+    as traffic is recorded and as old time slots expire.
+    """
+
+    SLOTS = 10
+
+    def __init__(self, org_names, window):
+        self.window = window
+        self.lock = Lock()
+
+        self._counters = {}
+        for org in org_names:
+            self._counters[org] = SlidingWindowCounter(window, self.SLOTS)
+        self._total = SlidingWindowCounter(window, self.SLOTS)
+
+        self._listeners = []
+
+    @property
+    def slot_width(self):
+        return float(self.window) / self.SLOTS
+
+    def add_listener(self, listener):
+        """
+        Call `listener(org, size, value)` with the org's new total whenever traffic is recorded, and with
+        `(None, None, None)` when the window is reset
+        """
+        self._listeners.append(listener)
+
+    def add_org(self, org):
+        with self.lock:
+            if org not in self._counters:
+                self._counters[org] = SlidingWindowCounter(self.window, self.SLOTS)
+
+    def add(self, org, size):
+        now = time()
+        with self.lock:
+            counter = self._counters[org]
+            counter.add(size, now)
+            self._total.add(size, now)
+            value = counter.value(now)
+
+        for listener in self._listeners:
+            listener(org, size, value)
+
+    def total(self):
+        with self.lock:
+            return self._total.value()
+
+    def reset(self):
+        with self.lock:
+            for counter in self._counters.values():
+                counter.reset()
+            self._total.reset()
+
+        for listener in self._listeners:
+            listener(None, None, None)
+
+    def __getitem__(self, org):
+        with self.lock:
+            return self._counters[org].value()
+
+    def __contains__(self, org):
+        return org in self._counters
+
+    def __iter__(self):
+        return iter(self._counters)
+
+    def keys(self):
+        return list(self._counters.keys())
+
+    def values(self):
+        now = time()
+        with self.lock:
+            return [counter.value(now) for counter in self._counters.values()]
+
+    def items(self):
+        now = time()
+        with self.lock:
+            return [(org, counter.value(now)) for org, counter in self._counters.items()]
+
 
 class NetStatKeeper(object):
     UPSTREAM_STD = 200
@@ -248,357 +481,488 @@ class NetStatKeeper(object):
 
     S = 10
 
-    def __init__(self, org_names):
-        from collections import deque
+    def __init__(self, org_names, whois, resolver):
         self.org_names = org_names
+        self.whois = whois
+        self.resolver = resolver
 
-        self.requested_upstream = {}
-        self.requested_downstream = {}
-        self.requested_upstream_traffic = {}
-        self.requested_downstream_traffic = {}
-
-        self.real_upstream = {}
-        self.real_downstream = {}
-        self.real_upstream_traffic = {}
-        self.real_downstream_traffic = {}
-
-        self.lock = RLock()
-        # self.outgoing_lock = RLock()
-
-        for org in org_names:
-            self.requested_upstream[org] = deque()
-            self.requested_downstream[org] = deque()
-            self.real_downstream[org] = deque()
-            self.real_upstream[org] = deque()
-            self.real_downstream_traffic[org] = 0
-            self.real_upstream_traffic[org] = 0
-            self.requested_downstream_traffic[org] = 0
-            self.requested_upstream_traffic[org] = 0
-
-        def refresher():
-            def refresh(ds):
-                for k in ds:
-                    while len(ds[k]):
-                        if ds[k][0][0] < threshold:
-                            ds[k].popleft()
-                        else:
-                            break
-
-            while True:
-                sleep(1)
-                now = time()
-                threshold = now - self.S
-
-                with self.lock:
-                    refresh(self.requested_downstream)
-                    refresh(self.requested_upstream)
-                    refresh(self.real_downstream)
-                    refresh(self.real_upstream)
-
-                    for netname in org_names:
-                        self.requested_upstream_traffic[netname] = 0
-                        for item in self.requested_upstream[netname]:
-                            self.requested_upstream_traffic[netname] += item[1]
-
-                        self.requested_downstream_traffic[netname] = 0
-                        for item in self.requested_downstream[netname]:
-                            self.requested_downstream_traffic[netname] += item[1]
-
-                        self.real_upstream_traffic[netname] = 0
-                        for item in self.real_upstream[netname]:
-                            self.real_upstream_traffic[netname] += item[1]
-
-                        self.real_downstream_traffic[netname] = 0
-                        for item in self.real_downstream[netname]:
-                            self.real_downstream_traffic[netname] += item[1]
-
-        refresh_thread = Thread(target=refresher)
-        refresh_thread.daemon = True
-        refresh_thread.start()
+        self.requested_upstream_traffic = TrafficWindow(org_names, self.S)
+        self.requested_downstream_traffic = TrafficWindow(org_names, self.S)
+        self.real_upstream_traffic = TrafficWindow(org_names, self.S)
+        self.real_downstream_traffic = TrafficWindow(org_names, self.S)
 
     def update_requested_downstream(self, flow):
-        ip = _get_flow_ip(flow)
+        ip = _get_flow_ip(flow, self.resolver)
         if ip is None:
             return
 
-        _, resp = get_flow_size(flow)
+        resp = response_size(flow)
 
-        netname = _whois(ip, self.org_names)
-        with self.lock:
-            self.requested_downstream_traffic[netname] += resp
-            self.requested_downstream[netname].append((time(), resp))
+        netname = self.whois.classify(ip)
+        self.requested_downstream_traffic.add(netname, resp)
 
     def update_requested_upstream(self, flow):
-        ip = _get_flow_ip(flow)
+        ip = _get_flow_ip(flow, self.resolver)
         if ip is None:
             return
 
-        req, _ = get_flow_size(flow)
+        req = request_size(flow)
 
-        netname = _whois(ip, self.org_names)
-        with self.lock:
-            self.requested_upstream_traffic[netname] += req
-            self.requested_upstream[netname].append((time(), req))
+        netname = self.whois.classify(ip)
+        self.requested_upstream_traffic.add(netname, req)
 
     def update_real_downstream(self, flow):
-        ip = _get_flow_ip(flow)
+        ip = _get_flow_ip(flow, self.resolver)
         if ip is None:
             return
 
-        _, resp = get_flow_size(flow)
+        resp = response_size(flow)
 
-        netname = _whois(ip, self.org_names)
-        with self.lock:
-            self.real_downstream_traffic[netname] += resp
-            self.real_downstream[netname].append((time(), resp))
+        netname = self.whois.classify(ip)
+        self.real_downstream_traffic.add(netname, resp)
 
     def update_real_upstream(self, flow):
-        ip = _get_flow_ip(flow)
+        ip = _get_flow_ip(flow, self.resolver)
         if ip is None:
             return
 
-        req, _ = get_flow_size(flow)
+        req = request_size(flow)
 
-        netname = _whois(ip, self.org_names)
-        with self.lock:
-            self.real_upstream_traffic[netname] += req
-            self.real_upstream[netname].append((time(), req))
+        netname = self.whois.classify(ip)
+        self.real_upstream_traffic.add(netname, req)
+
+    def add_orgs(self, orgs):
+        for window in (self.requested_upstream_traffic, self.requested_downstream_traffic,
+                       self.real_upstream_traffic, self.real_downstream_traffic):
+            for org in orgs:
+                window.add_org(org)
 
     def reset(self):
-        with self.lock:
-            for key in self.requested_downstream:
-                self.requested_downstream[key].clear()
-                self.requested_upstream[key].clear()
-                self.real_downstream[key].clear()
-                self.real_upstream[key].clear()
+        self.requested_downstream_traffic.reset()
+        self.requested_upstream_traffic.reset()
+        self.real_downstream_traffic.reset()
+        self.real_upstream_traffic.reset()
 
 
-class DecoyMaker(object):
-    def __init__(self, netstats, org_names):
-        self.netstats = netstats
-        self.decoy_urls = {}
-        self.decoy_sizes = {}
-        self.netnames = []
+class TokenBucket(object):
+    """
+    A byte budget for decoys. The balance may go negative when a decoy is larger than what was available,
+    later credits pay that back first.
+    """
 
-        self.inflight = 0
+    def __init__(self):
+        self.tokens = 0.0
 
-        for org in org_names:
-            self.netnames.append(org)
+    def credit(self, amount, capacity=None):
+        self.tokens += amount
+        if capacity is not None and self.tokens > capacity:
+            self.tokens = capacity
 
-    def get_decoy_url(self, skip_netname=None):
-        flow_netname = skip_netname
+    def debit(self, amount):
+        self.tokens -= amount
 
-        shuffle(self.netnames)
 
-        def key(netname):
-            if netname == flow_netname:
-                 return 100000
-            if netname == 'OTHER':
-                return 100000
-            if netname not in self.decoy_urls or not len(self.decoy_urls[netname]):
-                return 50000
-            return self.netstats.requested_upstream_traffic[netname]
+class OverheadBudget(object):
+    """
+    Decides how much decoy traffic may be sent, with a token bucket per organization.
 
-        self.netnames.sort(key=key)
+    When traffic is requested from an organization, `sustained` times its size is credited to the org's bucket,
+    and decoys (sent to other orgs) are paid for from it. The bucket holds at most `burst` times the traffic
+    requested from the org in the current window, which bounds how much is sent at once after a large download or
+    while decoys are disabled. Decoys are paid for with their expected size when sent, the difference to the
+    actual size is settled once the response arrives.
+    """
 
-        netname = self.netnames[0]
-        if netname not in self.decoy_urls or not len(self.decoy_urls[netname]):
-            return None
+    def __init__(self, traffic, sustained, burst):
+        """
+        :param traffic: the `TrafficWindow` of requested downstream traffic
+        """
+        self.traffic = traffic
+        self.sustained = sustained
+        self.burst = burst
 
-        # return self.decoy_urls[netname][0]
+        self.lock = Lock()
+        self._buckets = {}
 
-        return choice(self.decoy_urls[netname])
+        traffic.add_listener(self._on_traffic)
 
-    def record_decoy_sent(self, flow, url):
-        flow.estimated_size = self.decoy_sizes[url] 
-        self.inflight += flow.estimated_size
+    def ready(self):
+        """
+        Orgs with tokens available, decoys should be sent on their behalf
+        """
+        with self.lock:
+            return [org for org, bucket in self._buckets.items() if bucket.tokens > 0]
 
-    def record_decoy_received(self, flow):
-        self.inflight -= flow.estimated_size
+    def debit(self, org, size):
+        with self.lock:
+            self._bucket(org).debit(size)
 
-    def load_decoys(self, decoys_path):
-        import yaml
-        import json
-        # json loads strings as unicode, causes problems with saving flows
-        with open(decoys_path) as f:
-            # decoy_urls = yaml.safe_load(f.read())
-            decoy_urls = json.loads(f.read())
-            for netname in decoy_urls:
-                self.decoy_urls[netname] = [str(s) for s in decoy_urls[netname].keys()]
-                for url in decoy_urls[netname]:
-                    self.decoy_sizes[str(url)] = decoy_urls[netname][url]
-                # self.decoy_sizes.update(decoy_urls[netname])
+    def settle(self, org, estimated_size, actual_size):
+        with self.lock:
+            self._bucket(org).credit(estimated_size - actual_size)
 
+    def available(self, org):
+        with self.lock:
+            bucket = self._buckets.get(org)
+            return bucket.tokens if bucket is not None else 0.0
 
-class AdBlocker(object):
-    def __init__(self):
-        self.single_dom = set()
-        self.multi_dom = set()
-        self.adset = set()
+    def stats(self):
+        with self.lock:
+            tokens = sum(max(bucket.tokens, 0) for bucket in self._buckets.values())
+            debt = sum(-min(bucket.tokens, 0) for bucket in self._buckets.values())
+        return {
+            'target_overhead': self.sustained,
+            'burst_overhead': self.burst,
+            'available_bytes': tokens,
+            'debt_bytes': debt
+        }
 
-        self.blacklist = []
+    def _bucket(self, org):
+        bucket = self._buckets.get(org)
+        if bucket is None:
+            bucket = self._buckets[org] = TokenBucket()
+        return bucket
 
-    def should_block(self, flow):
-        from fnmatch import fnmatch
+    def _on_traffic(self, org, size, value):
+        with self.lock:
+            if org is None:
+                self._buckets = {}
+                return
+            self._bucket(org).credit(size * self.sustained, capacity=value * self.burst)
 
-        domain = urlparse(flow.request.url).netloc
 
-        parts = domain.split('.')
-        dom = parts.pop()
-        while parts:
-            dom = '{}.{}'.format(parts.pop(), dom)
-            if dom in self.adset:
-                return True
+class QueuedDecoy(object):
+    __slots__ = ('org', 'url', 'size', 'budget_org')
 
-        url = flow.request.url.replace('https://', '').replace('http://', '')
-        for pattern in self.blacklist:
-            if fnmatch(url, pattern):
-                return True
+    def __init__(self, org, url, size, budget_org=None):
+        self.org = org
+        self.url = url
+        self.size = size
+        self.budget_org = budget_org
 
-        return False
 
-    def load_blacklist(self, ad_domains_path, blacklist_path):
-        with open(ad_domains_path) as f:
-            for ad in f:
-                ad = ad.strip()
-                if not ad: continue
-                if ad.count('.') == 1:
-                    self.single_dom.add(ad)
-                else:
-                    self.multi_dom.add(ad)
-                self.adset.add(ad)
+class DecoyDispatcher(object):
+    """
+    Sends decoys with at most `max_concurrent` in flight overall and at most `max_per_org` to any one
+    organization (i.e. CDN), so decoys can't take over the proxy's connections and threads. Decoys beyond that
+    wait in a queue of at most `max_queued` (the oldest is dropped when it's full). A queued decoy is cancelled
+    instead of sent if its org's budget has been met by the time its turn comes, and its cost is refunded.
+
+    `submit` and `done` only update the queue, they're called from the pipe hooks and must not hold them up.
+    Sending is left to `dispatch`, which they have `schedule(func)` run later on the master thread (once, however
+    many calls come in meanwhile). `send(decoy)` is called by `dispatch` and returns the decoy's flow, `done(flow)`
+    must be called once the decoy completes or fails.
+    """
 
-        with open(blacklist_path) as f:
-            for dom in f:
-                dom = dom.strip()
-                if dom:
-                    self.blacklist.append(dom)
+    def __init__(self, send, budget, max_concurrent, max_per_org, max_queued, schedule):
+        self.send = send
+        self.schedule = schedule
+        self.budget = budget
+        self.max_concurrent = max_concurrent
+        self.max_per_org = max_per_org
+        self.max_queued = max_queued
 
+        self.lock = Lock()
+        self._queue = deque()
+        self._inflight = {}
+        self._inflight_total = 0
+        self._dispatch_pending = False
 
-def _get_flow_ip(flow):
-    if flow.server_conn and flow.server_conn.peer_address:
-        return flow.server_conn.peer_address.host
+        self.sent = 0
+        self.cancelled = 0
+        self.dropped = 0
 
-    domain = urlparse(flow.request.url).netloc
-    ips, domains = _dig(domain)
-    if len(ips):
-        return ips[0]
-    return None
+    def full(self):
+        return len(self._queue) >= self.max_queued
+
+    def submit(self, org, url, size, budget_org=None):
+        with self.lock:
+            if len(self._queue) >= self.max_queued:
+                self._refund(self._queue.popleft())
+                self.dropped += 1
+            self._queue.append(QueuedDecoy(org, url, size, budget_org))
+        self._schedule_dispatch()
+
+    def done(self, flow):
+        org = getattr(flow, 'decoy_org', None)
+        with self.lock:
+            count = self._inflight.get(org)
+            if not count:
+                return
+            self._inflight[org] = count - 1
+            self._inflight_total -= 1
+            if not self._queue:
+                return
+        self._schedule_dispatch()
+
+    def dispatch(self):
+        with self.lock:
+            self._dispatch_pending = False
+        for decoy in self._next_decoys():
+            self.send(decoy)
+
+    def _schedule_dispatch(self):
+        with self.lock:
+            if self._dispatch_pending:
+                return
+            self._dispatch_pending = True
+        self.schedule(self.dispatch)
+
+    def cancel_all(self):
+        with self.lock:
+            for decoy in self._queue:
+                self._refund(decoy)
+            self.cancelled += len(self._queue)
+            self._queue.clear()
+
+    def reset(self):
+        """
+        Forget about the decoys in flight
+        """
+        with self.lock:
+            self._inflight = {}
+            self._inflight_total = 0
 
+    def stats(self):
+        with self.lock:
+            return {
+                'queued': len(self._queue),
+                'inflight': self._inflight_total,
+                'sent': self.sent,
+                'cancelled': self.cancelled,
+                'dropped': self.dropped
+            }
 
-_whois_cache = {}
+    def _next_decoys(self):
+        """
+        Take the decoys which may be sent now off the queue and count them as in flight
+        """
+        ready = []
+        with self.lock:
+            waiting = deque()
+            while self._queue and self._inflight_total < self.max_concurrent:
+                decoy = self._queue.popleft()
 
+                if decoy.budget_org is not None and self.budget.available(decoy.budget_org) + decoy.size <= 0:
+                    # The budget was met without this decoy
+                    self._refund(decoy)
+                    self.cancelled += 1
+                    continue
 
-def _whois(ip, org_names):
-    from ipwhois import IPWhois
+                if self._inflight.get(decoy.org, 0) >= self.max_per_org:
+                    waiting.append(decoy)
+                    continue
 
-    if type(ip) is not str:
-        ip = _get_flow_ip(ip)
+                self._inflight[decoy.org] = self._inflight.get(decoy.org, 0) + 1
+                self._inflight_total += 1
+                self.sent += 1
+                ready.append(decoy)
 
-    if ip not in _whois_cache:
-        whois = IPWhois(ip)
-        try:
-            name = whois.lookup_rdap()['network']['name']
-            if not name:
-                name = whois.lookup()['nets'][0]['name']
-        except:
-            print("WHOIS ERROR")
-            name = 'OTHER'
+            waiting.extend(self._queue)
+            self._queue = waiting
+        return ready
 
-        _whois_cache[ip] = _clean_netname(org_names, name, ip)
-    return _whois_cache[ip]
+    def _refund(self, decoy):
+        if decoy.budget_org is not None:
+            self.budget.settle(decoy.budget_org, decoy.size, 0)
 
 
-def clean_netname(netname):
+class DecoySelector(object):
     """
-    Convert a whois netname into an organization name
+    Picks the organization decoys are sent to next: the one with the least requested traffic in `window`.
+
+    Organizations are the leaves of a tournament tree (a binary tree stored in a list) whose inner nodes hold the
+    smallest of their children, so recording traffic for an org and picking the minimum are both O(log n).
+    Traffic is pushed in by the window as it's recorded. Expiry isn't, so all leaves are refreshed from the
+    window, in O(n), once per time slot of the window.
+
+    Ties are broken in a random order, and an org goes to the back of that order when it's picked, so orgs with
+    equal traffic (typically none at all) take turns.
     """
-    # from cdn import cdn_list
-
-    ORGS = [
-        ('GOOGLE', ['google']),
-        ('AKAMAI', ['akamai', 'umass']),
-        ('AMAZON', ['at-', 'amazo']),
-        # ('CLOUDFRONT', []),
-        ('FASTLY', ['fastly']),
-        ('CLOUDFLARE', ['cloudflare']),
-        ('EDGECAST', ['edgecast']),
-        ('HIGHWINDS', ['highwind']),
-        ('INCAPSULA', ['incapsula']),
-        ('MAXCDN', ['netdna']),
-        ('CDNET', ['cdnet']),
-        ('TWITTER', ['twitter']),
-        ('INAP', ['inap-']),
-        ('LINODE', ['linode']),
-        ('DIGITALOCEAN', ['digitalocean']),
-        ('YAHOO', ['yahoo']),
-        ('FACEBOOK', ['facebook', 'ord1', 'tfbnet']),
-
-        ('OTHER', [])
-    ]
-    if ' ' in netname:
-        netname = netname.split()[0]
-
-    lower = netname.lower()
-    for org in ORGS:
-        if any([x in lower for x in org[1]]):
-            return org[0]
-
-    else:
-        org = netname.split()[0]
-        # if '-' in org:
-        #     org = org[:org.rindex('-')]
-        parts = org.split('-')
-        if len(parts) < 3:
-            org = parts[0]
-        elif parts[1].isdigit() :
-            org = parts[0]
-        else:
-            org = parts[0] + '-' + parts[1] #+ '-' + parts[2]
 
-    # if org.startswith('AMAZO') or org.startswith('AT-'):
-    #     org = 'AMAZON'
-    if org.startswith('WEBAIRINTERNET12'):
-        org = 'WEBAIRINTERNET12'
+    _EMPTY = (float('inf'), 0, None)
 
-    return org
+    def __init__(self, window, orgs):
+        self.window = window
+        self.lock = Lock()
+        self.set_orgs(orgs)
 
+        window.add_listener(self._on_traffic)
 
-def _clean_netname(org_names, name, ip):
-    org = clean_netname(name)
-    if name in org_names:
-        return name
+    def set_orgs(self, orgs):
+        with self.lock:
+            self._orgs = list(orgs)
+            self._leaf_index = {}
+
+            size = 1
+            while size < len(self._orgs):
+                size *= 2
+            self._size = size
+            self._tree = [self._EMPTY] * (2 * size)
+
+            for i, org in enumerate(self._orgs):
+                self._leaf_index[org] = size + i
+            self._slot = None
+            self._turn = 0
+
+    def pick(self, skip_org=None):
+        """
+        Return the org with the least traffic, other than `skip_org`, or None if there is no org to pick
+        """
+        with self.lock:
+            self._refresh_if_expired()
 
-    return 'OTHER'
+            skipped = self._leaf_index.get(skip_org)
+            if skipped is not None:
+                skipped_entry = self._tree[skipped]
+                self._set(skipped, self._EMPTY)
 
+            org = self._tree[1][2]
 
-def _parse_dig(raw_dig):
-    import re
+            if skipped is not None:
+                self._set(skipped, skipped_entry)
 
-    if len(raw_dig.strip()) == 0:
-        return [], []
+            if org is not None:
+                self._turn += 1
+                leaf = self._leaf_index[org]
+                self._set(leaf, (self._tree[leaf][0], self._turn, org))
 
-    lines = raw_dig.strip().split('\n')
+            return org
 
-    ip = []
-    domains = []
-    for line in lines:
-        line = line.strip()
-        if re.match('^\d+[.]\d+[.]\d+[.]\d+$', line):
-            ip.append(line)
-        else:
-            domains.append(line)
+    def _on_traffic(self, org, size, value):
+        with self.lock:
+            if org is None:
+                # The window was reset
+                self._slot = None
+                return
+
+            leaf = self._leaf_index.get(org)
+            if leaf is not None and self._slot is not None:
+                self._set(leaf, (value, self._tree[leaf][1], org))
+
+    def _refresh_if_expired(self):
+        slot = int(time() / self.window.slot_width)
+        if slot == self._slot:
+            return
+
+        tree = self._tree
+        for org, leaf in self._leaf_index.items():
+            turn = tree[leaf][1] if tree[leaf][2] is not None else random()
+            tree[leaf] = (self.window[org], turn, org)
+        for node in range(self._size - 1, 0, -1):
+            tree[node] = min(tree[2 * node], tree[2 * node + 1])
+        self._slot = slot
+
+    def _set(self, leaf, entry):
+        tree = self._tree
+        tree[leaf] = entry
+        node = leaf // 2
+        while node:
+            tree[node] = min(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+
+
+class DecoyMaker(object):
+    def __init__(self, netstats, catalog):
+        self.netstats = netstats
+        self.catalog = catalog
+        self.selector = DecoySelector(netstats.requested_upstream_traffic, self._decoy_orgs(catalog))
+
+        self.inflight = 0
+
+    def set_catalog(self, catalog):
+        self.selector.set_orgs(self._decoy_orgs(catalog))
+        self.catalog = catalog
+
+    def get_decoy(self, skip_netname=None):
+        """
+        Pick a decoy URL, returns an (org, url, size) tuple or None if there is no suitable decoy.
+
+        Decoys go to the org with the least requested traffic. Within the org, URLs are picked with a probability
+        proportional to their size, so the overhead target is reached with fewer requests.
+        """
+        catalog = self.catalog
+
+        netname = self.selector.pick(skip_netname)
+        if netname is None or not catalog.count(netname):
+            return None
+
+        index = catalog.weighted_index(netname, random())
+        return netname, catalog.url(netname, index), catalog.size(netname, index)
+
+    def record_decoy_sent(self, flow, size):
+        flow.estimated_size = size
+        self.inflight += flow.estimated_size
+
+    def record_decoy_received(self, flow):
+        self.inflight -= flow.estimated_size
+
+    @staticmethod
+    def _decoy_orgs(catalog):
+        return [org for org in catalog.org_names if org != 'OTHER' and catalog.count(org)]
+
+
+class AdBlocker(object):
+    def __init__(self):
+        # (ad domains, blacklisted URLs), replaced as a whole when the lists are (re)loaded
+        self._lists = (DomainTrie(), URLGlobSet())
+
+    def should_block(self, flow):
+        request = flow.request
+        adset, blacklist = self._lists
+
+        # Only check suffixes with at least two labels, a bare TLD in the list shouldn't block everything
+        if adset.matches_suffix(request.host, min_labels=2):
+            return True
 
-    return ip, domains
+        url = request.url
+        scheme_end = url.find('://')
+        if scheme_end != -1:
+            url = url[scheme_end + 3:]
+        return blacklist.match(url)
 
+    def load_blacklist(self, ad_domains_path, blacklist_path):
+        adset = DomainTrie()
+        blacklist = URLGlobSet()
 
-def _dig(site, raw=False):
-    from subprocess import Popen, PIPE
-    process = Popen(["dig", "+short", site], stdout=PIPE)
-    (output, err) = process.communicate()
-    exit_code = process.wait()
+        with open(ad_domains_path) as f:
+            for ad in f:
+                ad = ad.strip()
+                if ad:
+                    adset.add(ad)
 
-    if raw:
-        return output
+        with open(blacklist_path) as f:
+            for dom in f:
+                dom = dom.strip()
+                if dom:
+                    blacklist.add(dom)
+
+        blacklist.compile()
+        self._lists = (adset, blacklist)
 
-    return _parse_dig(output)
+
+def merge_stats(stats):
+    """
+    Combine the `ScramblerPipe.get_stats()` of several workers
+    """
+    merged = sum_stats(stats)
+    if not stats:
+        return merged
+
+    # Settings are the same in every worker
+    merged['max_overhead'] = stats[0]['max_overhead']
+    merged['budget']['target_overhead'] = stats[0]['budget']['target_overhead']
+    merged['budget']['burst_overhead'] = stats[0]['budget']['burst_overhead']
+    merged['achieved_overhead'] = float(merged['downstream_overhead']) / merged['downstream_normal'] \
+        if merged['downstream_normal'] else 0.0
+    return merged
+
+
+def _get_flow_ip(flow, resolver):
+    if flow.server_conn and flow.server_conn.peer_address:
+        return flow.server_conn.peer_address.host
+
+    ips = resolver.resolve(flow.request.host)
+    if len(ips):
+        return ips[0]
+    return None
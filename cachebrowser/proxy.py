@@ -1,4 +1,8 @@
 import logging
+import time
+from functools import partial
+from threading import Thread
+from timeit import default_timer
 
 import mitmproxy.controller
 import mitmproxy.proxy
@@ -11,9 +15,13 @@ import mitmproxy as mproxy
 from mitmproxy.script import script
 from cachebrowser.models import Website
 from cachebrowser.pipes import SKIP_PIPES
+from cachebrowser.pipes.base import FlowPipe
+from cachebrowser.stats import LatencyHistogram
 
 logger = logging.getLogger(__name__)
 
+PIPE_STATS_CHANNEL = 'pipe-stats'
+
 
 class TlsLayer(mproxy.protocol.TlsLayer):
     @property
@@ -46,18 +54,120 @@ class ProxyConfig(mitmproxy.proxy.ProxyConfig):
         # return not website.enabled
 
 
+class HookStats(object):
+    """
+    Timing of one pipe's handler for one hook
+    """
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.skips = 0
+
+    def stats(self):
+        stats = self.latency.snapshot()
+        stats.update({
+            'calls': stats.pop('count'),
+            'errors': self.errors,
+            'skips': self.skips,
+        })
+        return stats
+
+    def dump(self):
+        return {
+            'latency': self.latency.dump(),
+            'errors': self.errors,
+            'skips': self.skips,
+        }
+
+    def merge(self, dump):
+        self.latency.merge(dump['latency'])
+        self.errors += dump['errors']
+        self.skips += dump['skips']
+
+
+def merge_pipe_stats(dumps):
+    """
+    Combine the `ProxyController.dump_pipe_stats()` of several workers into the `pipe_stats()` format
+    """
+    merged = {}
+    for dump in dumps:
+        for pipe_name, hook, hook_dump in dump:
+            hook_stats = merged.get((pipe_name, hook))
+            if hook_stats is None:
+                hook_stats = merged[(pipe_name, hook)] = HookStats()
+            hook_stats.merge(hook_dump)
+
+    stats = {}
+    for (pipe_name, hook), hook_stats in merged.items():
+        stats.setdefault(pipe_name, {})[hook] = hook_stats.stats()
+    return stats
+
+
 class ProxyController(mitmproxy.flow.FlowMaster):
-    def __init__(self, server, ipc, state=None):
+    def __init__(self, server, ipc, state=None, stats_interval=0, serve_stats=True):
+        """
+        :param stats_interval: publish the pipe statistics on the 'pipe-stats' channel every `stats_interval`
+            seconds (0 to only serve them through the '/pipes/stats' RPC)
+        :param serve_stats: False to neither serve nor publish the pipe statistics, for proxy workers whose
+            statistics are merged and served by the supervisor (see `cachebrowser.workers`)
+        """
         if state is None:
             state = mitmproxy.flow.State()
 
         mitmproxy.flow.FlowMaster.__init__(self, server, state)
 
         self.ipc = ipc
+        self.stats_interval = stats_interval if serve_stats else 0
+
+        # (pipe name, hook name) -> HookStats
+        self.hook_stats = {}
+        # hook name -> [(pipe, handler, stats)] for the enabled pipes which handle the hook, built on first use
+        self._dispatch = {}
+
+        if serve_stats:
+            ipc.register_rpc('/pipes/stats', self._get_pipe_stats)
 
     def add_pipe(self, pipe):
         pipe.set_master(self)
         self.scripts.append(pipe)
+        self.pipes_changed(pipe)
+
+    def pipes_changed(self, pipe=None):
+        """
+        Called when a pipe is added, enabled or disabled (from any thread, e.g. by an RPC handler), or `pipe` is
+        None when scripts are loaded or unloaded. The dispatch lists of the hooks the pipe handles are dropped on
+        the master thread, so a list being built there can't outlive the change, and built again on the next event.
+        """
+        self.call_in_master(self._drop_handlers, pipe)
+
+    def load_script(self, command, use_reloader=False):
+        error = mproxy.flow.FlowMaster.load_script(self, command, use_reloader)
+        self.pipes_changed()
+        return error
+
+    def unload_script(self, script_obj):
+        mproxy.flow.FlowMaster.unload_script(self, script_obj)
+        self.pipes_changed()
+
+    def _drop_handlers(self, pipe):
+        for name in list(self._dispatch):
+            if not isinstance(pipe, FlowPipe) or getattr(pipe, name, None) is not None:
+                self._dispatch.pop(name, None)
+
+    def call_in_master(self, func, *args, **kwargs):
+        """
+        Have `func` called on the master thread, where the pipe hooks run. Lets pipes' background threads
+        create and replay flows safely.
+        """
+        self.masterq.put(('callback', (func, args, kwargs)))
+
+    def handle_callback(self, callback):
+        func, args, kwargs = callback
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Callback {} failed".format(func))
 
     def handle_serverconnect(self, server_conn):
         # server_conn.__class__ = ServerConnection
@@ -102,22 +212,81 @@ class ProxyController(mitmproxy.flow.FlowMaster):
         # logger.log(logging.DEBUG, e)
 
     def run(self):
+        if self.stats_interval:
+            publisher = Thread(target=self._publish_pipe_stats)
+            publisher.daemon = True
+            publisher.start()
+
         self.run_script_hook('start')
         super(ProxyController, self).run()
 
-    def _run_single_script_hook(self, script_obj, name, *args, **kwargs):
-        if script_obj and not self.pause_scripts:
+    def pipe_stats(self):
+        stats = {}
+        for (pipe_name, hook), hook_stats in list(self.hook_stats.items()):
+            stats.setdefault(pipe_name, {})[hook] = hook_stats.stats()
+        return stats
+
+    def dump_pipe_stats(self):
+        """
+        The pipe statistics in a form `merge_pipe_stats` can combine with those of other workers
+        """
+        return [[pipe_name, hook, hook_stats.dump()] for (pipe_name, hook), hook_stats in list(self.hook_stats.items())]
+
+    def _get_pipe_stats(self, context, request):
+        request.reply(self.pipe_stats())
+
+    def _publish_pipe_stats(self):
+        while True:
+            time.sleep(self.stats_interval)
+            if self.ipc.has_subscribers(PIPE_STATS_CHANNEL):
+                self.ipc.publish(PIPE_STATS_CHANNEL, self.pipe_stats())
+
+    def run_script_hook(self, name, *args, **kwargs):
+        if self.pause_scripts:
+            return
+
+        for pipe, handler, stats in self._handlers(name):
+            start = default_timer()
             try:
-                return script_obj.run(name, *args, **kwargs)
+                result = handler(*args, **kwargs)
             except script.ScriptException as e:
+                stats.errors += 1
                 self.add_event("Script error:\n" + str(e), "error")
+                continue
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                stats.latency.record(default_timer() - start)
 
-    def run_script_hook(self, name, *args, **kwargs):
-        for script_obj in self.scripts:
-            result = self._run_single_script_hook(script_obj, name, *args, **kwargs)
             if result == SKIP_PIPES:
+                stats.skips += 1
                 break
 
+    def _handlers(self, name):
+        handlers = self._dispatch.get(name)
+        if handlers is not None:
+            return handlers
+
+        handlers = []
+        for pipe in self.scripts:
+            if isinstance(pipe, FlowPipe):
+                handler = getattr(pipe, name, None)
+                if handler is None or not pipe.enabled:
+                    continue
+            else:
+                # Scripts loaded by mitmproxy itself resolve their hooks on every call
+                handler = partial(pipe.run, name)
+
+            key = (pipe.__class__.__name__, name)
+            stats = self.hook_stats.get(key)
+            if stats is None:
+                stats = self.hook_stats[key] = HookStats()
+            handlers.append((pipe, handler, stats))
+
+        self._dispatch[name] = handlers
+        return handlers
+
 
 class DumpProxyController(mitmproxy.dump.DumpMaster):
     def __init__(self, server):
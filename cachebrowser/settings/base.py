@@ -24,11 +24,88 @@ class CacheBrowserSettings(object):
         self.host = None
         self.port = None
         self.ipc_port = None
+        # Proxy worker processes, each handling connections from the shared proxy port
+        self.workers = 1
+        # Published messages waiting for a slow IPC client before `ipc_slow_client_policy` kicks in,
+        # which is one of 'drop', 'coalesce' (keep the latest message per channel) or 'disconnect'
+        self.ipc_high_water_mark = 1000
+        self.ipc_slow_client_policy = 'drop'
+        # Clients using a binary encoding with compression get frames of at least this many bytes compressed
+        self.ipc_compress_threshold = 1024
+        # Seconds before a pending RPC request is answered with a timeout error, and threads for blocking handlers
+        self.ipc_rpc_timeout = 30
+        self.ipc_rpc_workers = 4
         self.database = None
+        # Applied to every database connection, see https://www.sqlite.org/pragma.html
+        self.database_pragmas = {
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'mmap_size': 64 * 1024 * 1024,
+            'cache_size': -8000,  # in KiB when negative
+        }
+        # Group bootstrap-driven inserts into one transaction per batch, written from a background thread
+        self.database_write_behind = True
+        self.database_write_batch_size = 200
+        self.database_write_interval = 0.1
         self.bootstrap_sources = []
+        # Defaults for remote bootstrap sources, may be overridden per source with 'timeout' and 'cache_ttl'
+        self.bootstrap_timeout = 5
+        self.bootstrap_cache_ttl = 600
+        # 'sequential' asks the sources one after the other, 'parallel' asks them all at once and prefers the
+        # answer of an earlier source if it arrives within `bootstrap_grace_period` seconds of the first answer
+        self.bootstrap_lookup_mode = 'sequential'
+        self.bootstrap_grace_period = 0.05
+        # Skip a source for `bootstrap_breaker_reset` seconds after `bootstrap_breaker_threshold` failures in a row
+        self.bootstrap_breaker_threshold = 3
+        self.bootstrap_breaker_reset = 30
+        # Bootstrap hosts referenced by HTML/CSS responses before the browser connects to them
+        self.prefetch_hosts = True
 
         self.default_sni_policy = "original"
 
+        # Reload local bootstrap files and the scrambler's data files when they change, checking every
+        # `watch_interval` seconds
+        self.watch_files = True
+        self.watch_interval = 2.0
+
+        # Seconds between publishes of the pipes' timing statistics on the 'pipe-stats' channel (0 to disable)
+        self.pipe_stats_interval = 10
+
+        # How request logs are published to IPC clients, 'immediate' (one message per record) or 'batched'
+        self.publisher_mode = 'immediate'
+        self.publisher_batch_size = 100
+        self.publisher_flush_interval = 0.25
+        # Records kept while waiting for a flush, the overflow policy is either 'drop_oldest' or 'sample'
+        self.publisher_buffer_size = 5000
+        self.publisher_overflow_policy = 'drop_oldest'
+
+        # Resolved-host cache used by the resolver pipe (sizes in entries, TTLs in seconds)
+        self.host_cache_size = 4096
+        self.host_cache_ttl = 600
+        self.host_cache_negative_ttl = 60
+
+        # Organization lookups for the scrambler, cached per network for `whois_cache_ttl` seconds
+        self.whois_cache_ttl = 7 * 24 * 3600
+        self.whois_workers = 4
+
+        # Decoy traffic the scrambler aims for, as a ratio of the traffic requested from each organization. Up to
+        # `scrambler_burst_overhead` times the organization's recent traffic may be sent at once, decoys are
+        # released every `scrambler_schedule_interval` seconds
+        self.scrambler_overhead = 0.1
+        self.scrambler_burst_overhead = 0.5
+        self.scrambler_schedule_interval = 0.05
+        # Decoys in flight at once, overall and per organization, and decoys waiting for their turn
+        self.scrambler_max_concurrent_decoys = 8
+        self.scrambler_max_decoys_per_org = 2
+        self.scrambler_decoy_queue_size = 64
+
+        # Nameserver used to resolve hostnames in-process (None to use the system's first nameserver), lookups run
+        # in a pool of `dns_workers` threads
+        self.dns_nameserver = None
+        self.dns_port = 53
+        self.dns_timeout = 2.0
+        self.dns_workers = 2
+
         self.set_defaults()
 
     def set_defaults(self):
@@ -71,6 +148,52 @@ class CacheBrowserSettings(object):
             raise SettingsValidationError(
                 "invalid default sni policy '{}".format(self.default_sni_policy))
 
+        if self.bootstrap_lookup_mode not in ['sequential', 'parallel']:
+            raise SettingsValidationError(
+                "invalid bootstrap lookup mode '{}'".format(self.bootstrap_lookup_mode))
+
+        if type(self.workers) != int or self.workers < 1:
+            raise SettingsValidationError(
+                "invalid number of workers '{}'".format(self.workers))
+
+        if self.ipc_slow_client_policy not in ['drop', 'coalesce', 'disconnect']:
+            raise SettingsValidationError(
+                "invalid ipc slow client policy '{}'".format(self.ipc_slow_client_policy))
+
+        if self.watch_interval <= 0:
+            raise SettingsValidationError(
+                "invalid watch interval '{}'".format(self.watch_interval))
+
+        if self.pipe_stats_interval < 0:
+            raise SettingsValidationError(
+                "invalid pipe stats interval '{}'".format(self.pipe_stats_interval))
+
+        if self.publisher_mode not in ['immediate', 'batched']:
+            raise SettingsValidationError(
+                "invalid publisher mode '{}'".format(self.publisher_mode))
+
+        if self.publisher_overflow_policy not in ['drop_oldest', 'sample']:
+            raise SettingsValidationError(
+                "invalid publisher overflow policy '{}'".format(self.publisher_overflow_policy))
+
+        if type(self.host_cache_size) != int or self.host_cache_size <= 0:
+            raise SettingsValidationError(
+                "invalid host cache size '{}'".format(self.host_cache_size))
+
+        if not 0 <= self.scrambler_overhead <= self.scrambler_burst_overhead:
+            raise SettingsValidationError(
+                "invalid scrambler overhead '{}', it should be between 0 and the burst overhead ({})".format(
+                    self.scrambler_overhead, self.scrambler_burst_overhead))
+
+        if self.scrambler_schedule_interval <= 0:
+            raise SettingsValidationError(
+                "invalid scrambler schedule interval '{}'".format(self.scrambler_schedule_interval))
+
+        for name in ['scrambler_max_concurrent_decoys', 'scrambler_max_decoys_per_org', 'scrambler_decoy_queue_size']:
+            if type(getattr(self, name)) != int or getattr(self, name) < 1:
+                raise SettingsValidationError(
+                    "invalid value for '{}': '{}'".format(name, getattr(self, name)))
+
     def update_with_settings_file(self, config_file):
         if not config_file:
             return
@@ -87,8 +210,49 @@ class CacheBrowserSettings(object):
         update('port')
         update_path('database')
         update('default_sni_policy', 'sni_policy')
+        update('workers')
+        update('ipc_high_water_mark')
+        update('ipc_slow_client_policy')
+        update('ipc_compress_threshold')
+        update('ipc_rpc_timeout')
+        update('ipc_rpc_workers')
+        update('database_write_behind')
+        update('database_write_batch_size')
+        update('database_write_interval')
+        update('bootstrap_timeout')
+        update('bootstrap_cache_ttl')
+        update('bootstrap_lookup_mode')
+        update('bootstrap_grace_period')
+        update('bootstrap_breaker_threshold')
+        update('bootstrap_breaker_reset')
+        update('prefetch_hosts')
+        update('watch_files')
+        update('watch_interval')
+        update('pipe_stats_interval')
+        update('publisher_mode')
+        update('publisher_batch_size')
+        update('publisher_flush_interval')
+        update('publisher_buffer_size')
+        update('publisher_overflow_policy')
+        update('host_cache_size')
+        update('host_cache_ttl')
+        update('host_cache_negative_ttl')
+        update('whois_cache_ttl')
+        update('whois_workers')
+        update('scrambler_overhead')
+        update('scrambler_burst_overhead')
+        update('scrambler_schedule_interval')
+        update('scrambler_max_concurrent_decoys')
+        update('scrambler_max_decoys_per_org')
+        update('scrambler_decoy_queue_size')
+        update('dns_nameserver')
+        update('dns_port')
+        update('dns_timeout')
+        update('dns_workers')
 
         self._update_bootstrap_sources(config.pop('bootstrap_sources', None))
+        # Pragmas given in the config file are merged into the defaults (a value of null removes a default)
+        self._update_database_pragmas(config.pop('database_pragmas', None))
 
         if config:
             raise SettingsValidationError(
@@ -103,6 +267,7 @@ class CacheBrowserSettings(object):
         update('port')
         update('database')
         update('default_sni_policy', 'sni')
+        update('workers')
 
     def _update_arg(self, conf, param, confparam=None):
         value = conf.pop((confparam or param).lower(), None)
@@ -116,6 +281,19 @@ class CacheBrowserSettings(object):
                 value = self.data_path(value)
             setattr(self, param, value)
 
+    def _update_database_pragmas(self, pragmas):
+        if pragmas is None:
+            return
+
+        if not isinstance(pragmas, dict):
+            raise SettingsValidationError("'database_pragmas' should be a mapping of pragma names to values")
+
+        for name, value in pragmas.items():
+            if value is None:
+                self.database_pragmas.pop(name, None)
+            else:
+                self.database_pragmas[name] = value
+
     def _update_bootstrap_sources(self, bootstrap_sources):
         if bootstrap_sources is None:
             return
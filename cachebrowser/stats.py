@@ -0,0 +1,198 @@
+import time
+from array import array
+from threading import Lock
+
+
+class SlidingWindowCounter(object):
+    """
+    Sum of the values added over the last `window` seconds.
+
+    The window is split into a fixed number of time slots held in a ring buffer. A running total is kept up to
+    date as values are added and as whole slots fall out of the window, so adding and reading are both O(1)
+    (amortized over the number of slots). Expiry has the granularity of one slot, i.e. `window / slots` seconds.
+
+    Not thread-safe, callers are expected to hold their own lock.
+    """
+
+    def __init__(self, window, slots=10, clock=time.time):
+        self.window = window
+        self.slot_width = float(window) / slots
+        self.clock = clock
+
+        self._slots = array('d', [0.0]) * slots
+        self._head = int(clock() / self.slot_width)
+        self._total = 0.0
+
+    def add(self, value, now=None):
+        self._advance(self.clock() if now is None else now)
+        self._slots[self._head % len(self._slots)] += value
+        self._total += value
+
+    def value(self, now=None):
+        self._advance(self.clock() if now is None else now)
+        return self._total
+
+    def reset(self):
+        for i in range(len(self._slots)):
+            self._slots[i] = 0.0
+        self._total = 0.0
+
+    def _advance(self, now):
+        current = int(now / self.slot_width)
+        steps = current - self._head
+        if steps <= 0:
+            return
+
+        num_slots = len(self._slots)
+        if steps >= num_slots:
+            self.reset()
+        else:
+            for i in range(self._head + 1, current + 1):
+                index = i % num_slots
+                self._total -= self._slots[index]
+                self._slots[index] = 0.0
+
+            # Guard against floating point drift once everything has expired
+            if self._total < 0:
+                self._total = 0.0
+
+        self._head = current
+
+
+class LatencyHistogram(object):
+    """
+    A compact HDR-style latency histogram.
+
+    Latencies are recorded in microseconds into log-linear buckets: every power of two range is split into
+    `SUB_BUCKETS` linear buckets, so any recorded value is reported with a relative error below 1/SUB_BUCKETS
+    while the whole range up to `max_seconds` only needs a few hundred counters. Recording is O(1).
+    """
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self, max_seconds=60):
+        self.max_value = int(max_seconds * 1000000)
+        self._counts = [0] * (self._index(self.max_value) + 1)
+        self._lock = Lock()
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def _index(cls, value):
+        if value < 2 * cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return (shift + 1) * cls.SUB_BUCKETS + (value >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def _value_at(cls, index):
+        """
+        Upper bound of the values which fall into bucket `index`
+        """
+        if index < 2 * cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.SUB_BUCKETS - 1
+        sub_bucket = index % cls.SUB_BUCKETS + cls.SUB_BUCKETS
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = min(max(int(seconds * 1000000), 0), self.max_value)
+        with self._lock:
+            self._counts[self._index(value)] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, percentile):
+        """
+        Return the given percentile (0-100) in seconds, or None if nothing was recorded
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            target = max(1, int(round(self.count * percentile / 100.0)))
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= target:
+                    return min(self._value_at(index), self.max) / 1000000.0
+            return self.max / 1000000.0
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * len(self._counts)
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = None
+
+    def dump(self):
+        """
+        The recorded latencies in a JSON-serializable form, for `merge` in another process
+        """
+        with self._lock:
+            return {
+                'counts': [[index, count] for index, count in enumerate(self._counts) if count],
+                'count': self.count,
+                'total': self.total,
+                'min': self.min,
+                'max': self.max,
+            }
+
+    def merge(self, dump):
+        """
+        Add the latencies of another histogram's `dump()` to this one
+        """
+        with self._lock:
+            for index, count in dump['counts']:
+                self._counts[min(index, len(self._counts) - 1)] += count
+            self.count += dump['count']
+            self.total += dump['total']
+            if dump['min'] is not None and (self.min is None or dump['min'] < self.min):
+                self.min = dump['min']
+            if dump['max'] is not None and (self.max is None or dump['max'] > self.max):
+                self.max = dump['max']
+
+    def snapshot(self):
+        """
+        Summary of the recorded latencies, in milliseconds
+        """
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+
+        return {
+            'count': self.count,
+            'mean_ms': ms(self.total / 1000000.0 / self.count) if self.count else None,
+            'min_ms': ms(self.min / 1000000.0) if self.min is not None else None,
+            'p50_ms': ms(self.percentile(50)),
+            'p90_ms': ms(self.percentile(90)),
+            'p99_ms': ms(self.percentile(99)),
+            'max_ms': ms(self.max / 1000000.0) if self.max is not None else None,
+        }
+
+
+def sum_stats(reports):
+    """
+    Add up statistics dicts of the same shape (e.g. one per worker process). Numbers are summed, nested dicts are
+    added up recursively and other values are taken from the first report.
+    """
+    if not reports:
+        return {}
+
+    total = {}
+    for key, value in reports[0].items():
+        values = [report[key] for report in reports if key in report]
+        if isinstance(value, dict):
+            total[key] = sum_stats(values)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = sum(v for v in values if v is not None)
+        else:
+            total[key] = value
+    return total
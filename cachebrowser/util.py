@@ -2,34 +2,80 @@ import os
 import importlib
 import inspect
 
-def get_flow_size(flow, ):
+def request_size(flow):
     """
-    (Not accurate)
+    Size of the flow's request on the wire: request line, headers and body.
+
+    Computed once per request and cached on the flow.
+    """
+    request = flow.request
+    if request is None:
+        return 0
+
+    cached = getattr(flow, '_request_size', None)
+    if cached is not None and cached[0] is request:
+        return cached[1]
+
+    # "GET /path HTTP/1.1\r\n"
+    size = len(request.method) + len(request.path) + len(request.http_version) + 4
+    size += _headers_size(request.headers) + _body_size(request)
+
+    flow._request_size = (request, size)
+    return size
+
+
+def response_size(flow):
     """
-    def get_size(r):
-        s = len(r.content)
-        for header in r.headers:
-            s += len(header)
-            s += len(r.headers[header])
-            # Colon
-            s += 1
-        s += len(r.http_version)
-        # New lines
-        s += 2
-        return s
-
-    if flow.request:
-        req = get_size(flow.request) + len(flow.request.path) + len(flow.request.method)
-    else:
-        req = 0
-
-    if flow.response:
-        # status code
-        resp = get_size(flow.response) + len(flow.response.reason) + 3
-    else:
-        resp = 0
-
-    return req, resp
+    Size of the flow's response on the wire: status line, headers and body, 0 if there is no response yet.
+
+    Computed once per response and cached on the flow.
+    """
+    response = flow.response
+    if response is None:
+        return 0
+
+    cached = getattr(flow, '_response_size', None)
+    if cached is not None and cached[0] is response:
+        return cached[1]
+
+    # "HTTP/1.1 200 OK\r\n"
+    size = len(response.http_version) + len(response.reason) + 7
+    size += _headers_size(response.headers)
+    # These have no body, whatever their Content-Length says
+    if not (response.status_code < 200 or response.status_code in (204, 304) or
+            (flow.request is not None and flow.request.method == 'HEAD')):
+        size += _body_size(response)
+
+    flow._response_size = (response, size)
+    return size
+
+
+def get_flow_size(flow):
+    return request_size(flow), response_size(flow)
+
+
+def _headers_size(headers):
+    # "Name: value\r\n" for every header, then an empty line
+    size = 2
+    for name, value in headers.fields:
+        size += len(name) + len(value) + 4
+    return size
+
+
+def _body_size(message):
+    # Prefer Content-Length over measuring the body, which may not have been read or may be decoded
+    content_length = message.headers.get('content-length')
+    if content_length:
+        try:
+            return int(content_length)
+        except ValueError:
+            pass
+
+    # Newer netlib decodes `content` on access, only fall back to it if there is no `raw_content`
+    content = getattr(message, 'raw_content', None)
+    if content is None:
+        content = message.content
+    return len(content) if content else 0
 
 
 def pretty_bytes(num, suffix='B'):
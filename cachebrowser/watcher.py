@@ -0,0 +1,103 @@
+"""
+Reloads data files (local bootstrap sources, the scrambler's ad lists and decoys) when they change on disk.
+
+Files are polled: every `interval` seconds the modification time and size of each watched file is compared to
+what was seen before. When any file of a watch has changed, and has stayed the same since the previous poll (so
+a file which is still being written isn't picked up half-way), its callback is called on the watcher thread. Callbacks
+build their new indexes there and swap them in with a single assignment, so lookups on the proxy thread keep
+using the old index until the new one is complete and never wait for a reload.
+
+A file which disappears (e.g. while an editor replaces it) isn't reported until it's back.
+"""
+import logging
+import os
+from threading import Event, Lock, Thread
+
+import six
+
+logger = logging.getLogger(__name__)
+
+
+class FileWatcher(object):
+    def __init__(self, interval=2.0):
+        self.interval = interval
+
+        # [(paths, callback, {path: (mtime, size) last reloaded}, {path: (mtime, size) seen on the last poll})]
+        self._watches = []
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+        self.reloads = 0
+        self.failures = 0
+
+    def watch(self, paths, callback):
+        """
+        Call `callback()` whenever one of `paths` changes
+        """
+        if isinstance(paths, six.string_types):
+            paths = [paths]
+        paths = list(paths)
+
+        with self._lock:
+            stats = dict((path, _stat(path)) for path in paths)
+            self._watches.append((paths, callback, stats, dict(stats)))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def check(self):
+        """
+        Look for changes once and run the callbacks of the changed files
+        """
+        with self._lock:
+            watches = list(self._watches)
+
+        for paths, callback, loaded, polled in watches:
+            changed = []
+            settling = False
+            for path in paths:
+                current = _stat(path)
+                previous, polled[path] = polled.get(path), current
+                if current is None or current == loaded.get(path):
+                    continue
+                if current != previous:
+                    settling = True
+                changed.append(path)
+
+            if not changed or settling:
+                continue
+
+            for path in changed:
+                loaded[path] = polled[path]
+
+            logger.info("Reloading {}".format(', '.join(changed)))
+            try:
+                callback()
+                self.reloads += 1
+            except Exception:
+                self.failures += 1
+                logger.exception("Reloading {} failed, keeping the previous data".format(', '.join(changed)))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
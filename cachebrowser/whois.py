@@ -0,0 +1,240 @@
+import logging
+from time import time
+from threading import Lock
+
+import ipaddress
+import six
+from concurrent.futures import ThreadPoolExecutor
+
+from cachebrowser.models import WhoisNetwork
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_ORG = 'OTHER'
+
+
+class WhoisClassifier(object):
+    """
+    Classifies IP addresses into the organizations (CDNs, hosting providers, ...) that own them.
+
+    Lookups are cached per announced network rather than per address: a single RDAP answer covers every
+    address in the returned CIDR blocks. Cached networks are persisted in the database and reloaded on
+    startup, so a restart doesn't trigger a new round of lookups.
+
+    `classify` never blocks: addresses which aren't covered by a cached network are queued for lookup in a
+    worker pool and reported as 'OTHER' until their lookup completes.
+    """
+
+    # Failed lookups are only remembered in memory, and only for a short while
+    FAILURE_TTL = 3600
+
+    def __init__(self, org_names, ttl=7 * 24 * 3600, workers=4, persist=True, writer=None):
+        self.org_names = set(org_names)
+        self.ttl = ttl
+        self.persist = persist
+        self.writer = writer
+
+        # {(ip version, prefix length): {network address as int: (org, expires)}}
+        self._networks = {}
+        # Known prefix lengths per ip version, longest first
+        self._prefixes = {4: [], 6: []}
+        self._pending = set()
+        self._lock = Lock()
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.lookups = 0
+        self.failures = 0
+
+        if self.persist:
+            self._load()
+
+    def classify(self, ip):
+        if ip is None:
+            return UNKNOWN_ORG
+
+        try:
+            address = ipaddress.ip_address(six.text_type(ip))
+        except ValueError:
+            return UNKNOWN_ORG
+
+        org = self._find(address)
+        if org is not None:
+            return org
+
+        with self._lock:
+            if address in self._pending:
+                return UNKNOWN_ORG
+            self._pending.add(address)
+
+        self._executor.submit(self._lookup, address)
+        return UNKNOWN_ORG
+
+    def stats(self):
+        with self._lock:
+            networks = sum(len(networks) for networks in self._networks.values())
+            pending = len(self._pending)
+        return {
+            'networks': networks,
+            'pending': pending,
+            'lookups': self.lookups,
+            'failures': self.failures,
+        }
+
+    def _find(self, address):
+        version = address.version
+        value = int(address)
+        now = time()
+
+        for prefixlen in self._prefixes[version]:
+            shift = address.max_prefixlen - prefixlen
+            entry = self._networks[(version, prefixlen)].get(value >> shift << shift)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+        return None
+
+    def _add_network(self, network, org, expires):
+        key = (network.version, network.prefixlen)
+        with self._lock:
+            if key not in self._networks:
+                self._networks[key] = {}
+                # Swap in a new list so `_find` can iterate the old one without holding the lock
+                self._prefixes[network.version] = sorted(self._prefixes[network.version] + [network.prefixlen],
+                                                         reverse=True)
+            self._networks[key][int(network.network_address)] = (org, expires)
+
+    def _lookup(self, address):
+        try:
+            org, networks = self._query(address)
+        except Exception:
+            logger.debug("WHOIS lookup for {} failed".format(address), exc_info=True)
+            self.failures += 1
+            org, networks = UNKNOWN_ORG, None
+
+        self.lookups += 1
+
+        if networks:
+            expires = time() + self.ttl
+            for network in networks:
+                self._add_network(network, org, expires)
+                if self.persist:
+                    self._save(network, org, expires)
+        else:
+            single = ipaddress.ip_network(address)
+            self._add_network(single, org, time() + self.FAILURE_TTL)
+
+        with self._lock:
+            self._pending.discard(address)
+
+    def _query(self, address):
+        from ipwhois import IPWhois
+
+        whois = IPWhois(str(address))
+        result = whois.lookup_rdap()
+        network = result.get('network') or {}
+
+        name = network.get('name')
+        if not name:
+            name = whois.lookup()['nets'][0]['name']
+
+        networks = []
+        for cidr in (network.get('cidr') or '').split(','):
+            cidr = cidr.strip()
+            if cidr:
+                networks.append(ipaddress.ip_network(six.text_type(cidr), strict=False))
+
+        if not any(address in n for n in networks):
+            networks.append(ipaddress.ip_network(address))
+
+        return _clean_netname(self.org_names, name), networks
+
+    def _load(self):
+        now = time()
+        count = 0
+        for entry in WhoisNetwork.select().where(WhoisNetwork.expires > now):
+            if entry.org not in self.org_names:
+                # Saved with another list of decoy orgs, look the network up again
+                continue
+            try:
+                network = ipaddress.ip_network(six.text_type(entry.cidr))
+            except ValueError:
+                continue
+            self._add_network(network, entry.org, entry.expires)
+            count += 1
+
+        WhoisNetwork.delete().where(WhoisNetwork.expires <= now).execute()
+        logger.debug("Loaded {} cached WHOIS networks".format(count))
+
+    def _save(self, network, org, expires):
+        query = WhoisNetwork.insert(cidr=str(network), org=org, expires=expires).upsert()
+        if self.writer is not None:
+            self.writer.put(query.execute)
+            return
+
+        try:
+            query.execute()
+        except Exception:
+            logger.warning("Failed to persist WHOIS network {}".format(network), exc_info=True)
+
+
+def clean_netname(netname):
+    """
+    Convert a whois netname into an organization name
+    """
+    # from cdn import cdn_list
+
+    ORGS = [
+        ('GOOGLE', ['google']),
+        ('AKAMAI', ['akamai', 'umass']),
+        ('AMAZON', ['at-', 'amazo']),
+        # ('CLOUDFRONT', []),
+        ('FASTLY', ['fastly']),
+        ('CLOUDFLARE', ['cloudflare']),
+        ('EDGECAST', ['edgecast']),
+        ('HIGHWINDS', ['highwind']),
+        ('INCAPSULA', ['incapsula']),
+        ('MAXCDN', ['netdna']),
+        ('CDNET', ['cdnet']),
+        ('TWITTER', ['twitter']),
+        ('INAP', ['inap-']),
+        ('LINODE', ['linode']),
+        ('DIGITALOCEAN', ['digitalocean']),
+        ('YAHOO', ['yahoo']),
+        ('FACEBOOK', ['facebook', 'ord1', 'tfbnet']),
+
+        ('OTHER', [])
+    ]
+    if ' ' in netname:
+        netname = netname.split()[0]
+
+    lower = netname.lower()
+    for org in ORGS:
+        if any([x in lower for x in org[1]]):
+            return org[0]
+
+    else:
+        org = netname.split()[0]
+        # if '-' in org:
+        #     org = org[:org.rindex('-')]
+        parts = org.split('-')
+        if len(parts) < 3:
+            org = parts[0]
+        elif parts[1].isdigit() :
+            org = parts[0]
+        else:
+            org = parts[0] + '-' + parts[1] #+ '-' + parts[2]
+
+    # if org.startswith('AMAZO') or org.startswith('AT-'):
+    #     org = 'AMAZON'
+    if org.startswith('WEBAIRINTERNET12'):
+        org = 'WEBAIRINTERNET12'
+
+    return org
+
+
+def _clean_netname(org_names, name):
+    org = clean_netname(name)
+    if name in org_names:
+        return name
+
+    return UNKNOWN_ORG
@@ -0,0 +1,264 @@
+"""
+Multi-process mode (`--workers N`).
+
+The supervisor process binds the proxy port and then forks N worker processes, which each run a complete proxy
+(a ProxyController with all the pipes) accepting connections on the inherited listening socket. This spreads TLS
+interception over N cores.
+
+The supervisor runs the IPC server: UI clients connect to it as usual, and each worker connects to it as an IPC
+client (see `IPCWorkerClient`) to publish its request logs and to serve the RPC methods its pipes register.
+Requests for a method registered by all workers are sent to all of them, so e.g. scrambler settings changes
+reach every worker. The API routes themselves are served by the supervisor.
+
+Bootstrapped hosts are shared through the database. Every worker keeps its own host cache, the supervisor
+invalidates them by publishing on `HOST_CACHE_CHANNEL` and sums up the statistics they report on
+`HOST_CACHE_STATS_CHANNEL`.
+
+Pipe statistics (hook timings and the scrambler's statistics) are reported by the workers on
+`PIPE_STATS_REPORT_CHANNEL` in the same way. The supervisor merges them and serves the result through
+'/pipes/stats', the 'pipe-stats' channel and '/scrambler/stats', the workers don't serve their own.
+"""
+import copy
+import logging
+import os
+import signal
+import time
+from threading import Thread
+
+from cachebrowser.api.routes import routes as api_routes
+from cachebrowser.cache import TTLCache
+from cachebrowser.ipc import IPCManager, IPCWorkerClient
+from cachebrowser.models import db
+from cachebrowser.pipes import scrambler
+from cachebrowser.proxy import PIPE_STATS_CHANNEL, merge_pipe_stats
+
+logger = logging.getLogger(__name__)
+
+HOST_CACHE_CHANNEL = '_workers/host-cache'
+HOST_CACHE_STATS_CHANNEL = '_workers/host-cache/stats'
+PIPE_STATS_REPORT_CHANNEL = '_workers/pipe-stats'
+
+
+class WorkerHostCaches(object):
+    """
+    Takes the place of the host cache in the supervisor's context, so the API handlers can keep calling
+    `invalidate`, `clear` and `stats` on it
+    """
+
+    def __init__(self, ipc):
+        self.ipc = ipc
+        self._reports = {}
+        ipc.subscribe(HOST_CACHE_STATS_CHANNEL, self._on_report)
+
+    def invalidate(self, key):
+        self.ipc.publish(HOST_CACHE_CHANNEL, {'invalidate': key})
+
+    def clear(self):
+        self.ipc.publish(HOST_CACHE_CHANNEL, {'clear': True})
+
+    def stats(self):
+        totals = {}
+        for report in list(self._reports.values()):
+            for key, value in report.items():
+                totals[key] = totals.get(key, 0) + value
+        totals['workers'] = len(self._reports)
+        return totals
+
+    def _on_report(self, channel, message):
+        self._reports[message['worker']] = message['stats']
+
+
+def share_host_cache(ipc, host_cache, worker_index, report_interval=5):
+    """
+    Apply the supervisor's invalidations to a worker's host cache and report its statistics periodically
+    """
+    def on_message(channel, message):
+        if message.get('clear'):
+            host_cache.clear()
+        elif 'invalidate' in message:
+            host_cache.invalidate(message['invalidate'])
+
+    def report():
+        while True:
+            ipc.publish(HOST_CACHE_STATS_CHANNEL, {'worker': worker_index, 'stats': host_cache.stats()})
+            time.sleep(report_interval)
+
+    ipc.subscribe(HOST_CACHE_CHANNEL, on_message)
+
+    reporter = Thread(target=report)
+    reporter.daemon = True
+    reporter.start()
+
+
+class WorkerPipeStats(object):
+    """
+    Serves the pipe statistics of all workers, merged, in place of a single ProxyController and ScramblerPipe
+    """
+
+    def __init__(self, ipc, publish_interval=0):
+        self.ipc = ipc
+        self.publish_interval = publish_interval
+        self._reports = {}
+
+        ipc.subscribe(PIPE_STATS_REPORT_CHANNEL, self._on_report)
+        ipc.register_rpc('/pipes/stats', self._get_pipe_stats)
+        ipc.register_rpc('/scrambler/stats', self._get_scrambler_stats)
+
+        if publish_interval:
+            publisher = Thread(target=self._publish)
+            publisher.daemon = True
+            publisher.start()
+
+    def stats(self):
+        return merge_pipe_stats([report['hooks'] for report in list(self._reports.values())])
+
+    def scrambler_stats(self):
+        return scrambler.merge_stats([report['scrambler'] for report in list(self._reports.values())
+                                      if report.get('scrambler') is not None])
+
+    def _on_report(self, channel, message):
+        self._reports[message['worker']] = message
+
+    def _get_pipe_stats(self, context, request):
+        request.reply(self.stats())
+
+    def _get_scrambler_stats(self, context, request):
+        request.reply(self.scrambler_stats())
+
+    def _publish(self):
+        while True:
+            time.sleep(self.publish_interval)
+            if self.ipc.has_subscribers(PIPE_STATS_CHANNEL):
+                self.ipc.publish(PIPE_STATS_CHANNEL, self.stats())
+
+
+def share_pipe_stats(ipc, controller, worker_index, report_interval=5):
+    """
+    Report a worker's pipe statistics to the supervisor periodically
+    """
+    scrambler_pipe = next((pipe for pipe in controller.scripts if isinstance(pipe, scrambler.ScramblerPipe)), None)
+
+    def report():
+        while True:
+            ipc.publish(PIPE_STATS_REPORT_CHANNEL, {
+                'worker': worker_index,
+                'hooks': controller.dump_pipe_stats(),
+                'scrambler': scrambler_pipe.get_stats() if scrambler_pipe is not None else None,
+            })
+            time.sleep(report_interval)
+
+    reporter = Thread(target=report)
+    reporter.daemon = True
+    reporter.start()
+
+
+class Supervisor(object):
+    # Seconds to wait before restarting a worker which exited
+    RESTART_DELAY = 1
+
+    def __init__(self, context, num_workers, run_worker):
+        """
+        :param run_worker: called with the worker's index in each forked worker process, runs the proxy
+        """
+        self.context = context
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+
+        self.workers = {}
+        self._stopping = False
+        self.ipc = None
+        self.pipe_stats = None
+
+    def run(self):
+        for index in range(self.num_workers):
+            self._spawn(index)
+
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self._start_ipc()
+
+        try:
+            while self.workers:
+                pid, status = os.wait()
+                index = self.workers.pop(pid, None)
+                if index is None or self._stopping:
+                    continue
+
+                logger.warning("Worker {} (pid {}) exited with status {}, restarting it".format(index, pid, status))
+                time.sleep(self.RESTART_DELAY)
+                self._spawn(index)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self):
+        self._stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        for pid in list(self.workers):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = {}
+
+    def _start_ipc(self):
+        # The API handlers get a context of their own. Workers restarted later are forked from this process and
+        # must start from the original context, not one with the supervisor's IPC server and host cache proxy.
+        context = copy.copy(self.context)
+        self.ipc = ipc = IPCManager(context)
+        ipc.register_rpc_handlers(api_routes)
+        context.ipc = ipc
+        context.host_cache = WorkerHostCaches(ipc)
+        self.pipe_stats = WorkerPipeStats(ipc, context.settings.pipe_stats_interval)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            logger.debug("Started worker {} (pid {})".format(index, pid))
+            self.workers[pid] = index
+            return
+
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            self._init_worker(index)
+            self.run_worker(index)
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            logger.exception("Worker {} failed".format(index))
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _init_worker(self, index):
+        # Connections and threads don't survive a fork. Restarted workers are forked from a supervisor whose IPC
+        # server is running and whose API handlers may have used the database, start without any of that.
+        db.close()
+        if self.ipc is not None:
+            self.ipc.close_inherited_sockets()
+            self.ipc = None
+            self.pipe_stats = None
+
+        context = self.context
+        context.worker_index = index
+
+        settings = context.settings
+        context.host_cache = TTLCache(max_size=settings.host_cache_size,
+                                      ttl=settings.host_cache_ttl,
+                                      negative_ttl=settings.host_cache_negative_ttl)
+
+        parent = os.getppid()
+
+        def on_disconnect():
+            if os.getppid() != parent:
+                # The supervisor is gone, shut down instead of reconnecting
+                os.kill(os.getpid(), signal.SIGTERM)
+                return False
+
+        url = 'ws://127.0.0.1:{}/'.format(context.settings.ipc_port)
+        context.ipc = IPCWorkerClient(context, url, on_disconnect=on_disconnect)
+        share_host_cache(context.ipc, context.host_cache, index)
@@ -27,5 +27,12 @@ setup(
         'tornado',
         'appdirs',
         'ipwhois',
+        'requests',
+        'six',
+        'futures; python_version < "3.0"',
+        'ipaddress; python_version < "3.3"',
     ],
+    extras_require={
+        'msgpack': ['msgpack-python'],
+    },
 )